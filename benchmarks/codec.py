@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the FastAGI reply decoding.
+
+Compares the table-driven L{twisted.fats.codec.ResponseCodec} with the
+regular expression compiled per reply, which was used by
+C{FastAGIProtocol._returnCommandValues} before.
+
+Usage: python benchmarks/codec.py [iterations]
+
+$Id$
+"""
+
+import re, sys, time
+
+from twisted.fats.agi import CODEC
+
+
+REPLIES = [('ANSWER', '0'),
+           ('SET VARIABLE', '1'),
+           ('NOOP', '0'),
+           ('STREAM FILE', '0 endpos=12345'),
+           ('STREAM FILE', '55 endpos=4000'),
+           ('GET DATA', '1234 (timeout)'),
+           ('DATABASE GET', '1 (some value)'),
+           ('GET FULL VARIABLE', '1 3'),
+           ('RECORD FILE', '0 (hangup) endpos=123456'),
+           ('WAIT FOR DIGIT', '49')]
+
+
+def regexDecode(name, line):
+    r_pattern = re.compile(
+        r"""
+        (?P<result>[\S]?[0-9]?[\w]{0,})
+        (?:|[\b, (]{0,2}(?P<extra>.*?)[\b, )]{0,2})
+        (?:|endpos=(?P<endpos>\d+))$
+        """,
+        re.IGNORECASE|re.VERBOSE)
+    return r_pattern.match(line).groups()
+
+
+def codecDecode(name, line):
+    return CODEC.decode(name, line)
+
+
+def bench(decode, iterations):
+    replies = REPLIES
+    start = time.time()
+    for _ in xrange(iterations):
+        for name, line in replies:
+            decode(name, line)
+    return time.time() - start
+
+
+def main(iterations=20000):
+    total = iterations * len(REPLIES)
+    results = {}
+    for label, decode in (('regex', regexDecode), ('codec', codecDecode)):
+        elapsed = bench(decode, iterations)
+        results[label] = elapsed
+        print '%-6s %8.3fs %10.0f replies/s %6.2f us/reply' % (
+            label, elapsed, total / elapsed, elapsed / total * 1e6)
+    print 'speedup: %.1fx' % (results['regex'] / results['codec'])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
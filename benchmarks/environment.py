@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the FastAGI environment block handling.
+
+Compares the former line by line parsing (split, rstrip, lower and insert
+for every C{agi_*} line) with L{twisted.fats.environment.AGIEnvironment},
+when the handler reads four variables. Memory is the size of the objects
+kept per session, counted with C{sys.getsizeof}.
+
+Usage: python benchmarks/environment.py [iterations]
+
+$Id$
+"""
+
+import sys, time
+
+from twisted.fats.environment import AGIEnvironment
+
+BLOCK = """agi_network: yes
+agi_request: agi://localhost:9000/ivr/main?foo=bar
+agi_channel: SIP/tester-0825d3a8
+agi_language: en
+agi_type: SIP
+agi_uniqueid: 1203332455.12
+agi_callerid: 70065798
+agi_calleridname: FastAGI Tester
+agi_callingpres: 0
+agi_callingani2: 0
+agi_callington: 0
+agi_callingtns: 0
+agi_dnid: 1000
+agi_rdnis: unknown
+agi_context: testing
+agi_extension: 1000
+agi_priority: 1
+agi_enhanced: 0.0
+agi_accountcode: 1337
+"""
+READ = ('agi_request', 'agi_callerid', 'agi_dnid', 'agi_accountcode')
+
+
+def lineByLine(data):
+    env = {}
+    for line in data.split('\n')[:-1]:
+        key, value = line.split(': ', 1)
+        value = value.rstrip()
+        env[key.lower()] = value
+    for key in READ:
+        env[key]
+    return env
+
+
+def lazyBlock(data):
+    env = AGIEnvironment(data)
+    for key in READ:
+        env[key]
+    return env
+
+
+def sessionSize(env):
+    if isinstance(env, dict):
+        return sys.getsizeof(env) + sum(sys.getsizeof(v)
+                                        for v in env.itervalues())
+    return (sys.getsizeof(env) + sys.getsizeof(env.__dict__)
+            + sys.getsizeof(env.block) + sys.getsizeof(env.values)
+            + sum(sys.getsizeof(v) for v in env.values.itervalues()))
+
+
+def main(iterations=50000):
+    # Every session gets its own copy of the block from the transport.
+    data = [BLOCK[:-1] + '\n' for _ in range(100)]
+    for label, parse in (('lines', lineByLine), ('block', lazyBlock)):
+        start = time.time()
+        for i in xrange(iterations):
+            parse(data[i % 100])
+        elapsed = time.time() - start
+        print '%-6s %6.2f us/call start %6d bytes/session' % (
+            label, elapsed / iterations * 1e6, sessionSize(parse(data[0])))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
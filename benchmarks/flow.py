@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the compiled IVR flow against the call handler.
+
+Runs the same reception IVR (answer, set the variable, play the greeting
+with the number, the menu, the transfer) as:
+
+ - the generator call handler driven by the
+   L{twisted.fats.service.CoroutineDriver}, one command per round trip;
+ - the L{twisted.fats.flow.Flow}, which pipelines the steps before the
+   menu.
+
+Replies are fed to the protocol one by one, like the Asterisk does.
+Reports the CPU time per call and the number of the transport writes,
+which are the round trips the call waits for.
+
+Usage: python benchmarks/flow.py [calls]
+
+$Id$
+"""
+
+import sys, time, gc
+
+from twisted.python import log
+from twisted.fats.agi import FastAGIProtocol
+from twisted.fats.flow import Flow
+from twisted.fats.service import CoroutineDriver
+from twisted.fats.timer import TimerWheel
+
+log.msg = lambda *args, **kwargs: None
+
+
+class CountingTransport(object):
+    disconnecting = False
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+    def loseConnection(self):
+        pass
+
+
+def handler(agi):
+    yield agi.answer()
+    yield agi.setVariable('CDR(userfield)', 'ivr')
+    yield agi.streamFile('welcome')
+    yield agi.sayNumber(42)
+    result = yield agi.streamFile('press-1-sales', '12')
+    if result.result == '2':
+        yield agi.exec_('Dial', 'SIP/support')
+    else:
+        yield agi.exec_('Dial', 'SIP/sales')
+
+HANDLER_REPLIES = ['200 result=0', '200 result=1', '200 result=0 endpos=100',
+                   '200 result=0', '200 result=50 endpos=100',
+                   '200 result=0']
+
+FLOW = Flow({
+    'main': [('answer',),
+             ('set', {'CDR(userfield)': 'ivr'}),
+             ('play', 'welcome'),
+             ('say', 'number', 42),
+             ('menu', 'press-1-sales', {'1': 'sales', '2': 'support'})],
+    'sales': [('transfer', 'SIP/sales')],
+    'support': [('transfer', 'SIP/support')]})
+
+FLOW_REPLIES = ['200 result=0', '200 result=0', '200 result=0',
+                '200 result=50 endpos=100', '200 result=0']
+
+STYLES = [('CallHandler', lambda agi: CoroutineDriver(handler(agi)).start(),
+           HANDLER_REPLIES),
+          ('Flow', FLOW.run, FLOW_REPLIES)]
+
+
+def run(style, replies, calls):
+    """
+    @return: seconds per call and writes per call.
+    """
+    wheel = TimerWheel()
+    done = []
+    transport = CountingTransport()
+    start = time.clock()
+    for _ in xrange(calls):
+        agi = FastAGIProtocol()
+        agi.wheel = wheel
+        agi.makeConnection(transport)
+        agi.readingEnv = False
+        agi.env = {}
+        style(agi).addCallback(done.append)
+        for reply in replies:
+            agi.lineReceived(reply)
+    elapsed = time.clock() - start
+    assert len(done) == calls
+    return elapsed / calls, float(transport.writes) / calls
+
+
+def main(calls=2000):
+    print 'CPU time, best of 10 runs'
+    for label, style, replies in STYLES:
+        gc.disable()
+        try:
+            results = [run(style, replies, calls) for _ in range(10)]
+        finally:
+            gc.enable()
+        print '%-12s %7.1f us/call %4.1f round trips/call' % (
+            label, min(results)[0] * 1e6, results[0][1])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the stream framing.
+
+Compares L{basic.LineOnlyReceiver} with L{twisted.fats.framing.FramedReceiver}
+in the line mode on:
+
+ - AMI event flood delivered in 4096 byte chunks;
+ - long lines delivered in 64 byte chunks, where the line receiver copies
+   the buffered partial line again with every chunk.
+
+The event flood is also fed to the L{twisted.fats.ami.AMI} in the message
+mode, its C{frameReceived} splits every message into the lines, so all the
+receivers deliver the same lines to C{lineReceived}.
+
+Usage: python benchmarks/framing.py [megabytes]
+
+$Id$
+"""
+
+import sys, time
+
+from twisted.protocols import basic
+from twisted.fats.framing import Framer, FramedReceiver
+from twisted.fats.ami import AMI
+
+EVENT = ('Event: Newchannel\r\nPrivilege: call,all\r\n'
+         'Channel: SIP/fats-08173788\r\nState: Ring\r\nCallerid: fats\r\n'
+         'Calleridname: <unknown>\r\nUniqueid: 1192989348.9\r\n\r\n')
+
+
+class NullTransport:
+    disconnecting = False
+
+    def write(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+class LineCounter(basic.LineOnlyReceiver):
+    MAX_LENGTH = 1 << 20
+    frames = 0
+
+    def lineReceived(self, line):
+        self.frames += 1
+
+
+class FramedLineCounter(FramedReceiver):
+    MAX_LENGTH = 1 << 20
+    frames = 0
+
+    def lineReceived(self, line):
+        self.frames += 1
+
+
+class AMICounter(AMI):
+    """
+    L{AMI} after the greeting, with the message parsing stubbed out.
+    """
+    greeted = True
+    frames = 0
+
+    def lineReceived(self, line):
+        self.frames += 1
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def run(factory, data, delimiter=None):
+    proto = factory()
+    proto.makeConnection(NullTransport())
+    if delimiter is not None:
+        proto.framer = Framer(delimiter)
+    start = time.time()
+    for chunk in data:
+        proto.dataReceived(chunk)
+    return time.time() - start, proto.frames
+
+
+def main(megabytes=8):
+    flood = EVENT * (megabytes * (1 << 20) / len(EVENT))
+    longLines = ('x' * 65535 + '\r\n') * 4
+    lineReceivers = [('LineOnlyReceiver', LineCounter, None),
+                     ('FramedReceiver', FramedLineCounter, None)]
+    cases = [('event flood', chunks(flood, 4096), len(flood),
+              lineReceivers + [('AMI.frameReceived', AMICounter,
+                                '\r\n\r\n')]),
+             ('long lines', chunks(longLines, 64), len(longLines),
+              lineReceivers)]
+
+    for case, data, size, receivers in cases:
+        print case
+        for label, factory, delimiter in receivers:
+            elapsed, lines = run(factory, data, delimiter)
+            print '  %-20s %8.1f MB/s %8d lines' % (
+                label, size / elapsed / (1 << 20), lines)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
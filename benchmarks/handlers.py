@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the call handler styles.
+
+Runs the same 10 command IVR script against L{FastAGIProtocol} written as:
+
+ - nested C{addCallback} chain;
+ - C{defer.inlineCallbacks} generator;
+ - plain generator driven by L{twisted.fats.service.CoroutineDriver}.
+
+Replies are fed to the protocol one by one after each command is sent,
+like the Asterisk does. Reports the CPU time per call, and the time of the
+handler machinery alone, when the commands are stubbed with the pending
+deferreds which are fired in order.
+
+Usage: python benchmarks/handlers.py [calls]
+
+$Id$
+"""
+
+import sys, time, gc
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.fats.agi import FastAGIProtocol
+from twisted.fats.service import CoroutineDriver
+from twisted.fats.timer import TimerWheel
+
+log.msg = lambda *args, **kwargs: None
+
+
+class NullTransport(object):
+    disconnecting = False
+
+    def write(self, data):
+        pass
+
+    def loseConnection(self):
+        pass
+
+
+def callbacks(agi):
+    df = agi.answer()
+    df.addCallback(lambda _: agi.setVariable('LANG', 'en'))
+    df.addCallback(lambda _: agi.streamFile('welcome'))
+    df.addCallback(lambda _: agi.getData('menu', 3, 1))
+    df.addCallback(lambda _: agi.databaseGet('ivr', 'choice'))
+    df.addCallback(lambda _: agi.streamFile('option'))
+    df.addCallback(lambda _: agi.sayNumber(42))
+    df.addCallback(lambda _: agi.setVariable('DONE', '1'))
+    df.addCallback(lambda _: agi.streamFile('goodbye'))
+    df.addCallback(lambda _: agi.hangup())
+    return df
+
+
+def generator(agi):
+    yield agi.answer()
+    yield agi.setVariable('LANG', 'en')
+    yield agi.streamFile('welcome')
+    yield agi.getData('menu', 3, 1)
+    yield agi.databaseGet('ivr', 'choice')
+    yield agi.streamFile('option')
+    yield agi.sayNumber(42)
+    yield agi.setVariable('DONE', '1')
+    yield agi.streamFile('goodbye')
+    yield agi.hangup()
+
+STYLES = [('addCallback', callbacks),
+          ('inlineCallbacks', defer.inlineCallbacks(generator)),
+          ('CoroutineDriver',
+           lambda agi: CoroutineDriver(generator(agi)).start())]
+
+REPLIES = ['200 result=0', '200 result=1', '200 result=0 endpos=100',
+           '200 result=1', '200 result=1 (2)', '200 result=0 endpos=100',
+           '200 result=0', '200 result=1', '200 result=0 endpos=100',
+           '200 result=1']
+
+
+def run(style, calls):
+    """
+    @return: seconds per call.
+    """
+    wheel = TimerWheel()
+    done = []
+    start = time.clock()
+    for _ in xrange(calls):
+        agi = FastAGIProtocol()
+        agi.wheel = wheel
+        agi.makeConnection(NullTransport())
+        agi.readingEnv = False
+        style(agi).addCallback(done.append)
+        for reply in REPLIES:
+            agi.lineReceived(reply)
+    elapsed = time.clock() - start
+    assert len(done) == calls
+    return elapsed / calls
+
+
+class StubAGI(object):
+    """
+    Commands return the pending deferreds, fired by L{reply}.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def __getattr__(self, name):
+        def command(*args):
+            df = defer.Deferred()
+            self.pending.append(df)
+            return df
+        return command
+
+    def reply(self):
+        self.pending.pop(0).callback(None)
+
+
+def runStub(style, calls):
+    """
+    @return: seconds per call of the handler machinery.
+    """
+    done = []
+    start = time.clock()
+    for _ in xrange(calls):
+        agi = StubAGI()
+        style(agi).addCallback(done.append)
+        for reply in REPLIES:
+            agi.reply()
+    elapsed = time.clock() - start
+    assert len(done) == calls
+    return elapsed / calls
+
+
+def best(func, style, calls, repeat=10):
+    gc.disable()
+    try:
+        return min(func(style, calls) for _ in range(repeat))
+    finally:
+        gc.enable()
+
+
+def main(calls=2000):
+    print 'CPU time, best of 10 runs'
+    for label, style in STYLES:
+        print '%-16s %7.1f us/call %7.1f us/call handler only' % (
+            label, best(run, style, calls) * 1e6,
+            best(runStub, style, calls) * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the middleware around the FastAGI calls.
+
+Starts the synchronous handler by L{FastAGIFactory.handleCall} with:
+
+ - no middleware;
+ - the given number of the empty L{Middleware}s, which define no hook;
+ - the given number of the no-op middlewares defining all the hooks, run
+   from the flattened tuples of L{FastAGIFactory.compileMiddleware};
+ - the same ones, each wrapping the call with its own closures and
+   deferred callbacks, like the decorated C{handleCall} does;
+ - the stock L{CallMetrics} and L{AccountcodeLimit}.
+
+Reports the CPU time per call and the overhead per middleware over the
+bare call.
+
+Usage: python benchmarks/middleware.py [middleware] [calls]
+
+$Id$
+"""
+
+import sys, time, gc
+
+from twisted.internet import defer, task
+from twisted.python import log
+from twisted.fats.middleware import Middleware, AccountcodeLimit, CallMetrics
+from twisted.fats.service import FastAGIFactory, CallHandler
+
+log.msg = lambda *args, **kwargs: None
+
+
+class Call(object):
+    route = url = handler = None
+    env = {'agi_accountcode': 'acme'}
+
+    def finish(self):
+        pass
+
+
+class Handler(CallHandler):
+
+    def startCall(self):
+        return defer.succeed(None)
+
+
+class Noop(Middleware):
+
+    def before(self, agi):
+        pass
+
+    def after(self, agi, result):
+        pass
+
+    def error(self, agi, reason):
+        pass
+
+
+class WrappingFactory(FastAGIFactory):
+    """
+    Runs every middleware in its own per-call callbacks.
+    """
+
+    def handleCall(self, agi):
+        wrapped = FastAGIFactory.handleCall
+        for item in reversed(self.middleware):
+            wrapped = self._wrap(item, wrapped)
+        return wrapped(self, agi)
+
+    def _wrap(self, item, inner):
+        def handleCall(factory, agi):
+            result = item.before(agi)
+            if result is not None:
+                return result
+            def after(result):
+                item.after(agi, result)
+                return result
+            def error(reason):
+                item.error(agi, reason)
+                return reason
+            return inner(factory, agi).addCallbacks(after, error)
+        return handleCall
+
+    def compileMiddleware(self):
+        self._before = self._after = self._error = ()
+
+
+def factory(middleware, factoryClass=FastAGIFactory):
+    factory = factoryClass()
+    factory.handler = Handler
+    factory.middleware = middleware
+    factory.startFactory()
+    return factory
+
+
+def run(factory, calls):
+    call = Call()
+    handleCall = factory.handleCall
+    gc.collect()
+    started = time.clock()
+    for index in xrange(calls):
+        handleCall(call)
+        factory.callEnded(call)
+    return (time.clock() - started) / calls
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 5
+    calls = len(sys.argv) > 2 and int(sys.argv[2]) or 100000
+    noop = [Noop() for index in range(count)]
+    print '%d middleware, %d calls' % (count, calls)
+    bare = run(factory(()), calls)
+    for name, middleware, factoryClass in (
+            ('none', (), FastAGIFactory),
+            ('empty', [Middleware() for index in range(count)],
+             FastAGIFactory),
+            ('flat', noop, FastAGIFactory),
+            ('wrapped', noop, WrappingFactory),
+            ('metrics', [CallMetrics(task.Clock())], FastAGIFactory),
+            ('limit', [AccountcodeLimit(10)], FastAGIFactory)):
+        seconds = run(factory(middleware, factoryClass), calls)
+        print '%-8s %8.2f us/call %8.2f us/middleware' % (
+            name, seconds * 1e6,
+            middleware and (seconds - bare) * 1e6 / len(middleware) or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the prefork FastAGI server by the number of the workers.
+
+Starts the L{twisted.fats.prefork.Supervisor} with 1, 2 and 4 workers on
+the loopback port, then the client processes which play the Asterisk: each
+one opens the call, sends the environment and answers every command with
+C{200 result=0} until the server closes the call. The handler answers the
+call, reads five variables and plays the prompt. Reports the calls per
+second served with the inherited socket and with C{SO_REUSEPORT}, and the
+CPU time of the supervisor and the workers per call, which includes the
+start of the worker interpreters.
+
+The calls per second grow with the workers only up to the number of the
+free cores, the clients take their share of them too; on the one core box
+the workers just share it.
+
+Usage: python benchmarks/prefork.py [seconds] [clients]
+
+$Id$
+"""
+
+import sys, os, time, socket, signal
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.fats.prefork import Supervisor
+from twisted.fats.service import FastAGIFactory, CallHandler
+
+log.msg = lambda *args, **kwargs: None
+
+ENV = ''.join(['agi_network: yes\n',
+               'agi_request: agi://127.0.0.1/bench\n',
+               'agi_channel: SIP/bench-1\n',
+               'agi_language: en\n',
+               'agi_uniqueid: 1\n',
+               '\n'])
+
+
+class Handler(CallHandler):
+
+    def startCall(self):
+        yield self.agi.answer()
+        for name in ('A', 'B', 'C', 'D', 'E'):
+            yield self.agi.getVariable(name)
+        yield self.agi.streamFile('hello')
+
+
+class Factory(FastAGIFactory):
+    handler = Handler
+
+
+def serve(port, workers, reusePort):
+    # The workers import this module by its name, it is on their path.
+    supervisor = Supervisor('prefork.Factory', port, workers=workers,
+                            interface='127.0.0.1', reusePort=reusePort,
+                            restartDelay=0.1)
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  supervisor.stopService)
+    supervisor.startService()
+    reactor.run(installSignalHandlers=True)
+    os._exit(0)
+
+
+def client(port, seconds, out):
+    calls = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        skt = socket.create_connection(('127.0.0.1', port))
+        skt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        skt.sendall(ENV)
+        lines = skt.makefile('rb')
+        while lines.readline():
+            skt.sendall('200 result=0\n')
+        skt.close()
+        calls += 1
+    os.write(out, '%d\n' % calls)
+    os._exit(0)
+
+
+def freePort():
+    skt = socket.socket()
+    skt.bind(('127.0.0.1', 0))
+    port = skt.getsockname()[1]
+    skt.close()
+    return port
+
+
+def waitPort(port):
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise SystemExit('The server did not start')
+
+
+def run(workers, reusePort, seconds, clients):
+    """
+    @return: calls per second and server CPU seconds per call.
+    """
+    port = freePort()
+    server = os.fork()
+    if not server:
+        serve(port, workers, reusePort)
+    waitPort(port)
+    # Let the other workers start, each one is a new interpreter.
+    time.sleep(0.2 + 0.5 * workers)
+    read, write = os.pipe()
+    pids = []
+    for i in range(clients):
+        pid = os.fork()
+        if not pid:
+            client(port, seconds, write)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    os.close(write)
+    calls = sum([int(line) for line in os.fdopen(read).read().split()])
+    before = os.times()
+    os.kill(server, signal.SIGTERM)
+    os.waitpid(server, 0)
+    after = os.times()
+    cpu = after[2] + after[3] - before[2] - before[3]
+    return calls / float(seconds), cpu / max(calls, 1)
+
+
+def main():
+    seconds = len(sys.argv) > 1 and float(sys.argv[1]) or 3
+    clients = len(sys.argv) > 2 and int(sys.argv[2]) or 8
+    print 'CPUs: %d, clients: %d, %.1f s per run' % (
+        os.sysconf('SC_NPROCESSORS_ONLN'), clients, seconds)
+    print '%-8s %-10s %12s %14s' % ('workers', 'socket', 'calls/s',
+                                    'us CPU/call')
+    for reusePort in (False, True):
+        for workers in (1, 2, 4):
+            rate, cpu = run(workers, reusePort, seconds, clients)
+            print '%-8d %-10s %12.0f %14.1f' % (
+                workers, reusePort and 'reuseport' or 'inherited', rate,
+                cpu * 1e6)
+
+
+if __name__ == '__main__':
+    main()
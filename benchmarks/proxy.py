@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the FastAGI proxy overhead.
+
+Starts the FastAGI backend process and the L{twisted.fats.proxy} process
+in front of it, then the client processes which play the Asterisk like
+in C{benchmarks/prefork.py}. Reports the calls per second served directly
+by the backend and through the proxy, and the CPU time of the proxy per
+call. All the processes share the cores of the box.
+
+Usage: python benchmarks/proxy.py [seconds] [clients]
+
+$Id$
+"""
+
+import sys, os, signal
+
+from twisted.internet import reactor
+from twisted.fats.proxy import ProxyFactory, BackendPool, Backend
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from prefork import Factory, client, freePort, waitPort
+
+
+def spawn(target, *args):
+    pid = os.fork()
+    if not pid:
+        target(*args)
+        reactor.run()
+        os._exit(0)
+    return pid
+
+
+def backend(port):
+    reactor.listenTCP(port, Factory(), interface='127.0.0.1')
+
+
+def proxy(port, backendPort):
+    pool = BackendPool([Backend('127.0.0.1', backendPort)])
+    reactor.listenTCP(port, ProxyFactory(pool), backlog=128,
+                      interface='127.0.0.1')
+
+
+def load(port, seconds, clients):
+    read, write = os.pipe()
+    pids = []
+    for i in range(clients):
+        pid = os.fork()
+        if not pid:
+            client(port, seconds, write)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    os.close(write)
+    return sum([int(line) for line in os.fdopen(read).read().split()])
+
+
+def stop(pid):
+    before = os.times()
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    after = os.times()
+    return after[2] + after[3] - before[2] - before[3]
+
+
+def main():
+    seconds = len(sys.argv) > 1 and float(sys.argv[1]) or 3
+    clients = len(sys.argv) > 2 and int(sys.argv[2]) or 8
+    backendPort, proxyPort = freePort(), freePort()
+    server = spawn(backend, backendPort)
+    waitPort(backendPort)
+    direct = load(backendPort, seconds, clients)
+    front = spawn(proxy, proxyPort, backendPort)
+    waitPort(proxyPort)
+    proxied = load(proxyPort, seconds, clients)
+    cpu = stop(front)
+    stop(server)
+    print 'CPUs: %d, clients: %d, %.1f s per run' % (
+        os.sysconf('SC_NPROCESSORS_ONLN'), clients, seconds)
+    print 'direct   %8.0f calls/s' % (direct / seconds)
+    print 'proxied  %8.0f calls/s, proxy %.1f us CPU/call' % (
+        proxied / seconds, cpu / max(proxied, 1) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the FastAGI command result objects.
+
+Compares the slotted L{twisted.fats.agi.Command} and
+L{twisted.fats.agi.ResultCode} with the former C{__dict__} based command,
+whose result code methods split the C{COMMANDS} templates on every call.
+Memory per reply is measured with C{tracemalloc} when the interpreter has
+it, otherwise with C{sys.getsizeof} of the object and its C{__dict__}.
+
+Usage: python benchmarks/results.py [iterations]
+
+$Id$
+"""
+
+import sys, time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from twisted.fats.agi import COMMANDS, SUCCESS, FAILURE, Command, ResultCode
+
+
+class LegacyCommand(object):
+    __rcode = lambda self, type: COMMANDS[self.name][type].split()[0]
+    is_success = lambda self: bool(self.result == self.__rcode(SUCCESS))
+    is_failure = lambda self: bool(self.result == self.__rcode(FAILURE))
+    is_default = lambda self: bool(self.result in (self.__rcode(SUCCESS),
+                                                   self.__rcode(FAILURE)))
+    has_error = lambda self: bool(self.is_failure() and not self.is_success())
+
+    def __init__(self, name, result=None, extra=None, endpos=None):
+        if name.endswith('_'):
+            name = name[:-1]
+        self.name = name.upper()
+        self.result = result
+        self.endpos = None if endpos is None else int(endpos)
+        self.extra = None if not endpos is None and extra == '' else extra
+        self.has_dtmf = False
+
+
+CASES = [('legacy', lambda: LegacyCommand('ANSWER', '0')),
+         ('Command', lambda: Command('ANSWER', '0')),
+         ('ResultCode', lambda: ResultCode('ANSWER', '0'))]
+
+
+def objectSize(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def allocated(factory, count):
+    """
+    @return: bytes allocated per object.
+    """
+    if tracemalloc is None:
+        return objectSize(factory())
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [factory() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before - sys.getsizeof(objects)) / float(count)
+
+
+def cpu(factory, iterations):
+    """
+    @return: seconds per reply, including the error check done by the
+        protocol for every reply.
+    """
+    start = time.time()
+    for _ in range(iterations):
+        factory().has_error()
+    return (time.time() - start) / iterations
+
+
+def main(iterations=100000):
+    print 'memory: %s' % ('tracemalloc' if tracemalloc else 'sys.getsizeof')
+    for label, factory in CASES:
+        print '%-10s %7.1f bytes/reply %6.2f us/reply' % (
+            label, allocated(factory, 10000), cpu(factory, iterations) * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
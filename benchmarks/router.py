@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the call dispatch by the agi_request path.
+
+Dispatches the requests among the given number of the IVR services:
+
+ - linear: L{URL} parsed per call, then the chain of the path comparisons,
+   like the handler with the C{if} chain does;
+ - router: L{twisted.fats.agi.parseURL} from the cache, then the
+   L{twisted.fats.router.Router} trie.
+
+Reports the CPU time per dispatch.
+
+Usage: python benchmarks/router.py [services] [calls]
+
+$Id$
+"""
+
+import sys, time, gc
+
+from twisted.fats.agi import URL, parseURL
+from twisted.fats.router import Router
+
+
+def requests(services):
+    return ['agi://10.0.0.1/ivr/service%d/%s?lang=en' % (index, 'queue%d'
+            % (index % 7)) for index in range(services)]
+
+
+def linear(services):
+    paths = [('ivr', 'service%d' % index) for index in range(services)]
+    def dispatch(request):
+        path = URL(request).path
+        for index, prefix in enumerate(paths):
+            if path[:2] == prefix:
+                return index, path[2]
+    return dispatch
+
+
+def trie(services):
+    router = Router()
+    for index in range(services):
+        router.add('ivr/service%d/{queue}' % index, index)
+    def dispatch(request):
+        route, args = router.match(parseURL(request).path)
+        return route.handler, args['queue']
+    return dispatch
+
+
+def run(dispatch, requests, calls):
+    count = len(requests)
+    gc.collect()
+    started = time.clock()
+    for index in xrange(calls):
+        dispatch(requests[index % count])
+    return (time.clock() - started) / calls
+
+
+def main():
+    services = len(sys.argv) > 1 and int(sys.argv[1]) or 300
+    calls = len(sys.argv) > 2 and int(sys.argv[2]) or 100000
+    reqs = requests(services)
+    assert linear(services)(reqs[-1]) == trie(services)(reqs[-1])
+    print '%d services, %d calls' % (services, calls)
+    for name, factory in (('linear', linear), ('router', trie)):
+        print '%-8s %8.2f us/call' % (name,
+                                       run(factory(services), reqs, calls) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the SAY sentence.
+
+Plays "you have 3 messages, the last one on <date> at <time>" as the
+separate C{STREAM FILE} and C{SAY} commands, and as one playlist rendered
+by L{twisted.fats.say.Sentence}. Reports the AGI round trips and the CPU
+time per sentence, the replies are fed at once like the Asterisk does.
+
+Usage: python benchmarks/say.py [sentences]
+
+$Id$
+"""
+
+import sys, time, gc, datetime
+
+from twisted.python import log
+from twisted.fats.agi import FastAGIProtocol
+from twisted.fats.say import Sentence
+from twisted.fats.timer import TimerWheel
+
+log.msg = lambda *args, **kwargs: None
+
+LAST = datetime.datetime(2008, 3, 5, 14, 5)
+
+
+class ReplyingTransport(object):
+    """
+    Answers every command line with the success reply.
+    """
+    disconnecting = False
+
+    def __init__(self):
+        self.commands = 0
+
+    def write(self, data):
+        self.commands += data.count('\n')
+        for line in data.splitlines():
+            if line.startswith('STREAM FILE'):
+                self.agi.lineReceived('200 result=0 endpos=8000')
+            else:
+                self.agi.lineReceived('200 result=0')
+
+    def loseConnection(self):
+        pass
+
+
+def commands(agi):
+    df = agi.streamFile('vm-youhave')
+    df.addCallback(lambda _: agi.sayNumber(3))
+    df.addCallback(lambda _: agi.streamFile('vm-messages'))
+    df.addCallback(lambda _: agi.sayDate(LAST))
+    df.addCallback(lambda _: agi.streamFile('digits/at'))
+    df.addCallback(lambda _: agi.sayTime(LAST))
+    return df
+
+
+def sentence(agi):
+    return Sentence(agi).file('vm-youhave').number(3).file('vm-messages'
+        ).date(LAST).file('digits/at').time(LAST).play()
+
+
+def run(style, count):
+    """
+    @return: seconds and AGI commands per sentence.
+    """
+    wheel = TimerWheel()
+    sent = 0
+    start = time.clock()
+    for _ in xrange(count):
+        agi = FastAGIProtocol()
+        agi.wheel = wheel
+        transport = ReplyingTransport()
+        transport.agi = agi
+        agi.makeConnection(transport)
+        agi._setEnv({'agi_language': 'en'})
+        style(agi)
+        sent += transport.commands
+    return (time.clock() - start) / count, sent / count
+
+
+def main(count=2000):
+    gc.disable()
+    print 'CPU time, best of 5 runs'
+    for label, style in [('separate commands', commands),
+                         ('Sentence', sentence)]:
+        elapsed, sent = min(run(style, count) for _ in range(5))
+        print '%-18s %2d round trips %7.1f us/sentence' % (
+            label, sent, elapsed * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
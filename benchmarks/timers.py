@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Benchmark of the session timers.
+
+Every live call holds a session deadline. Each call runs commands, and
+every command reply cancels that command's deadline and schedules the
+next one. The benchmark compares the cost of this with
+C{reactor.callLater} and with the shared L{twisted.fats.timer.TimerWheel}.
+It reports the time per command and the number of entries in the
+reactor's delayed call heap.
+
+Usage: python benchmarks/timers.py [calls]
+
+$Id$
+"""
+
+import sys, time
+
+from twisted.internet import reactor
+from twisted.fats.timer import TimerWheel
+
+COMMANDS = 10
+
+
+def noop():
+    pass
+
+
+def run(callLater, calls):
+    """
+    @return: seconds per command.
+    """
+    start = time.time()
+    sessions = [callLater(3600, noop) for _ in xrange(calls)]
+    for _ in xrange(COMMANDS):
+        deadlines = [callLater(30, noop) for _ in xrange(calls)]
+        for deadline in deadlines:
+            deadline.cancel()
+    for session in sessions:
+        session.cancel()
+    return (time.time() - start) / (calls * COMMANDS)
+
+
+def main(calls=20000):
+    wheel = TimerWheel(reactor)
+    for label, callLater in (('reactor.callLater', reactor.callLater),
+                             ('TimerWheel', wheel.callLater)):
+        sessions = [callLater(3600, noop) for _ in xrange(calls)]
+        size = len(reactor.getDelayedCalls())
+        for session in sessions:
+            session.cancel()
+        print '%-18s %6.2f us/command %6d delayed calls for %d calls' % (
+            label, run(callLater, calls) * 1e6, size, calls)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,293 @@
+# -*- test-case-name: twisted.fats.test.test_admission -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Admission control of the calls
+
+API Stability: unstable
+
+Without the limit every accepted call starts its handler, so during the
+call storm all the calls slow down together. The L{AdmissionController} of
+the L{FastAGIFactory} runs at most L{AdmissionController.maxCalls} handlers
+(and at most the limit of the route per L{URL.path}), keeps the calls over
+the limit in the bounded queue ordered by the priority of their
+accountcode, and returns the calls which can't be served to the dialplan
+at once, by the fallback::
+
+    factory = FastAGIFactory()
+    factory.admission = AdmissionController(
+        maxCalls=200, maxPerPath={('queue',): 50},
+        priorities={'vip': 0}, fallback=overflowTo('overflow'),
+        adaptive=True)
+
+The adaptive limit starts at the L{maxCalls} and follows the load: it is
+decreased while the command latency or the reactor lag are over their
+targets, and increased again while the limit is reached under the normal
+load.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import heapq
+
+from twisted.internet import defer
+from twisted.python import log
+
+from twisted.fats.timer import getWheel
+
+
+def _isAlive(agi):
+    transport = agi.transport
+    return (transport is not None and not transport.disconnecting
+            and not agi.hungup)
+
+
+def overflowTo(context, extension='s', priority=1):
+    """
+    @return: fallback which sends the rejected call to the dialplan
+        location.
+    """
+    def fallback(agi):
+        return agi.pipeline().setContext(context).setExtension(extension
+            ).setPriority(priority).run()
+    return fallback
+
+
+class AdmissionController(object):
+    """
+    Concurrency limits, the wait queue and the load shedding of the calls.
+
+    @ivar maxCalls: limit of the running handlers, C{None} for unlimited.
+    @ivar maxPerPath: limit of the running handlers per route, the
+        dictionary of the limits by L{URL.path} or one limit for every
+        route.
+    @ivar queueSize: number of the calls waiting for the slot.
+    @ivar queueTimeout: seconds the call waits for the slot.
+    @ivar priorities: dictionary of the priorities by the accountcode, the
+        lower number is served first.
+    @ivar defaultPriority: priority of the other accountcodes.
+    @ivar fallback: callable which sends the rejected call to the
+        dialplan, returns the deferred; the call is just finished by
+        default.
+    @ivar adaptive: whether the L{limit} follows the load.
+    @ivar targetLatency: command latency in seconds over which the adaptive
+        limit is decreased.
+    @ivar targetLag: reactor lag in seconds over which the adaptive limit
+        is decreased.
+    @ivar interval: seconds between the adjustments of the adaptive limit.
+    @ivar minCalls: lowest adaptive limit.
+    @ivar limit: current limit of the running handlers.
+    @ivar active: number of the running handlers.
+    @ivar paths: dictionary of the running handlers by the path.
+    @ivar queue: heap of the waiting calls.
+    """
+    defaultPriority = 10
+    decrease = 0.9
+
+    def __init__(self, maxCalls=None, maxPerPath=None, queueSize=100,
+                 queueTimeout=5, priorities=None, fallback=None,
+                 adaptive=False, targetLatency=0.5, targetLag=0.1,
+                 interval=1, minCalls=1, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.maxCalls = maxCalls
+        self.maxPerPath = maxPerPath
+        self.queueSize = queueSize
+        self.queueTimeout = queueTimeout
+        self.priorities = priorities or {}
+        self.fallback = fallback
+        self.adaptive = adaptive and maxCalls is not None
+        self.targetLatency = targetLatency
+        self.targetLag = targetLag
+        self.interval = interval
+        self.minCalls = minCalls
+        self.limit = maxCalls
+        self.active = 0
+        self.paths = {}
+        self.queue = []
+        self._sequence = 0
+        self.admitted = self.queued = self.rejected = self.timedOut = 0
+        self.latency = self.lag = 0.0
+        self._latencies = self._commands = 0
+        self._probe = self._shutdownTrigger = None
+
+    def _path(self, agi):
+        return agi.url is not None and agi.url.path or ()
+
+    def _pathLimit(self, path):
+        limits = self.maxPerPath
+        if isinstance(limits, dict):
+            return limits.get(path)
+        return limits
+
+    def _hasSlot(self, path):
+        if self.limit is not None and self.active >= self.limit:
+            return False
+        limit = self._pathLimit(path)
+        return limit is None or self.paths.get(path, 0) < limit
+
+    def admit(self, agi):
+        """
+        Take the slot for the call, queue it, or reject it.
+
+        @return: deferred fired with C{True} when the handler may start, or
+            with C{False} when the call is rejected and sent to the
+            fallback.
+        """
+        if self.adaptive and self._probe is None:
+            self._startProbe()
+        path = self._path(agi)
+        if self._hasSlot(path):
+            self._take(path)
+            return defer.succeed(True)
+
+        priority = self.priorities.get(agi.env.get('agi_accountcode'),
+                                       self.defaultPriority)
+        if len(self.queue) >= self.queueSize:
+            worst = max(self.queue)
+            if worst[0] <= priority:
+                return self._reject(agi)
+            self.queue.remove(worst)
+            heapq.heapify(self.queue)
+            worst[4].cancel()
+            self._reject(worst[2]).chainDeferred(worst[3])
+
+        self._sequence += 1
+        df = defer.Deferred()
+        entry = [priority, self._sequence, agi, df, None]
+        entry[4] = getWheel(self.reactor).callLater(self.queueTimeout,
+                                                     self._expired, entry)
+        heapq.heappush(self.queue, entry)
+        self.queued += 1
+        return df
+
+    def _take(self, path):
+        self.active += 1
+        self.paths[path] = self.paths.get(path, 0) + 1
+        self.admitted += 1
+
+    def _expired(self, entry):
+        self.queue.remove(entry)
+        heapq.heapify(self.queue)
+        self.timedOut += 1
+        if _isAlive(entry[2]):
+            self._reject(entry[2]).chainDeferred(entry[3])
+        else:
+            entry[3].callback(False)
+
+    def _reject(self, agi):
+        """
+        Send the call to the fallback and finish it.
+
+        @return: deferred C{False}.
+        """
+        self.rejected += 1
+        def finish(result):
+            agi.finish()
+            return False
+        def failed(failure):
+            log.msg('Admission fallback failed: %s' %
+                    failure.getErrorMessage())
+        if self.fallback is None:
+            return defer.maybeDeferred(finish, None)
+        return defer.maybeDeferred(self.fallback, agi
+            ).addErrback(failed).addCallback(finish)
+
+    def release(self, agi):
+        """
+        Free the slot of the finished call and start the waiting ones.
+        """
+        path = self._path(agi)
+        self.active -= 1
+        count = self.paths.get(path, 1) - 1
+        if count:
+            self.paths[path] = count
+        else:
+            self.paths.pop(path, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        skipped = []
+        queue = self.queue
+        while queue and (self.limit is None or self.active < self.limit):
+            entry = heapq.heappop(queue)
+            agi = entry[2]
+            if not _isAlive(agi):
+                entry[4].cancel()
+                entry[3].callback(False)
+                continue
+            path = self._path(agi)
+            if not self._hasSlot(path):
+                skipped.append(entry)
+                continue
+            entry[4].cancel()
+            self._take(path)
+            entry[3].callback(True)
+        for entry in skipped:
+            heapq.heappush(queue, entry)
+
+    def commandCompleted(self, latency):
+        """
+        Account the latency of the AGI command, see
+        L{FastAGIProtocol.commandObserver}.
+        """
+        self._latencies += latency
+        self._commands += 1
+
+    def _startProbe(self):
+        self._expected = self.reactor.seconds() + self.interval
+        self._probe = self.reactor.callLater(self.interval, self._adjust)
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+                'before', 'shutdown', self._shutdown)
+
+    def _shutdown(self):
+        self._shutdownTrigger = None
+        self.stop()
+
+    def stop(self):
+        """
+        Stop adjusting the adaptive limit.
+        """
+        if self._probe is not None and self._probe.active():
+            self._probe.cancel()
+        self._probe = None
+
+    def _adjust(self):
+        """
+        Measure the reactor lag and the command latency, then move the
+        adaptive limit: decrease it multiplicatively on the overload,
+        increase it by one when it is reached under the normal load.
+        """
+        self.lag = max(self.reactor.seconds() - self._expected, 0.0)
+        if self._commands:
+            self.latency = self._latencies / self._commands
+        else:
+            self.latency = 0.0
+        self._latencies = self._commands = 0
+        if self.latency > self.targetLatency or self.lag > self.targetLag:
+            self.limit = max(self.minCalls, int(self.limit * self.decrease))
+        elif self.active >= self.limit and self.limit < self.maxCalls:
+            self.limit += 1
+            self._dispatch()
+        self._startProbe()
+
+    def stats(self):
+        """
+        @return: dictionary of the admission metrics.
+        """
+        return {'active': self.active,
+                'limit': self.limit,
+                'waiting': len(self.queue),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected,
+                'timedOut': self.timedOut,
+                'latency': self.latency,
+                'lag': self.lag}
+
+
+__all__ = ['AdmissionController', 'overflowTo']
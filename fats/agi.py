@@ -22,13 +22,17 @@ See also: U{Asterisk Gateway Interface
 $Id: agi.py 24 2008-02-18 12:22:42Z burus $
 """
 
-import re, time, urllib
-from twisted.internet import reactor, defer, error
-from twisted.protocols import basic
+import time, urllib
+from twisted.internet import defer, error
 from twisted.python import log
 
+from twisted.fats.cache import LRUCache
+from twisted.fats.codec import ResponseCodec
+from twisted.fats.environment import AGIEnvironment, internKey, shareValue
+from twisted.fats.framing import Framer, FramedReceiver
+from twisted.fats.timer import getWheel
 from twisted.fats.errors import AGICommandFailure, UndefinedTimeFormat, \
-     AGICommandTimeout, FailureOnOpen
+     AGICommandTimeout, FailureOnOpen, AGIPipelineAborted, AGIHangup
 
 SUCCESS = 0
 FAILURE = 1
@@ -80,16 +84,79 @@ COMMANDS = {'ANSWER':               ('0', '-1'),
             'VERBOSE':              ('1', '1'),
             'WAIT FOR DIGIT':       ('0', '-1')}
 
+CODEC = ResponseCodec(COMMANDS)
 
-"""
-_result2dig = lambda res: int(res) if not res is None and ((res[1:].isdigit()
-            if res.startswith('-') else res) is True or res.isdigit()) else res
+# Success and failure result codes resolved once per command name.
+RESULT_CODES = dict((name, (shape.success, shape.failure))
+                    for name, shape in CODEC.shapes.iteritems())
+NO_CODES = (None, None)
 
-def cmd_code(cmd_name, type):
-    return COMMANDS[cmd_name][type].split()[0]
-"""
 
-class Command(object):
+class ResultCode(object):
+    """
+    Result of the AGI command which replies with a code only, like
+    C{ANSWER}, C{NOOP} or C{SET VARIABLE}. See L{Command} for the methods.
+
+    @ivar name: command name
+    @ivar result: command result
+    @type result: C{str}
+    """
+    __slots__ = ('name', 'result', 'has_dtmf', '_codes')
+
+    extra = None
+    endpos = None
+
+    def __init__(self, name, result=None):
+        self.name = name
+        self.result = result
+        self.has_dtmf = False
+        self._codes = RESULT_CODES.get(name, NO_CODES)
+
+    def is_success(self):
+        return self.result == self._codes[SUCCESS]
+
+    def is_failure(self):
+        return self.result == self._codes[FAILURE]
+
+    def is_default(self):
+        return self.result in self._codes
+
+    def has_error(self):
+        codes = self._codes
+        return self.result == codes[FAILURE] and self.result != codes[SUCCESS]
+
+    def __eq__(self, obj):
+        """
+        Allow to compare two commands.
+        """
+        try:
+            return (self.name == obj.name and self.result == obj.result
+                    and self.endpos == obj.endpos)
+        except AttributeError:
+            return False
+
+    def __ne__(self, obj):
+        return not self.__eq__(obj)
+
+    def convert_dtmf(self):
+        """
+        Use to convert ASCII responce to the alpha symbol.
+        Be careful and check COMMAND.has_dtmf value.
+        """
+        self.has_dtmf = True
+        self.result = chr(int(self.result))
+
+    def __repr__(self):
+        """
+        Command representation for the debug process.
+        """
+        return '%s:[%s(%s), %s(%s), %s(%s)]' % (self.name, self.result,
+                                                type(self.result),
+                                                self.extra, type(self.extra),
+                                                self.endpos, type(self.endpos))
+
+
+class Command(ResultCode):
     """
     AGI command object. See AGI commands reference for detail info.
 
@@ -103,59 +170,58 @@ class Command(object):
         DTMF ASCII code in the result value. DTMF ASCII result is
         automaticaly converted to the ''char''.
 
-    @method __rcode: return default result code
     @method is_success: return ''true'' if result code is success
     @method is_failure: return ''true'' if result code is failure
     @method is_default: Return ''true'' if command is in default of results
     @method has_error: check result for an undefined error
 
     """
-    __rcode = lambda self, type: COMMANDS[self.name][type].split()[0]
-    is_success = lambda self: bool(self.result == self.__rcode(SUCCESS))
-    is_failure = lambda self: bool(self.result == self.__rcode(FAILURE))
-    is_default = lambda self: bool(self.result in (self.__rcode(SUCCESS),
-                                                   self.__rcode(FAILURE)))
-    has_error = lambda self: bool(self.is_failure() and not self.is_success())
+    __slots__ = ('extra', 'endpos')
 
     def __init__(self, name, result=None, extra=None, endpos=None):
         if name.endswith('_'):
             name = name[:-1]
-        self.name = name.upper()
+        self.name = name = name.upper()
+        self._codes = RESULT_CODES.get(name, NO_CODES)
 
         self.result = result
         self.endpos = None if endpos is None else int(endpos)
         self.extra = None if not endpos is None and extra == '' else extra
 
         self.has_dtmf = False
-                                            
-    def __cmp__(self, obj):
-        """
-        Allow to compare two commands.
-        """
-        compare_attributes = ('name', 'result', 'endpos')
-        return not reduce(
-            lambda acc, a: acc * (getattr(self, a) == getattr(obj, a)),
-                                  compare_attributes, 1)
 
-    def convert_dtmf(self):
-        """
-        Use to convert ASCII responce to the alpha symbol.
-        Be careful and check COMMAND.has_dtmf value.
-        """
-        self.has_dtmf = True
-        self.result = chr(int(self.result))
+
+class PlaylistResult(object):
+    """
+    Result of the L{FastAGIProtocol.playlist}.
+
+    @ivar digit: escape digit which interrupted the playback or C{None}.
+    @ivar index: index of the interrupted prompt or C{None}.
+    @ivar endpos: sample offset where the interrupted prompt stopped or
+        C{None}.
+    """
+    __slots__ = ('digit', 'index', 'endpos')
+
+    def __init__(self, digit=None, index=None, endpos=None):
+        self.digit = digit
+        self.index = index
+        self.endpos = endpos
+
+    def __eq__(self, obj):
+        try:
+            return (self.digit == obj.digit and self.index == obj.index
+                    and self.endpos == obj.endpos)
+        except AttributeError:
+            return False
+
+    def __ne__(self, obj):
+        return not self.__eq__(obj)
 
     def __repr__(self):
-        """
-        Command representation for the debug process.
-        """
-        return '%s:[%s(%s), %s(%s), %s(%s)]' % (self.name, self.result,
-                                                type(self.result),
-                                                self.extra, type(self.extra),
-                                                self.endpos, type(self.endpos))
+        return 'PLAYLIST:[%s, %s, %s]' % (self.digit, self.index, self.endpos)
 
 
-class FastAGIProtocol(basic.LineOnlyReceiver):
+class FastAGIProtocol(FramedReceiver):
     """
     Base protocol methods
 
@@ -163,9 +229,38 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
     @ivar readingEnv: whether the instance is still in initialising by
         reading the environment variables from the dial session
     @ivar pendingMessages: set of outstanding messages for which we expect replies
-    @ivar url: parsed url params from the agi_request variable.
-
-    @ivar env: environment variables for the current asterisk dial session:
+    @ivar pipelined: command lines queued by the running L{CommandPipeline}
+        or C{None}
+    @ivar url: parsed url params from the agi_request variable, shared by
+        the calls of the same request (see L{parseURL}), so read only.
+    @ivar commandTimeout: default deadline of the command reply in seconds,
+        C{None} waits forever.
+    @ivar sessionTimeout: deadline of the whole call session in seconds
+        since the call start, C{None} for the unlimited session.
+    @ivar wheel: L{TimerWheel} which runs the deadlines and waits, the
+        shared wheel of the reactor by default.
+    @ivar pendingWaits: dictionary of the L{wait} timers by their deferreds.
+    @ivar hungup: whether the C{HANGUP} notification is received.
+    @ivar handler: call handler of the session, set by the factory.
+    @ivar variables: per call cache of the channel variables, kept by
+        L{getVariables}, L{setVariable} and L{setVariables}.
+    @ivar variablesDelimiter: separator of the values in the
+        L{getVariables} reply.
+    @ivar prompts: L{PromptCatalog} which resolves the prompt files before
+        they are sent, C{None} sends them as is.
+    @ivar prefetcher: L{Prefetcher} which learns the variables read by the
+        route and prefetches them at the call start, C{None} to read every
+        variable by its own command.
+    @ivar commandsSent: number of the commands sent in the session.
+    @ivar commandObserver: callable called with the seconds every command
+        took, C{None} to not measure them.
+    @ivar route: L{twisted.fats.router.Route} of the call, set by the
+        factory with the router.
+    @ivar routeArgs: dictionary of the path segments captured by the
+        L{route}.
+
+    @ivar env: environment variables for the current asterisk dial session,
+        L{AGIEnvironment} which is decoded on the access:
         
         - agi_network = 'yes'
         - agi_request = 'agi://localhost'
@@ -188,6 +283,21 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
         - agi_accountcode = ''
     """
     delimiter = '\n'
+    variablesDelimiter = '|~|'
+    prompts = None
+    prefetcher = None
+    prefetchCall = None
+    commandsSent = 0
+    commandObserver = None
+    route = None
+    routeArgs = None
+    pipelined = None
+    commandTimeout = None
+    sessionTimeout = None
+    wheel = None
+    handler = None
+    hungup = False
+    _sessionTimer = None
 
     def connectionMade(self):
         """
@@ -200,7 +310,11 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
         self.env = {}
         self.url = None
         self.pendingMessages = []
+        self.pendingWaits = {}
+        self.variables = {}
         self.readingEnv = True
+        if self.wheel is None:
+            self.wheel = getWheel()
 
     def connectionLost(self, reason):
         """
@@ -208,9 +322,15 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
         """
         log.msg('Connection terminated to the FastAGI server %s' % id(self))
 
-        for df in self.pendingMessages:
-            df.errback(error.ConnectionDone('FastAGI connection terminated'))
-        del self.pendingMessages[:]
+        if self._sessionTimer is not None and self._sessionTimer.active():
+            self._sessionTimer.cancel()
+        self._failPending(
+            error.ConnectionDone('FastAGI connection terminated'))
+        if self.prefetcher is not None:
+            self.prefetcher.callEnded(self)
+        callEnded = getattr(self.factory, 'callEnded', None)
+        if callEnded is not None:
+            callEnded(self)
 
     def __getitem__(self, key):
         return self.env[key]
@@ -220,21 +340,106 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
 
     def _setURL(self):
         if self.env.get('agi_request', None):
-            self.url = URL(self.env['agi_request'])
+            self.url = parseURL(self.env['agi_request'])
 
     def _setEnv(self, env):
         self.readingEnv = False
         self.env = env
 
+    def dataReceived(self, data):
+        """
+        Read the environment block up to the blank line as one frame, then
+        handle the command replies line by line.
+        """
+        if self.readingEnv:
+            framer = self.framer
+            if framer is None:
+                framer = self.framer = Framer(self.delimiter)
+            if not len(framer) and data.startswith(self.delimiter):
+                # Empty environment block.
+                self._startCall(AGIEnvironment())
+                data = data[len(self.delimiter):]
+            else:
+                framer.delimiter = self.delimiter * 2
+        FramedReceiver.dataReceived(self, data)
+
+    def frameReceived(self, frame):
+        """
+        Start the call on the environment block, pass the replies to the
+        L{lineReceived}.
+        """
+        if self.readingEnv:
+            self.framer.delimiter = self.delimiter
+            self._startCall(AGIEnvironment(frame))
+        else:
+            self.lineReceived(frame)
+
+    def _startCall(self, env):
+        self._setEnv(env)
+        self._setURL()
+        self._startSessionTimer()
+        if self.prefetcher is not None:
+            self.prefetcher.callStarted(self)
+        self.factory.handleCall(self)
+
+    def _startSessionTimer(self):
+        if self.sessionTimeout is not None:
+            self._sessionTimer = self.wheel.callLater(self.sessionTimeout,
+                                                      self._sessionTimedOut)
+
+    def _sessionTimedOut(self):
+        """
+        Fail all the pending commands and drop the session.
+        """
+        log.msg('FastAGI session %s timed out' % id(self))
+        self._failPending(AGICommandTimeout('session'))
+        self.finish()
+
+    def _failPending(self, reason):
+        """
+        Fail the pending commands and waits.
+
+        Places of the commands are taken by the sinks for the replies
+        which are still on the way.
+        """
+        pending = self.pendingMessages[:]
+        self.pendingMessages[:] = [_replySink() for df in pending]
+        waits = self.pendingWaits.items()
+        self.pendingWaits.clear()
+        for df, timer in waits:
+            timer.cancel()
+        for df in pending:
+            df.errback(reason)
+        for df, timer in waits:
+            df.errback(reason)
+
+    def hangupReceived(self):
+        """
+        Handle the C{HANGUP} notification sent by the Asterisk 1.6+ when the
+        channel hangs up.
+
+        Pending commands and waits fail with L{AGIHangup}, the handler is
+        notified by its C{hangupReceived} method and the connection is
+        dropped.
+        """
+        log.msg('FastAGI channel hung up %s' % id(self))
+        self.hungup = True
+        self._failPending(AGIHangup('HANGUP'))
+        hook = getattr(self.handler, 'hangupReceived', None)
+        if hook is not None:
+            try:
+                hook()
+            except:
+                log.err()
+        self.finish()
+
     def lineReceived(self, line):
         """
         Handle Twisted's report of an incoming line from the manager.
         """
         if self.readingEnv:
             if not line.strip():
-                self.readingEnv = False
-                self._setURL()
-                self.factory.handleCall(self)
+                self._startCall(self.env)
             else:
                 try:
                     key, value = line.split(': ', 1)
@@ -242,8 +447,11 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
                 except ValueError, err:
                     log.err('Invalid variable line: %r' %line)
                 else:
-                    self.env[key.lower()] = value 
+                    key = internKey(key)
+                    self.env[key] = shareValue(key, value)
                     #log.msg('%s = %r' % (key, value), debug=True)
+        elif line.rstrip() == 'HANGUP':
+            self.hangupReceived()
         else:
             try:
                 df = self.pendingMessages.pop(0)
@@ -260,43 +468,113 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
                     except ValueError, err:
                         errCode = 500
                     finally:
-                        df.errback(AGICommandFailure(errCode, line))
+                        df.errback(AGICommandFailure((errCode, line)))
                    
-    def sendCommand(self, name, args=None):
+    def sendCommand(self, name, args=None, timeout=None):
         """
         Send the given command to the other side.
+
+        @param timeout: deadline of the reply in seconds, the
+            L{commandTimeout} by default. The command deferred fails with
+            L{AGICommandTimeout} when it passes, the late reply is dropped.
         """            
         command_string = args and name+' '+str(args) or name
+        if self.hungup:
+            return defer.fail(AGIHangup(command_string))
         log.msg('Send Command: %r'% command_string)
 
         df = defer.Deferred()
         self.pendingMessages.append(df)
-        self.sendLine(command_string)
-
+        self.commandsSent += 1
+        if self.pipelined is None:
+            self.sendLine(command_string)
+        else:
+            self.pipelined.append(command_string)
+
+        if timeout is None:
+            timeout = self.commandTimeout
+        if timeout is not None:
+            timer = self.wheel.callLater(timeout, self._commandTimedOut, df,
+                                         command_string)
+            df.addBoth(_cancelTimer, timer)
+        if self.commandObserver is not None:
+            df.addBoth(_observeCommand, self.commandObserver,
+                       self.wheel.clock, self.wheel.clock.seconds())
         return df.addCallback(self._returnCommandValues, name)
 
+    def _commandTimedOut(self, df, command_string):
+        """
+        Fail the command deferred, its place in the L{pendingMessages} is
+        taken by the sink for the late reply to keep the replies order.
+        """
+        for index, pending in enumerate(self.pendingMessages):
+            if pending is df:
+                self.pendingMessages[index] = _replySink()
+                break
+        log.msg('Command timed out: %r' % command_string)
+        df.errback(AGICommandTimeout(command_string))
+
+    def pipeline(self):
+        """
+        Start the commands pipeline.
+
+        Commands queued to the pipeline are written to the Asterisk in one
+        transport write, their replies are matched in order.
+
+        @return: L{CommandPipeline}
+        """
+        return CommandPipeline(self)
+
+    def _writePipelined(self, calls):
+        """
+        Run the protocol methods and send their commands in one write.
+
+        Nothing is sent when a method raises, the commands queued before it
+        are dropped from the L{pendingMessages} and failed with
+        L{AGIPipelineAborted}, so they don't take the replies of the later
+        commands.
+
+        @param calls: sequence of C{(method name, args, kwargs)}.
+        @return: list of the command deferreds.
+        """
+        self.pipelined = lines = []
+        queued = len(self.pendingMessages)
+        try:
+            dfs = [getattr(self, name)(*args, **kwargs)
+                   for name, args, kwargs in calls]
+        except:
+            dropped = self.pendingMessages[queued:]
+            del self.pendingMessages[queued:]
+            for df in dropped:
+                df.addErrback(lambda failure: None)
+                df.errback(AGIPipelineAborted(lines.pop(0)))
+            raise
+        finally:
+            self.pipelined = None
+        if lines:
+            lines.append('')
+            self.transport.write(self.delimiter.join(lines))
+        return dfs
+
     @staticmethod
     def _returnCommandValues(result, command_name):
         """
         Return command values.
         
         Check command result for failure and return base pattern for all kinds of
-        FastAGI command's result.
+        FastAGI command's result. The reply is split by the L{CODEC} according
+        to the command's result shape.
 
-        @return: L{Command} instance is container for the results.
+        @return: L{Command} instance is container for the results or
+            L{ResultCode} for the code only reply.
         @raise AGICommandFailure: Raised on failure error code.
         """
-        
-        r_pattern = re.compile(
-            r"""
-            (?P<result>[\S]?[0-9]?[\w]{0,})
-            (?:|[\b, (]{0,2}(?P<extra>.*?)[\b, )]{0,2})
-            (?:|endpos=(?P<endpos>\d+))$
-            """,
-            re.IGNORECASE|re.VERBOSE)
-        result = r_pattern.match(result).groups()
-
-        command = Command(command_name, *result)
+        result, extra, endpos = CODEC.decode(command_name, result)
+        if extra is None and endpos is None and \
+               CODEC.shape(command_name).codeOnly:
+            command = ResultCode(command_name, result)
+        else:
+            command = Command(command_name, result, extra, endpos)
         if command.has_error():
             raise AGICommandFailure(command)
         else:
@@ -316,13 +594,21 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
         """
         Wait for X seconds.
         
-        Just a wrapper around callLater, doesn't talk to server)
+        Just a timer on the L{wheel}, doesn't talk to server)
         
-        @return: Deferred which fires some time after duration seconds have passed
+        @return: Deferred which fires some time after duration seconds have
+            passed, fails with L{AGIHangup} when the channel hangs up first.
         """
+        if self.hungup:
+            return defer.fail(AGIHangup('wait'))
         df = defer.Deferred()
-        reactor.callLater(duration, df.callback, 0)
+        self.pendingWaits[df] = self.wheel.callLater(duration, self._waitDone,
+                                                     df)
         return df
+
+    def _waitDone(self, df):
+        del self.pendingWaits[df]
+        df.callback(0)
     
     def answer(self):
         """
@@ -377,6 +663,22 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
         elif not cmd.is_default():
             cmd.convert_dtmf()
         return cmd
+
+    def _resolvePrompt(self, filename, command_name):
+        """
+        Resolve the prompt for the channel language by the L{prompts}.
+
+        @return: file name to send.
+        @raise FailureOnOpen: for the prompt missing in the catalog.
+        """
+        if self.prompts is None:
+            return filename
+        resolved = self.prompts.resolve(filename,
+                                        self.env.get('agi_language'))
+        if resolved is None:
+            log.msg('Prompt is not found: %r' % filename)
+            raise FailureOnOpen(Command(command_name, '0', None, 0))
+        return resolved
         
     def controlStreamFile(self, filename, escapeDigits='', skipMS=0, ffChar='*',
                           rewChar='#', pauseChar=None):
@@ -407,6 +709,10 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
         @raise: L{AGICommandFailure}, L{FailureOnOpen}
             
 	"""
+        try:
+            filename = self._resolvePrompt(filename, 'CONTROL STREAM FILE')
+        except FailureOnOpen:
+            return defer.fail()
         args =  '%s %r %s %r %r' % (filename, escapeDigits, skipMS, ffChar,
                                     rewChar)
         if pauseChar:
@@ -536,6 +842,10 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
             Failure or not set: 200 result=0
         """
         # XXX check with asterisk API ... ${VAR1(VARIABLE)} !!!
+        if self.prefetcher is not None and not channel:
+            df = self.prefetcher.read(self, 'GET FULL VARIABLE', name)
+            if df is not None:
+                return df
         args = '%s %s' % (name, channel) if channel else name
         return self.sendCommand('GET FULL VARIABLE', args)
 
@@ -560,6 +870,10 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
 
         @raise: L{AGICommandFailure}, L{FailureOnOpen}
         """
+        try:
+            filename = self._resolvePrompt(filename, 'GET OPTION')
+        except FailureOnOpen:
+            return defer.fail()
         args = '%s %r' % (filename, escapeDigits)
         if timeout:
             timeout *= 1000
@@ -625,7 +939,51 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
             Success: 200 result=1 <value> 
             Failure or not set: 200 result=0
         """
+        if self.prefetcher is not None:
+            df = self.prefetcher.read(self, 'GET VARIABLE', name)
+            if df is not None:
+                return df
         return self.sendCommand('GET VARIABLE', name)
+
+    def getVariables(self, *names):
+        """
+        Read several variables in one C{GET FULL VARIABLE} round trip.
+
+        The names are joined into one expression by the
+        L{variablesDelimiter} and its value is split back. Values of the
+        plain variables are cached for the call, so the next read of them
+        costs no round trip. Dialplan functions, like C{GROUP_COUNT()},
+        are read every time.
+
+        @param names: variable names or function calls.
+        @return: deferred dictionary of the string values by the name, the
+            unset variable is C{''}.
+        @raise AGICommandFailure: on failure or when a value contains the
+            L{variablesDelimiter}.
+        """
+        variables = self.variables
+        values = {}
+        missing = []
+        for name in names:
+            if name in variables:
+                values[name] = variables[name]
+            elif name not in missing:
+                missing.append(name)
+        if not missing:
+            return defer.succeed(values)
+
+        delimiter = self.variablesDelimiter
+        def split(command):
+            parts = (command.extra or '').split(delimiter)
+            if len(parts) != len(missing):
+                raise AGICommandFailure(command)
+            for name, value in zip(missing, parts):
+                values[name] = value
+                self._cacheVariable(name, value)
+            return values
+        expression = delimiter.join(['${%s}' % name for name in missing])
+        return self.sendCommand('GET FULL VARIABLE', '"%s"' % expression
+                                ).addCallback(split)
     
     def hangup(self, channel=None):
         """
@@ -725,11 +1083,19 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
             args += ' BEEP'
         if silence:
             args += ' s=%s' % silence
-            
-        return self.sendCommand('RECORD FILE', args)
+
+        df = self.sendCommand('RECORD FILE', args)
+        if self.prompts is not None and not filename.startswith('/'):
+            # The relative recording is written to the sounds directory
+            # which the catalog indexed at the start.
+            def recorded(result):
+                self.prompts.addPath('%s.%s' % (filename, format))
+                return result
+            df.addCallback(recorded)
+        return df
 
 
-    def _sayWrapper(self, command, args, escapeDigits):
+    def _sayWrapper(self, command, args, escapeDigits, options=''):
         """Wrapper for the Astesrik say methods
         """
         def checkResult(cmd):
@@ -737,7 +1103,7 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
                 cmd.convert_dtmf()
             return cmd
         
-        args = '%s %r' % (args, escapeDigits or '')
+        args = '%s %r%s' % (args, escapeDigits or '', options)
         return self.sendCommand(command, args).addCallback(checkResult)
 
     def sayAlpha(self, string, escapeDigits=''):
@@ -829,17 +1195,17 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
                 Digit pressed: 200 result=<digit>
                     <digit> is the ascii code for the digit pressed.
         """ 
-        def formatQuery(args, format, timezone):
-            if format:
-                args += ' %s' % format
-            if timezone:
-                args += ' %s' % timezone
-            return args
-        
+        # The format and the timezone follow the escape digits.
+        options = ''
+        if format or timezone:
+            options = ' "%s"' % (format or "ABdY 'digits/at' IMp")
+        if timezone:
+            options += ' %s' % timezone
+
         return self._dateAsSeconds(time
-            ).addCallback(formatQuery, format, timezone
-            ).addCallback(lambda args:
-                          self._sayWrapper('SAY DATETIME', args, escapeDigits))
+            ).addCallback(lambda seconds:
+                          self._sayWrapper('SAY DATETIME', seconds,
+                                           escapeDigits, options))
 
     def sayDigits(self, number, escapeDigits=''):
         """
@@ -1029,7 +1395,54 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
         @return: deferred integer result code::
             200 result=1
         """
-        return self.sendCommand('SET VARIABLE', '%s %r' % (variablename, value))
+        def cache(result):
+            self._cacheVariable(variablename, str(value))
+            return result
+        if self.prefetcher is not None:
+            self.prefetcher.invalidate(self, (variablename,))
+        return self.sendCommand('SET VARIABLE', '%s %r' % (variablename, value)
+                                ).addCallback(cache)
+
+    def setVariables(self, variables):
+        """
+        Set several variables in one C{EXEC MSet} round trip.
+
+        @param variables: dictionary of the values by the name, the values
+            can't contain the C{|} and C{"}.
+        @return: deferred result of the C{MSet} application.
+        @raise ValueError: on the value which can't be passed to C{MSet}.
+        """
+        values = [(name, str(value))
+                  for name, value in sorted(variables.iteritems())]
+        for name, value in values:
+            if '|' in value or '"' in value:
+                raise ValueError('Value of %s can not be passed to MSet: %r'
+                                 % (name, value))
+        def cache(result):
+            for name, value in values:
+                self._cacheVariable(name, value)
+            return result
+        if self.prefetcher is not None:
+            self.prefetcher.invalidate(self, [name for name, _ in values])
+        return self.exec_('MSet', *['%s=%s' % item for item in values]
+                          ).addCallback(cache)
+
+    def invalidateVariables(self, *names):
+        """
+        Drop the cached values of the variables changed by the dialplan
+        applications, of all the variables when no names are given.
+        """
+        if not names:
+            self.variables.clear()
+        for name in names:
+            self.variables.pop(name, None)
+        if self.prefetcher is not None:
+            self.prefetcher.invalidate(self, names)
+
+    def _cacheVariable(self, name, value):
+        # Functions are evaluated by every read.
+        if '(' not in name:
+            self.variables[name] = value
 
     def streamFile(self, filename, escapeDigits='', offset=0):
         """
@@ -1055,11 +1468,58 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
 
         @raise: L{AGICommandFailure}, L{FailureOnOpen}
         """
+        try:
+            filename = self._resolvePrompt(filename, 'STREAM FILE')
+        except FailureOnOpen:
+            return defer.fail()
         args =  '%s %r' % (filename, escapeDigits)
         if offset:
             args += ' %s' % offset
         return self.sendCommand('STREAM FILE', args
             ).addCallback(self.__checkResultDTMF)
+
+    def playlist(self, filenames, escapeDigits=''):
+        """
+        Play the prompts one after another.
+
+        Without the escape digits the whole list is played by the single
+        C{EXEC Playback file1&file2&...}. The Playback can't be interrupted,
+        so with the escape digits (or the file name containing C{&}) every
+        prompt is sent as C{STREAM FILE} when the previous one has finished,
+        and the first pressed digit stops the list.
+
+        @param filenames: sequence of the file names without the extension.
+        @param escapeDigits: digits which stop the playback.
+        @return: deferred L{PlaylistResult}, with the pressed digit, the
+            index of the interrupted prompt and its offset.
+        @raise: L{AGICommandFailure}, L{FailureOnOpen}
+        """
+        filenames = list(filenames)
+        if not escapeDigits and not [name for name in filenames
+                                     if '&' in name]:
+            if not filenames:
+                return defer.succeed(PlaylistResult())
+            try:
+                filenames = [self._resolvePrompt(filename, 'EXEC')
+                             for filename in filenames]
+            except FailureOnOpen:
+                return defer.fail()
+            def played(command):
+                if command.result != '0':
+                    raise AGICommandFailure(command)
+                return PlaylistResult()
+            return self.exec_('Playback', '&'.join(filenames)
+                              ).addCallback(played)
+
+        def streamNext(command, index):
+            if command is not None and command.has_dtmf:
+                return PlaylistResult(command.result, index - 1,
+                                      command.endpos)
+            if index == len(filenames):
+                return PlaylistResult()
+            return self.streamFile(filenames[index], escapeDigits
+                                   ).addCallback(streamNext, index + 1)
+        return streamNext(None, 0)
     
     def tddMode(self, on=True):
         """
@@ -1129,6 +1589,88 @@ class FastAGIProtocol(basic.LineOnlyReceiver):
             ).addCallback(checkResult)
 
 
+def _replySink():
+    """
+    @return: deferred which swallows the late reply of the timed out command.
+    """
+    return defer.Deferred().addErrback(lambda failure: None)
+
+
+def _cancelTimer(result, timer):
+    if timer.active():
+        timer.cancel()
+    return result
+
+
+def _observeCommand(result, observer, clock, started):
+    observer(clock.seconds() - started)
+    return result
+
+
+class CommandPipeline(object):
+    """
+    Queue of the AGI commands sent in one write.
+
+    Asterisk handles the AGI lines strictly in order, so the whole queue is
+    written at once and the replies are matched in order through the
+    L{FastAGIProtocol.pendingMessages}. Any L{FastAGIProtocol} command method
+    may be queued::
+
+        agi.pipeline().answer().setVariable('LANG', 'en'
+            ).streamFile('welcome').run()
+
+    A failure short-circuits the commands queued after it: their results
+    are dropped with L{AGIPipelineAborted}. Asterisk has already received
+    them, so it still executes them. The pipeline is run once.
+
+    @ivar agi: L{FastAGIProtocol} instance.
+    @ivar calls: queued C{(method name, args, kwargs)}.
+    @ivar failure: first failure of the running pipeline.
+    """
+
+    def __init__(self, agi):
+        self.agi = agi
+        self.calls = []
+        self.failure = None
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(self.agi, name)):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self.calls)
+
+    def run(self):
+        """
+        Send the queued commands.
+
+        @return: deferred list of the commands results or the first failure.
+        """
+        dfs = self.agi._writePipelined(self.calls)
+        for df in dfs:
+            df.addCallbacks(self._checkResult, self._checkFailure)
+        return defer.DeferredList(dfs, fireOnOneErrback=True,
+                                  consumeErrors=True
+            ).addCallbacks(lambda results: [value for _, value in results],
+                           lambda failure: failure.value.subFailure)
+
+    def _checkResult(self, result):
+        if self.failure is not None:
+            raise AGIPipelineAborted(result)
+        return result
+
+    def _checkFailure(self, failure):
+        if self.failure is None:
+            self.failure = failure
+            return failure
+        raise AGIPipelineAborted(failure.value)
+
+
 class URL:
     """
     Special class for the agi request URL parsing.
@@ -1150,7 +1692,37 @@ class URL:
         self.path = path
         self.params = params
 
-__all__ = ['Command', 'FastAGIProtocol', 'COMMANDS', 'SUCCESS', 'FAILURE',
+
+_urls = None
+
+
+def getURLCache():
+    """
+    @return: L{LRUCache} of the parsed L{URL} by the agi_request.
+    """
+    global _urls
+    if _urls is None:
+        _urls = LRUCache(maxSize=1024)
+    return _urls
+
+
+def parseURL(request):
+    """
+    Parse the agi_request once per request string, the calls of the same
+    service share the L{URL}.
+
+    @return: L{URL} of the request.
+    """
+    urls = getURLCache()
+    url = urls.get(request)
+    if url is None:
+        url = URL(request)
+        urls.set(request, url)
+    return url
+
+__all__ = ['Command', 'ResultCode', 'PlaylistResult', 'FastAGIProtocol',
+           'CommandPipeline', 'URL', 'parseURL', 'getURLCache',
+           'COMMANDS', 'CODEC', 'RESULT_CODES', 'SUCCESS', 'FAILURE',
            'CHANNEL_AVAILABLE', 'CHANNEL_RESERVED', 'CHANNEL_OFF_HOOK',
            'CHANNEL_DIGITS_DIALED', 'CHANNEL_LINE_IS_RINGING',
            'CHANNEL_LINE_UP', 'CHANNEL_LINE_BUSY']
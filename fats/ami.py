@@ -12,10 +12,10 @@ $Id: ami.py 26 2008-06-23 09:05:55Z burus $
 """
 
 from twisted.internet import reactor, defer, error, protocol
-from twisted.protocols import basic
 from twisted.python import log
 from string import Template
-from twisted.fats.errors import LoginFailed
+from twisted.fats.errors import AMIFailure, LoginFailed
+from twisted.fats.framing import FramedReceiver
 
 COMMANDS = {
     'login': Template('action: login\r\n'
@@ -33,10 +33,20 @@ COMMANDS = {
                               'channel: $channel\r\n'
                               'file: $file\r\n'),
 
+    'agi': Template('action: AGI\r\n'
+                    'channel: $channel\r\n'
+                    'command: $command\r\n'
+                    'commandid: $commandid\r\n'),
+
+    'dbPut': Template('action: DBPut\r\n'
+                      'family: $family\r\n'
+                      'key: $key\r\n'
+                      'val: $val\r\n'),
+
     
     }
 
-class AMI(basic.LineOnlyReceiver):
+class AMI(FramedReceiver):
     """
     http://www.voip-info.org/wiki/view/Asterisk+manager+API
 
@@ -77,13 +87,44 @@ class AMI(basic.LineOnlyReceiver):
     SIPshowpeer      system,all       Show SIP peer (text format)
     Status           call,all         Lists channel status
     StopMonitor      call,all         Stop monitoring a channel
+
+    After the greeting the framer splits the stream into the whole
+    messages, so L{MAX_LENGTH} limits the message rather than its line.
+
+    Actions are written at once, without waiting for the response of the
+    previous one: the manager answers them in order. Events are passed to
+    the L{eventHandlers}, or queued for the L{getEvent} when there are no
+    handlers.
+
+    @ivar eventHandlers: callables called with the event dictionary.
     """
+    MAX_LENGTH = 1 << 20
+    greeted = False
     
     def __init__(self):
         self.__response_farm = []
         self._events = []
         self.__events_farm = []
         self.__have_event = False
+        self.eventHandlers = []
+
+    def frameReceived(self, frame):
+        """
+        Handle the greeting line, then the whole blank line terminated
+        messages split by the framer in one scan.
+        """
+        if not self.greeted:
+            if frame.startswith('Asterisk Call Manager'):
+                self.greeted = True
+                self.framer.delimiter = self.delimiter * 2
+            return self.lineReceived(frame)
+
+        if not frame:
+            return
+        lineReceived = self.lineReceived
+        for line in frame.split(self.delimiter):
+            lineReceived(line)
+        lineReceived('')
             
     def lineReceived(self, line):
         def composeResponse(response, key, value, exception, condition):
@@ -98,8 +139,9 @@ class AMI(basic.LineOnlyReceiver):
             return event
         
         if line.startswith('Asterisk Call Manager'):
-            _, cmd, _ = self.__response_farm[0]
-            self.sendLine(cmd[0])
+            self.greeted = True
+            for _, cmd, _ in self.__response_farm:
+                self.sendLine(cmd[0])
                 
         elif not line.strip():
             if not self.__have_event:
@@ -109,16 +151,15 @@ class AMI(basic.LineOnlyReceiver):
                 deferredResponse.addErrback(
                     lambda value: response.errback(value))
                 deferredResponse.callback(_AsteriskResponse())
-            
-                if self.__response_farm:
-                    _, cmd, _ = self.__response_farm[0]
-                    self.sendLine(cmd[0])
             else:
                 event, deferredEvent = self.__events_farm.pop(-1)
                 deferredEvent.addCallback(lambda value: event.callback(value))
                 deferredEvent.addErrback(lambda value: event.errback(value))
+                if self.eventHandlers:
+                    event.addCallback(self._dispatchEvent)
+                else:
+                    self._events.append(event)
                 deferredEvent.callback(_AsteriskEvent())
-                self._events.append(event)
         else:
             type_, value = line.split(': ')
             if type_ == 'Response':
@@ -145,10 +186,28 @@ class AMI(basic.LineOnlyReceiver):
         # TODO: append a substance
         self.__response_farm.append((response, (command, exception, condition),
                            defer.Deferred()))
+        if self.greeted:
+            self.sendLine(command)
         
         # add callback for the values representation
         return response
 
+    def _dispatchEvent(self, event):
+        for handler in self.eventHandlers[:]:
+            try:
+                handler(event)
+            except:
+                log.err()
+
+    def addEventHandler(self, handler):
+        """
+        Pass the events to the handler instead of the L{getEvent} queue.
+        """
+        self.eventHandlers.append(handler)
+
+    def removeEventHandler(self, handler):
+        self.eventHandlers.remove(handler)
+
     def getEvent(self):
         """
         """
@@ -212,6 +271,29 @@ class AMI(basic.LineOnlyReceiver):
         @return: deferred result L{_AsteriskResponse}
         """
 
+    def agi(self, channel, command, commandID):
+        """
+        Queue the AGI command to the channel in the AsyncAGI mode, its
+        result comes by the C{AsyncAGI} event with the C{Exec} subevent and
+        the same C{CommandID}.
+
+        @return: deferred result L{_AsteriskResponse}
+        """
+        command = str(COMMANDS['agi'].substitute(
+            channel=channel, command=command, commandid=commandID))
+        return self._sendCommand(command)
+
+    def dbPut(self, family, key, val):
+        """
+        Add or update the AstDB entry.
+
+        @return: deferred result L{_AsteriskResponse}, L{AMIFailure} when
+            Asterisk refuses the put.
+        """
+        command = str(COMMANDS['dbPut'].substitute(
+            family=family, key=key, val=val))
+        return self._sendCommand(command, exception=AMIFailure)
+
 class _AsteriskResponse(dict):
     pass
 
@@ -0,0 +1,284 @@
+# -*- test-case-name: twisted.fats.test.test_astdb -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""AstDB cache shared by the call sessions
+
+API Stability: unstable
+
+Every C{DATABASE GET} costs the AGI round trip, while the per extension
+flags kept in the AstDB are read by nearly every call. The L{AstDBCache}
+keeps the values for all the sessions of the process and writes the puts
+behind, coalesced into one pipelined write::
+
+    class Forward(CallHandler):
+        def startCall(self):
+            return getAstDBCache().get(self.agi, 'forward',
+                                       self.agi['agi_extension']
+                                       ).addCallback(self.route)
+
+The puts are written through the AMI connection given to the cache, by
+the C{DBPut} actions, so they don't depend on any call. Without it every
+put is written through the session which made it, and the puts of the
+session which is hung up before the write are lost.
+
+The cache sees only the changes made through it. Changes made by the
+dialplan or by the other processes are visible after the L{AstDBCache.ttl}
+or after the L{AstDBCache.invalidate}, which may be driven by the AMI
+C{UserEvent} (see L{AstDBCache.eventReceived}).
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from collections import OrderedDict
+
+from twisted.internet import defer
+from twisted.python import log
+
+from twisted.fats.cache import LRUCache
+from twisted.fats.errors import AGICommandFailure
+from twisted.fats.timer import getWheel
+
+_MISSING = object()
+
+
+def _isAlive(agi):
+    """
+    @return: whether the session can still send the commands.
+    """
+    transport = agi.transport
+    return (transport is not None and not transport.disconnecting
+            and not agi.hungup)
+
+
+class AstDBCache(object):
+    """
+    AstDB values cached for all the sessions of the process.
+
+    Values are cached by C{(family, key)}, the missing key as C{None}. Puts
+    update the cache at once and are written after the L{flushDelay}, by
+    the L{ami} or through the session of the put; the later put of the same
+    key replaces the earlier one which is not written yet.
+
+    @ivar cache: L{LRUCache} of the values.
+    @ivar ami: L{twisted.fats.ami.AMI} protocol which writes the puts,
+        C{None} to write them through the sessions.
+    @ivar flushDelay: seconds the puts are collected before the write.
+    @ivar dirty: C{OrderedDict} of the values waiting for the write by
+        C{(family, key)}.
+    @ivar reads: number of the C{DATABASE GET} sent.
+    @ivar puts: number of the L{put} calls.
+    @ivar writes: number of the puts sent.
+    @ivar failedWrites: number of the puts written again after the failure.
+    @ivar lostWrites: number of the puts dropped since their session hung
+        up before the write.
+    """
+
+    def __init__(self, maxSize=10000, ttl=60, flushDelay=0.05, ami=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.cache = LRUCache(maxSize, ttl, reactor)
+        self.ami = ami
+        self.flushDelay = flushDelay
+        self.dirty = OrderedDict()
+        self.reads = self.puts = self.writes = self.failedWrites = 0
+        self.lostWrites = 0
+        self._writers = {}
+        self._flushTimer = None
+        self._shutdownTrigger = None
+
+    def _scheduleFlush(self):
+        if self._flushTimer is None or not self._flushTimer.active():
+            self._flushTimer = getWheel(self.reactor).callLater(
+                self.flushDelay, self.flush)
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+                'before', 'shutdown', self._shutdown)
+
+    def _shutdown(self):
+        self._shutdownTrigger = None
+        return self.flush()
+
+    def get(self, agi, family, key):
+        """
+        @return: deferred value of the key, C{None} when it is not set.
+        """
+        value = self.cache.get((family, key), _MISSING)
+        if value is _MISSING:
+            # Evicted or expired before the write.
+            value = self.dirty.get((family, key), _MISSING)
+            if value is not _MISSING:
+                self.cache.set((family, key), value)
+        if value is not _MISSING:
+            return defer.succeed(value)
+
+        self.reads += 1
+        def found(command):
+            self.cache.set((family, key), command.extra)
+            return command.extra
+        def missing(failure):
+            failure.trap(AGICommandFailure)
+            command = failure.value.result
+            if getattr(command, 'result', None) != '0':
+                return failure
+            self.cache.set((family, key), None)
+            return None
+        return agi.databaseGet(family, key).addCallbacks(found, missing)
+
+    def put(self, agi, family, key, value):
+        """
+        Cache the value and write it behind.
+        """
+        value = str(value)
+        self.puts += 1
+        self.cache.set((family, key), value)
+        self.dirty.pop((family, key), None)
+        self.dirty[family, key] = value
+        self._writers[family, key] = agi
+        self._scheduleFlush()
+
+    def delete(self, agi, family, key):
+        """
+        Delete the key through the session at once.
+
+        @return: deferred result of the C{DATABASE DEL}.
+        """
+        self.dirty.pop((family, key), None)
+        self._writers.pop((family, key), None)
+        self.cache.set((family, key), None)
+        return agi.databaseDel(family, key)
+
+    def deleteTree(self, agi, family, keyTree=None):
+        """
+        Delete the family, or the keys of the family starting with the
+        key tree, through the session at once.
+
+        @return: deferred result of the C{DATABASE DELTREE}.
+        """
+        self.invalidate(family, keyTree=keyTree)
+        return agi.databaseDeltree(family, keyTree)
+
+    def invalidate(self, family, key=None, keyTree=None):
+        """
+        Drop the cached values changed behind the cache. The puts waiting
+        for the write are dropped as well.
+
+        @param key: the only key to drop, the whole family by default.
+        @param keyTree: drop the keys starting with it.
+        """
+        if key is not None:
+            match = lambda item: item == (family, key)
+        elif keyTree is not None:
+            match = lambda item: (item[0] == family
+                                  and item[1].startswith(keyTree))
+        else:
+            match = lambda item: item[0] == family
+        for item in [item for item in self.dirty if match(item)]:
+            del self.dirty[item]
+            self._writers.pop(item, None)
+        self.cache.removeMatching(match)
+
+    def eventReceived(self, event):
+        """
+        Invalidate the cache by the AMI event, sent by the dialplan with
+        C{UserEvent(AstDBChanged|Family: <family>|Key: <key>)}.
+
+        @param event: dictionary of the event headers with the lower case
+            names, as delivered by the L{twisted.fats.ami.AMI}.
+        """
+        if event.get('userevent') == 'AstDBChanged' and 'family' in event:
+            self.invalidate(event['family'], event.get('key'))
+        return event
+
+    def flush(self):
+        """
+        Write the waiting puts, by the L{ami} or in one pipelined write per
+        session.
+
+        @return: deferred fired when the puts are written, the failed ones
+            wait for the next flush.
+        """
+        if self._flushTimer is not None and self._flushTimer.active():
+            self._flushTimer.cancel()
+        self._flushTimer = None
+        if not self.dirty:
+            return defer.succeed(None)
+
+        batch, self.dirty = self.dirty, OrderedDict()
+        writers, self._writers = self._writers, {}
+        dfs = []
+        if self.ami is not None:
+            for (family, key), value in batch.iteritems():
+                dfs.append(self._written(
+                    self.ami.dbPut(family, key, value), family, key, value,
+                    None))
+        else:
+            sessions = OrderedDict()
+            for item, value in batch.iteritems():
+                sessions.setdefault(writers[item], []).append(item + (value,))
+            for agi, puts in sessions.iteritems():
+                if not _isAlive(agi):
+                    log.msg('AstDB puts of the hung up session are lost: %d'
+                            % len(puts))
+                    self.lostWrites += len(puts)
+                    continue
+                try:
+                    results = agi._writePipelined([('databasePut', put, {})
+                                                   for put in puts])
+                except:
+                    results = [defer.fail() for put in puts]
+                for df, put in zip(results, puts):
+                    dfs.append(self._written(df, *put + (agi,)))
+        self.writes += len(dfs)
+        return defer.DeferredList(dfs).addCallback(lambda _: None)
+
+    def _written(self, df, family, key, value, agi):
+        """
+        Put the failed write back unless the key is put again.
+        """
+        def failed(failure):
+            log.msg('AstDB put of %s/%s failed: %s' %
+                    (family, key, failure.getErrorMessage()))
+            self.failedWrites += 1
+            if (family, key) not in self.dirty:
+                self.dirty[family, key] = value
+                self._writers[family, key] = agi
+                self._scheduleFlush()
+        return df.addCallbacks(lambda _: None, failed)
+
+    def stats(self):
+        """
+        @return: dictionary of the cache metrics, C{roundTripsSaved} counts
+            the reads served by the cache and the coalesced puts.
+        """
+        stats = self.cache.stats()
+        stats.update({'reads': self.reads,
+                      'puts': self.puts,
+                      'writes': self.writes,
+                      'failedWrites': self.failedWrites,
+                      'lostWrites': self.lostWrites,
+                      'dirty': len(self.dirty),
+                      'roundTripsSaved': (self.cache.hits + self.cache.misses
+                                          - self.reads + self.puts
+                                          - self.writes - len(self.dirty))})
+        return stats
+
+
+_cache = None
+
+
+def getAstDBCache():
+    """
+    @return: L{AstDBCache} shared by the call sessions.
+    """
+    global _cache
+    if _cache is None:
+        _cache = AstDBCache()
+    return _cache
+
+
+__all__ = ['AstDBCache', 'getAstDBCache']
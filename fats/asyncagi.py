@@ -0,0 +1,186 @@
+# -*- test-case-name: twisted.fats.test.test_asyncagi -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""AsyncAGI sessions over the AMI connection
+
+API Stability: unstable
+
+Every FastAGI call costs the Asterisk the new TCP connection and the
+environment exchange. With C{AGI(agi:async)} in the dialplan (Asterisk
+1.6+) the call session is driven through the manager connection instead:
+the environment comes by the C{AsyncAGI} event with the C{Start}
+subevent, the commands are sent by the C{AGI} actions and their results
+come back by the C{Exec} subevents. The L{AsyncAGIManager} multiplexes any
+number of the sessions over one L{twisted.fats.ami.AMI} connection and
+presents each of them to the unchanged call handler as the
+L{FastAGIProtocol}::
+
+    def connected(ami):
+        AsyncAGIManager(ami, FastAGIFactory())
+
+    connectAMI('fats', 'secret').addCallback(connected)
+
+The session ends with the C{ASYNCAGI BREAK}, which returns the channel to
+the dialplan.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import urllib
+
+from twisted.internet import error
+from twisted.python import log, failure
+
+from twisted.fats.agi import FastAGIProtocol
+from twisted.fats.environment import AGIEnvironment
+
+
+class AsyncAGITransport(object):
+    """
+    Transport of the session which sends the command lines by the AMI
+    C{AGI} actions.
+
+    @ivar manager: L{AsyncAGIManager} of the session.
+    @ivar channel: name of the channel.
+    @ivar commands: command ids waiting for the result, in order.
+    """
+    disconnecting = False
+
+    def __init__(self, manager, channel):
+        self.manager = manager
+        self.channel = channel
+        self.commands = []
+
+    def write(self, data):
+        for line in data.split('\n'):
+            if line:
+                self.commands.append(self.manager.sendCommand(self.channel,
+                                                              line))
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def loseConnection(self):
+        """
+        Return the channel to the dialplan.
+        """
+        if not self.disconnecting:
+            self.disconnecting = True
+            self.manager.sendCommand(self.channel, 'ASYNCAGI BREAK')
+
+    def getPeer(self):
+        return ('AsyncAGI', self.channel)
+
+    getHost = getPeer
+
+
+class AsyncAGIProtocol(FastAGIProtocol):
+    """
+    Call session of the AsyncAGI channel.
+    """
+
+    def execReceived(self, commandID, result):
+        """
+        Pass the command result to the session.
+        """
+        commands = self.transport.commands
+        if commands and commands[0] == commandID:
+            commands.pop(0)
+        elif commandID in commands:
+            log.msg('AsyncAGI results out of order: %s' % commandID)
+            commands.remove(commandID)
+        else:
+            # ASYNCAGI BREAK and the commands of the other applications.
+            return
+        for line in result.split('\n'):
+            if line:
+                self.lineReceived(line)
+
+
+class AsyncAGIManager(object):
+    """
+    Sessions of the AsyncAGI channels driven through the AMI connection.
+
+    @ivar ami: L{twisted.fats.ami.AMI} connection.
+    @ivar factory: factory of the call handlers, like the
+        L{FastAGIFactory}.
+    @ivar protocol: class of the sessions.
+    @ivar sessions: dictionary of the L{AsyncAGIProtocol} by the channel.
+    @ivar started: number of the started sessions.
+    """
+    protocol = AsyncAGIProtocol
+
+    def __init__(self, ami, factory):
+        self.ami = ami
+        self.factory = factory
+        self.sessions = {}
+        self.started = 0
+        self._lastID = 0
+        ami.addEventHandler(self.eventReceived)
+
+    def stop(self):
+        """
+        Stop receiving the events, the sessions are dropped.
+        """
+        self.ami.removeEventHandler(self.eventReceived)
+        for channel in self.sessions.keys():
+            self._end(channel)
+
+    def sendCommand(self, channel, command):
+        """
+        @return: command id of the C{AGI} action.
+        """
+        self._lastID += 1
+        commandID = '%x' % self._lastID
+        self.ami.agi(channel, command, commandID).addErrback(
+            self._actionFailed, channel, command)
+        return commandID
+
+    def _actionFailed(self, reason, channel, command):
+        log.msg('AsyncAGI command %r to %s failed: %s' %
+                (command, channel, reason.getErrorMessage()))
+        self._end(channel)
+
+    def eventReceived(self, event):
+        """
+        Dispatch the C{AsyncAGI} events.
+        """
+        if event.get('event') != 'AsyncAGI':
+            return
+        subevent = event.get('subevent')
+        channel = event.get('channel')
+        if subevent == 'Start':
+            self._start(channel, urllib.unquote(event.get('env', '')))
+        elif subevent == 'Exec':
+            session = self.sessions.get(channel)
+            if session is not None:
+                session.execReceived(event.get('commandid'),
+                                     urllib.unquote(event.get('result', '')))
+        elif subevent == 'End':
+            self._end(channel)
+
+    def _start(self, channel, env):
+        if channel in self.sessions:
+            self._end(channel)
+        session = self.protocol()
+        session.factory = self.factory
+        session.makeConnection(AsyncAGITransport(self, channel))
+        self.sessions[channel] = session
+        self.started += 1
+        session._startCall(AGIEnvironment(env.strip('\n')))
+
+    def _end(self, channel):
+        session = self.sessions.pop(channel, None)
+        if session is not None:
+            session.transport.disconnecting = True
+            session.connectionLost(failure.Failure(
+                error.ConnectionDone('AsyncAGI session ended')))
+
+    def stats(self):
+        return {'sessions': len(self.sessions), 'started': self.started}
+
+
+__all__ = ['AsyncAGIManager', 'AsyncAGIProtocol', 'AsyncAGITransport']
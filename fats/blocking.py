@@ -0,0 +1,327 @@
+# -*- test-case-name: twisted.fats.test.test_blocking -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Blocking call handlers
+
+API Stability: unstable
+
+Call scripts written in the synchronous style (ORM queries, blocking client
+libraries) run in the bounded worker thread pool instead of the reactor
+thread. The script sees the L{BlockingAGI} proxy as its C{agi}: every
+protocol method is called in the reactor thread and the worker blocks until
+the reply::
+
+    class Menu(ThreadedCallHandler):
+        timeout = 60
+
+        def startCall(self):
+            self.agi.answer()
+            account = Account.objects.get(number=self.agi['agi_callerid'])
+            self.agi.sayNumber(account.balance)
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import time, threading, Queue
+
+from zope.interface import implements
+from twisted.internet import defer, error
+from twisted.python import failure, threadpool
+
+from twisted.fats.errors import AGICommandTimeout, CallPoolFull
+from twisted.fats.service import CallHandler, IBlockingCallHandler
+from twisted.fats.timer import getWheel
+
+_TIMEOUT = object()
+
+
+class BlockingAGI(object):
+    """
+    Synchronous proxy of the L{FastAGIProtocol} for the worker thread.
+
+    Methods of the protocol are called in the reactor thread, the proxy
+    waits for the deferred and returns its result or raises its exception.
+    Other attributes (C{env}, C{url}) are read as is.
+
+    @ivar agi: proxied protocol.
+    @ivar deadline: time when the commands start to fail with
+        L{AGICommandTimeout}, C{None} for the unlimited call.
+    @ivar pool: L{CallPool} running the call, its shutdown fails the
+        commands waiting for the reply.
+    """
+
+    def __init__(self, agi, timeout=None, reactor=None, pool=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.agi = agi
+        self.reactor = reactor
+        self.pool = pool
+        self.deadline = timeout and time.time() + timeout or None
+
+    def __getitem__(self, key):
+        return self.agi.env[key]
+
+    def __getattr__(self, name):
+        attribute = getattr(self.agi, name)
+        if not callable(attribute):
+            return attribute
+        def call(*args, **kwargs):
+            return self._call(name, attribute, args, kwargs)
+        call.__name__ = name
+        return call
+
+    def _call(self, name, method, args, kwargs):
+        """
+        Run the protocol method in the reactor thread and wait for its
+        result.
+        """
+        timeout = None
+        if self.deadline is not None:
+            timeout = self.deadline - time.time()
+            if timeout <= 0:
+                raise AGICommandTimeout(name)
+
+        results = Queue.Queue()
+        if self.pool is not None and not self.pool._addWaiting(results):
+            raise defer.CancelledError('call pool stopped')
+        def run():
+            transport = self.agi.transport
+            if transport is None or transport.disconnecting:
+                results.put(failure.Failure(
+                    error.ConnectionDone('FastAGI connection terminated')))
+                return
+            timer = None
+            if timeout is not None:
+                timer = getWheel(self.reactor).callLater(timeout, results.put,
+                                                         _TIMEOUT)
+            def done(result):
+                if timer is not None and timer.active():
+                    timer.cancel()
+                results.put(result)
+            defer.maybeDeferred(method, *args, **kwargs).addBoth(done)
+        self.reactor.callFromThread(run)
+
+        # Queue.get without the timeout blocks on the lock, with the timeout
+        # it polls, so the deadline is put to the queue by the timer.
+        try:
+            result = results.get()
+        finally:
+            if self.pool is not None:
+                self.pool._removeWaiting(results)
+        if result is _TIMEOUT:
+            raise AGICommandTimeout(name)
+        if isinstance(result, failure.Failure):
+            result.raiseException()
+        return result
+
+
+class CallPool(object):
+    """
+    Bounded worker thread pool for the blocking call handlers.
+
+    When all the workers are busy and L{maxQueue} calls are already waiting
+    for them the new calls are rejected with L{CallPoolFull}, so an
+    overloaded server releases the channels to the dialplan instead of
+    piling them up.
+
+    @ivar threadpool: L{threadpool.ThreadPool} of the workers, started on
+        the first call and stopped on the reactor shutdown.
+    @ivar maxQueue: maximum number of the calls waiting for the worker.
+    @ivar queued: number of the calls waiting for the worker.
+    @ivar running: number of the calls running in the workers.
+    @ivar completed: number of the finished calls.
+    @ivar failed: number of the calls which raised the exception.
+    @ivar rejected: number of the calls rejected by the full queue.
+    @ivar timedOut: number of the calls failed by the timeout.
+    @ivar totalWait: seconds spent by the calls in the queue.
+    @ivar maxWait: longest queue wait in seconds.
+    """
+
+    def __init__(self, minThreads=0, maxThreads=20, maxQueue=100,
+                 name='fats-calls', reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.threadpool = threadpool.ThreadPool(minThreads, maxThreads, name)
+        self.maxQueue = maxQueue
+        self.queued = self.running = 0
+        self.completed = self.failed = self.rejected = self.timedOut = 0
+        self.totalWait = self.maxWait = 0.0
+        self._lock = threading.Lock()
+        self._waiting = set()
+        self._stopping = False
+        self._shutdownTrigger = None
+
+    def start(self):
+        if not self.threadpool.started:
+            self._stopping = False
+            self.threadpool.start()
+            self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._shutdown)
+
+    def _shutdown(self):
+        self._shutdownTrigger = None
+        self.stop()
+
+    def stop(self):
+        """
+        Stop the workers.
+
+        The reactor does not answer the commands of the blocked workers
+        any more, so their L{BlockingAGI} calls fail with
+        L{defer.CancelledError} before the workers are joined.
+        """
+        if self._shutdownTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        self._lock.acquire()
+        self._stopping = True
+        waiting, self._waiting = self._waiting, set()
+        self._lock.release()
+        for results in waiting:
+            results.put(failure.Failure(
+                defer.CancelledError('call pool stopped')))
+        self.threadpool.stop()
+
+    def _addWaiting(self, results):
+        """
+        Register the reply queue of the L{BlockingAGI} command.
+
+        @return: C{False} when the pool is stopping.
+        """
+        self._lock.acquire()
+        try:
+            if self._stopping:
+                return False
+            self._waiting.add(results)
+            return True
+        finally:
+            self._lock.release()
+
+    def _removeWaiting(self, results):
+        self._lock.acquire()
+        self._waiting.discard(results)
+        self._lock.release()
+
+    def stats(self):
+        """
+        @return: dictionary of the pool metrics.
+        """
+        self._lock.acquire()
+        try:
+            started = self.running + self.completed + self.failed
+            return {'workers': len(self.threadpool.threads),
+                    'maxWorkers': self.threadpool.max,
+                    'queued': self.queued,
+                    'running': self.running,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'rejected': self.rejected,
+                    'timedOut': self.timedOut,
+                    'maxWait': self.maxWait,
+                    'averageWait': started and self.totalWait / started}
+        finally:
+            self._lock.release()
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run the function in the worker thread.
+
+        @param timeout: keyword only, seconds since now after which the
+            result deferred fails with L{AGICommandTimeout}. The thread is
+            not interrupted, its late result is dropped.
+        @return: deferred result of the function.
+        """
+        timeout = kwargs.pop('timeout', None)
+        self._lock.acquire()
+        try:
+            if self.queued + self.running >= \
+                   self.maxQueue + self.threadpool.max:
+                self.rejected += 1
+                return defer.fail(CallPoolFull(self.queued))
+            self.queued += 1
+        finally:
+            self._lock.release()
+        self.start()
+
+        df = defer.Deferred()
+        timer = None
+        if timeout is not None:
+            def timedOut():
+                self._lock.acquire()
+                self.timedOut += 1
+                self._lock.release()
+                df.errback(AGICommandTimeout('call'))
+            timer = getWheel(self.reactor).callLater(timeout, timedOut)
+
+        def finished(success, result):
+            if timer is not None:
+                if not timer.active():
+                    return
+                timer.cancel()
+            if success:
+                df.callback(result)
+            else:
+                df.errback(result)
+
+        def onResult(success, result):
+            self._lock.acquire()
+            self.running -= 1
+            if success:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._lock.release()
+            self.reactor.callFromThread(finished, success, result)
+
+        self.threadpool.callInThreadWithCallback(onResult, self._started,
+                                                 time.time(), func, args,
+                                                 kwargs)
+        return df
+
+    def _started(self, queuedAt, func, args, kwargs):
+        wait = time.time() - queuedAt
+        self._lock.acquire()
+        self.queued -= 1
+        self.running += 1
+        self.totalWait += wait
+        self.maxWait = max(self.maxWait, wait)
+        self._lock.release()
+        return func(*args, **kwargs)
+
+
+_pool = None
+
+
+def getPool():
+    """
+    @return: L{CallPool} shared by the handlers without their own pool.
+    """
+    global _pool
+    if _pool is None:
+        _pool = CallPool()
+    return _pool
+
+
+class ThreadedCallHandler(CallHandler):
+    """
+    Call handler with the blocking C{startCall}.
+
+    The factory runs C{startCall} in the L{pool} with the L{BlockingAGI}
+    proxy as the C{agi}, the return value of C{startCall} is the result of
+    the call.
+
+    @ivar pool: L{CallPool} of the handler, the shared one by default.
+    @ivar timeout: seconds the whole call may take, including the wait for
+        the free worker; C{None} for the unlimited call.
+    """
+    implements(IBlockingCallHandler)
+
+    pool = None
+    timeout = None
+
+
+__all__ = ['BlockingAGI', 'CallPool', 'ThreadedCallHandler', 'getPool']
@@ -0,0 +1,117 @@
+# -*- test-case-name: twisted.fats.test.test_cache -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Process wide caches
+
+API Stability: unstable
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with the optional expiration of the entries.
+
+    @ivar maxSize: number of the entries after which the least recently
+        used one is evicted.
+    @ivar ttl: default seconds the entry lives, C{None} for the entries
+        which live until evicted.
+    @ivar clock: provider of the C{seconds} method, the reactor by default.
+    @ivar entries: C{OrderedDict} of the C{(value, expiration time)} by the
+        key, the most recently used is the last.
+    @ivar hits: number of the found entries.
+    @ivar misses: number of the missing or expired entries.
+    @ivar expired: number of the entries dropped by the expiration.
+    @ivar evicted: number of the entries dropped by the size limit.
+    """
+
+    def __init__(self, maxSize=1024, ttl=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = self.misses = self.expired = self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """
+        @return: the cached value, or the default for the missing or
+            expired key.
+        """
+        entries = self.entries
+        try:
+            value, expires = entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires <= self.clock.seconds():
+            self.expired += 1
+            self.misses += 1
+            return default
+        entries[key] = value, expires
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache the value.
+
+        @param ttl: seconds the entry lives, the L{ttl} by default.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            expires = self.clock.seconds() + ttl
+        entries = self.entries
+        entries.pop(key, None)
+        entries[key] = value, expires
+        while len(entries) > self.maxSize:
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def remove(self, key):
+        """
+        Drop the entry, if any.
+        """
+        self.entries.pop(key, None)
+
+    def removeMatching(self, predicate):
+        """
+        Drop the entries whose key matches the predicate.
+
+        @return: number of the dropped entries.
+        """
+        keys = [key for key in self.entries if predicate(key)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """
+        @return: dictionary of the cache metrics.
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self.entries),
+                'maxSize': self.maxSize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'hitRate': lookups and float(self.hits) / lookups}
+
+
+__all__ = ['LRUCache']
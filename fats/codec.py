@@ -0,0 +1,110 @@
+# -*- test-case-name: twisted.fats.test.test_codec -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""FastAGI response codec
+
+API Stability: unstable
+
+Decode the C{200 result=...} replies of the FastAGI commands without regular
+expressions. The codec is generated once from a commands table (see
+L{twisted.fats.agi.COMMANDS}) and knows the result shape of every command:
+the result code, the extra value which may be parenthesised, the C{endpos=}
+offset and the C{(timeout)} like flags.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+ENDPOS = ' endpos='
+
+
+class ResultShape(object):
+    """
+    Result shape of the FastAGI command built from its reply templates.
+
+    @ivar name: command name.
+    @ivar success: success result code, like C{'0'}.
+    @ivar failure: failure result code, like C{'-1'}.
+    @ivar hasExtra: whether the reply may carry a value after the result.
+    @ivar hasEndpos: whether the reply may carry the C{endpos=} offset.
+    @ivar codeOnly: whether the reply is just a result code.
+    """
+    __slots__ = ('name', 'success', 'failure', 'hasExtra', 'hasEndpos',
+                 'codeOnly')
+
+    def __init__(self, name, success, failure):
+        self.name = name
+        self.success = success.split()[0]
+        self.failure = failure.split()[0]
+        self.hasEndpos = 'endpos=' in success or 'endpos=' in failure
+
+        tails = [t for t in success.split()[1:] + failure.split()[1:]
+                 if not t.startswith('endpos=')]
+        self.hasExtra = bool(tails)
+        self.codeOnly = not (self.hasExtra or self.hasEndpos)
+
+    def __repr__(self):
+        return '<ResultShape %s: %s/%s>' % (self.name, self.success,
+                                            self.failure)
+
+
+class ResponseCodec(object):
+    """
+    Decoder of the FastAGI command replies.
+
+    @ivar shapes: dictionary of the L{ResultShape} by the command name.
+    @ivar default: shape used for the commands missing in the table.
+    """
+
+    def __init__(self, commands):
+        """
+        @param commands: dictionary of the C{(success, failure)} reply
+            templates by the command name.
+        """
+        self.shapes = dict((name, ResultShape(name, *templates))
+                           for name, templates in commands.iteritems())
+        self.default = ResultShape('', '%s %s endpos=%s', '%s')
+
+    def shape(self, name):
+        """
+        @return: L{ResultShape} for the command.
+        """
+        return self.shapes.get(name, self.default)
+
+    def decode(self, name, line):
+        """
+        Split the reply value (the part after C{200 result=}).
+
+        Values in parentheses lose their brackets, like C{(timeout)} or the
+        C{DATABASE GET} value. The empty extra value followed by the
+        C{endpos=} offset is returned as C{''}.
+
+        @param name: command name.
+        @param line: reply value, like C{'1 (value)'} or C{'0 endpos=1234'}.
+
+        @return: tuple of the C{str} result, C{str} extra value or C{None}
+            and C{int} endpos or C{None}.
+        """
+        shape = self.shapes.get(name, self.default)
+        if shape.codeOnly and ' ' not in line:
+            return line, None, None
+
+        endpos = None
+        if shape.hasEndpos:
+            index = line.find(ENDPOS)
+            if index != -1:
+                endpos = int(line[index + 8:])
+                line = line[:index]
+
+        result, separator, extra = line.partition(' ')
+        if not separator:
+            return result, ('' if endpos is not None else None), endpos
+
+        if extra[:1] == '(' and extra[-1:] == ')':
+            extra = extra[1:-1]
+        return result, extra, endpos
+
+
+__all__ = ['ResultShape', 'ResponseCodec']
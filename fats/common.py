@@ -35,21 +35,18 @@ def checkGroupCount(agi, max_group_calls):
     @raise: MaxGroupCount
     @return: Group count
     """
-    def checkGroup(skip_result):
-        def onResult(cmd):
-            group_count = int(cmd.extra)
-                
-            if group_count > max_group_calls:
-                log.msg(
-                    """Maximum allowed calls restriction for account '%s',
-                    current group count '%s'"""%
-                    (agi.env['agi_accountcode'], group_count))
-                raise MaxGroupCount
-            return group_count
-            
-        return agi.getFullVariable('${GROUP_COUNT(${GROUP})}'
-            ).addCallback(onResult)
-        
-    return agi.setVariable('GROUP',
-        agi.env['agi_accountcode']
-        ).addCallback(checkGroup)
+    def onResult(results):
+        group_count = int(results[1].extra)
+
+        if group_count > max_group_calls:
+            log.msg(
+                """Maximum allowed calls restriction for account '%s',
+                current group count '%s'"""%
+                (agi.env['agi_accountcode'], group_count))
+            raise MaxGroupCount
+        return group_count
+
+    # Both commands are sent in one write, the count is read after the set.
+    return agi.pipeline().setVariable('GROUP', agi.env['agi_accountcode']
+        ).getFullVariable('${GROUP_COUNT(${GROUP})}').run(
+        ).addCallback(onResult)
@@ -0,0 +1,144 @@
+# -*- test-case-name: twisted.fats.test.test_environment -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""FastAGI environment block
+
+API Stability: unstable
+
+Asterisk starts every FastAGI session with about twenty C{agi_*: value}
+lines terminated by the blank line. The whole block is kept as one string
+and a variable is cut out of it only when the call handler asks for it, so
+the call start costs a single scan for the blank line.
+
+Key names are interned, and values of the keys which are the same for most
+of the calls (C{agi_network}, C{agi_language}, C{agi_type}, ...) share one
+string between the sessions.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from UserDict import DictMixin
+
+from twisted.python import log
+
+# Only the keys with a handful of values: the table is bounded by
+# MAX_SHARED, and the per customer keys (agi_context, agi_accountcode,
+# agi_rdnis) would fill it with the values of the first calls.
+SHARED_KEYS = frozenset(['agi_network', 'agi_language', 'agi_type',
+                         'agi_callingpres', 'agi_callingani2',
+                         'agi_callington', 'agi_callingtns',
+                         'agi_enhanced', 'agi_version'])
+MAX_SHARED = 4096
+
+_keys = {}
+_values = {}
+_needles = {}
+
+
+def internKey(key):
+    """
+    @return: interned lower case key name.
+    """
+    try:
+        return _keys[key]
+    except KeyError:
+        name = intern(key.lower())
+        if len(_keys) < MAX_SHARED:
+            _keys[key] = name
+        return name
+
+
+def shareValue(key, value):
+    """
+    @return: string shared between the sessions for the value of the
+        L{SHARED_KEYS}, the value itself for the other keys.
+    """
+    if key not in SHARED_KEYS:
+        return value
+    try:
+        return _values[value]
+    except KeyError:
+        if len(_values) < MAX_SHARED:
+            _values[value] = value
+        return value
+
+
+class AGIEnvironment(DictMixin, object):
+    """
+    Lazy dictionary of the FastAGI environment variables.
+
+    Variables are looked up in the raw block and cached on the first
+    access. Iteration, deletion or a missing key parse the rest of the
+    block at once and release it.
+
+    @ivar block: raw environment block prefixed with the newline, C{None}
+        when it is parsed.
+    """
+
+    def __init__(self, block=''):
+        """
+        @param block: environment lines up to (not including) the blank line.
+        """
+        self.block = '\n' + block
+        self.values = {}
+
+    def __getitem__(self, key):
+        values = self.values
+        if key in values:
+            return values[key]
+
+        block = self.block
+        if block is None:
+            raise KeyError(key)
+
+        needle = _needles.get(key)
+        if needle is None:
+            needle = '\n%s: ' % key
+            if len(_needles) < MAX_SHARED:
+                _needles[key] = needle
+        start = block.find(needle)
+        if start == -1:
+            self._parse()
+            return values[key]
+
+        start += len(needle)
+        end = block.find('\n', start)
+        if end == -1:
+            end = len(block)
+        key = internKey(key)
+        value = values[key] = shareValue(key, block[start:end].rstrip())
+        return value
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        self._parse()
+        del self.values[key]
+
+    def keys(self):
+        self._parse()
+        return self.values.keys()
+
+    def _parse(self):
+        """
+        Parse the rest of the block.
+        """
+        if self.block is None:
+            return
+        values = self.values
+        for line in self.block.split('\n'):
+            key, separator, value = line.partition(': ')
+            if separator:
+                key = internKey(key)
+                if key not in values:
+                    values[key] = shareValue(key, value.rstrip())
+            elif line:
+                log.err('Invalid variable line: %r' % line)
+        self.block = None
+
+
+__all__ = ['AGIEnvironment', 'internKey', 'shareValue', 'SHARED_KEYS']
@@ -34,6 +34,48 @@ class FailureOnOpen(AGICommandFailure):
     FastAGI command failure of some description
     """
 
+class AGIPipelineAborted(AGICommandFailure):
+    """
+    FastAGI pipelined command result dropped after a previous failure
+    """
+
+class AGIHangup(AsteriskException):
+    """
+    FastAGI channel hung up, the command is cancelled
+    """
+
+class LookupTimeout(AsteriskException):
+    """
+    Lookup overlapped with the playback missed its deadline
+    """
+
+class CallPoolFull(AsteriskException):
+    """
+    Blocking call handler rejected by the full worker pool queue
+    """
+
+class TaskQueueFull(AsteriskException):
+    """
+    Task rejected by the full process pool queue
+    """
+
+class TaskError(AsteriskException):
+    """
+    Process pool task raised the exception in the worker process
+
+    @ivar type: name of the exception class.
+    @ivar value: string of the exception.
+    @ivar traceback: formatted traceback in the worker.
+    """
+    def __init__(self, type, value, traceback):
+        AsteriskException.__init__(self, (type, value))
+        self.type = type
+        self.value = value
+        self.traceback = traceback
+
+    def __str__(self):
+        return '%s: %s' % (self.type, self.value)
+
 class UndefinedTimeFormat(AsteriskException):
     """
     FastAGI time format error
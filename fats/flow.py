@@ -0,0 +1,288 @@
+# -*- test-case-name: twisted.fats.test.test_flow -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Declarative IVR flows
+
+API Stability: unstable
+
+The IVR tree is described by the nodes of the steps and compiled once, at
+the load time, into the plan: the consecutive steps which don't wait for
+the caller are merged into one pipelined write, the adjacent prompts and
+the static SAY steps into one prompt list::
+
+    class Reception(FlowHandler):
+        flow = Flow({
+            'main': [('answer',),
+                     ('set', {'CDR(userfield)': 'ivr'}),
+                     ('play', 'welcome'),
+                     ('menu', ['press-1-sales', 'press-2-support'],
+                      {'1': 'sales', '2': 'support'}, {'retries': 3}),
+                     ('hangup',)],
+            'sales': [('collect', 'ext', 'enter-ext', 4),
+                      ('transfer', 'SIP/%(ext)s')],
+            'support': [('transfer', 'SIP/support')]})
+
+The steps:
+
+ - C{('answer',)};
+ - C{('set', {name: value})} sets the channel variables by one C{MSet};
+ - C{('play', prompt, ...)} plays the prompts, not interruptible;
+ - C{('say', kind, value)} plays the static number, digits, date or time
+   in the language of the flow, see L{twisted.fats.say.render}, by the
+   SAY command when the language has no renderer;
+ - C{('collect', name, prompt, maxDigits[, timeout])} reads the digits by
+   C{GET DATA} into the flow variable;
+ - C{('menu', prompts, {digit: node}[, options])} plays the prompts until
+   the choice digit, the options are the C{timeout} of the digit after the
+   prompts, the number of the C{retries}, the C{invalid} prompts played on
+   the wrong digit and the C{fallback} node when no choice is made (the
+   next steps run by default);
+ - C{('goto', node)};
+ - C{('transfer', target[, options])} dials the target and ends the flow;
+ - C{('hangup',)} ends the flow.
+
+Values of the C{set} and the C{transfer} steps may use the flow variables
+as C{%(name)s}.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.internet import defer
+
+from twisted.fats.errors import AGICommandTimeout
+from twisted.fats.say import render, sayCommand
+from twisted.fats.service import CallHandler, CoroutineDriver
+
+# Operations of the plan.
+_BATCH, _COLLECT, _MENU, _GOTO, _END = range(5)
+
+_INTERACTIVE = frozenset(['collect', 'menu'])
+_TERMINAL = frozenset(['goto', 'transfer', 'hangup'])
+
+
+def _isDynamic(value):
+    return isinstance(value, basestring) and '%(' in value
+
+
+class Flow(object):
+    """
+    Compiled IVR flow.
+
+    @ivar start: name of the first node.
+    @ivar language: language of the C{say} steps.
+    @ivar nodes: dictionary of the operations tuples by the node name.
+    """
+
+    def __init__(self, nodes, start='main', language='en'):
+        self.start = start
+        self.language = language
+        self.nodes = {}
+        for name, steps in nodes.iteritems():
+            self.nodes[name] = self._compile(name, steps)
+        self._link()
+
+    def _compile(self, node, steps):
+        """
+        @return: tuple of the operations of the node.
+        """
+        ops = []
+        calls = []
+        prompts = []
+        dynamic = [False]
+        def flushPrompts():
+            if prompts:
+                calls.append(('playlist', (tuple(prompts),), {}))
+                del prompts[:]
+        def flushCalls():
+            flushPrompts()
+            if calls:
+                ops.append((_BATCH, (tuple(calls), dynamic[0])))
+                del calls[:]
+                dynamic[0] = False
+
+        for index, step in enumerate(steps):
+            kind, args = step[0], step[1:]
+            if index and steps[index - 1][0] in _TERMINAL:
+                raise ValueError('Step after %r in the node %r' %
+                                 (steps[index - 1][0], node))
+            if kind == 'play':
+                prompts.extend(args)
+                continue
+            if kind == 'say':
+                files = render(self.language, *args)
+                if files is not None:
+                    prompts.extend(files)
+                    continue
+                flushPrompts()
+                calls.append(sayCommand(*args))
+                continue
+            flushPrompts()
+            if kind == 'answer':
+                calls.append(('answer', (), {}))
+            elif kind == 'set':
+                variables = args[0]
+                dynamic[0] = dynamic[0] or bool(
+                    [value for value in variables.itervalues()
+                     if _isDynamic(value)])
+                calls.append(('setVariables', (dict(variables),), {}))
+            elif kind == 'transfer':
+                dynamic[0] = dynamic[0] or bool(
+                    [arg for arg in args if _isDynamic(arg)])
+                calls.append(('exec_', ('Dial',) + args, {}))
+            elif kind == 'hangup':
+                calls.append(('hangup', (), {}))
+            elif kind in _INTERACTIVE or kind == 'goto':
+                flushCalls()
+                if kind == 'collect':
+                    name, prompt, maxDigits = args[:3]
+                    timeout = len(args) > 3 and args[3] or 5
+                    ops.append((_COLLECT, (name, prompt, timeout, maxDigits)))
+                elif kind == 'menu':
+                    ops.append((_MENU, self._menu(*args)))
+                else:
+                    ops.append((_GOTO, args[0]))
+            else:
+                raise ValueError('Unknown step %r in the node %r' %
+                                 (kind, node))
+        flushCalls()
+        if not ops or ops[-1][0] != _GOTO:
+            ops.append((_END, None))
+        return tuple(ops)
+
+    def _menu(self, prompts, choices, options=None):
+        options = options or {}
+        if isinstance(prompts, basestring):
+            prompts = (prompts,)
+        invalid = options.get('invalid', ())
+        if isinstance(invalid, basestring):
+            invalid = (invalid,)
+        return (tuple(prompts), dict(choices), ''.join(sorted(choices)),
+                options.get('timeout', 5), options.get('retries', 3),
+                tuple(invalid), options.get('fallback'))
+
+    def _link(self):
+        """
+        Check the targets of the jumps.
+        """
+        if self.start not in self.nodes:
+            raise ValueError('Unknown start node %r' % self.start)
+        for name, ops in self.nodes.iteritems():
+            for code, arg in ops:
+                targets = ()
+                if code == _GOTO:
+                    targets = (arg,)
+                elif code == _MENU:
+                    targets = arg[1].values() + [arg[6]]
+                for target in targets:
+                    if target is not None and target not in self.nodes:
+                        raise ValueError('Unknown node %r in the node %r' %
+                                         (target, name))
+
+    def run(self, agi, variables=None):
+        """
+        Run the flow for the call.
+
+        @param variables: initial flow variables.
+        @return: deferred dictionary of the flow variables.
+        """
+        if variables is None:
+            variables = {}
+        return CoroutineDriver(self._run(agi, variables)).start()
+
+    def _run(self, agi, variables):
+        nodes = self.nodes
+        ops = nodes[self.start]
+        index = 0
+        while True:
+            code, arg = ops[index]
+            index += 1
+            if code == _BATCH:
+                calls, dynamic = arg
+                if dynamic:
+                    calls = [(name, _format(args, variables), kwargs)
+                             for name, args, kwargs in calls]
+                yield _runBatch(agi, calls)
+            elif code == _COLLECT:
+                name, prompt, timeout, maxDigits = arg
+                command = yield agi.getData(prompt, timeout, maxDigits)
+                variables[name] = command.result
+            elif code == _MENU:
+                (prompts, choices, escapeDigits, timeout, retries, invalid,
+                 target) = arg
+                for attempt in xrange(retries):
+                    result = yield agi.playlist(prompts, escapeDigits)
+                    digit = result.digit
+                    if digit is None:
+                        try:
+                            command = yield agi.waitForDigit(timeout)
+                        except AGICommandTimeout:
+                            continue
+                        digit = command.result
+                    if digit in choices:
+                        target = choices[digit]
+                        break
+                    if invalid:
+                        yield agi.playlist(invalid)
+                if target is not None:
+                    ops, index = nodes[target], 0
+            elif code == _GOTO:
+                ops, index = nodes[arg], 0
+            else:
+                break
+        defer.returnValue(variables)
+
+
+def _runBatch(agi, calls):
+    """
+    Send the calls in one write, without the L{CommandPipeline} result list.
+
+    @return: deferred result of the last call, or the first failure.
+    """
+    if len(calls) == 1:
+        name, args, kwargs = calls[0]
+        return getattr(agi, name)(*args, **kwargs)
+    dfs = agi._writePipelined(calls)
+    last = dfs.pop()
+    if not dfs:
+        return last
+    failures = []
+    for df in dfs:
+        df.addErrback(failures.append)
+    def check(result):
+        if failures:
+            return failures[0]
+        return result
+    return last.addBoth(check)
+
+
+def _format(args, variables):
+    """
+    @return: arguments with the flow variables substituted.
+    """
+    formatted = []
+    for arg in args:
+        if _isDynamic(arg):
+            arg = arg % variables
+        elif isinstance(arg, dict):
+            arg = dict([(name, value % variables if _isDynamic(value)
+                         else value) for name, value in arg.iteritems()])
+        formatted.append(arg)
+    return tuple(formatted)
+
+
+class FlowHandler(CallHandler):
+    """
+    Call handler which runs the L{flow}.
+
+    @ivar flow: L{Flow} of the handler.
+    """
+    flow = None
+
+    def startCall(self):
+        return self.flow.run(self.agi)
+
+
+__all__ = ['Flow', 'FlowHandler']
@@ -0,0 +1,214 @@
+# -*- test-case-name: twisted.fats.test.test_framing -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Stream framing for the FastAGI and AMI protocols
+
+API Stability: unstable
+
+L{basic.LineOnlyReceiver} concatenates and splits the whole buffer on every
+C{dataReceived}, so a partial frame is copied again with each chunk. The
+L{Framer} keeps the stream in a growable C{bytearray} and remembers how far
+it has been searched for the delimiter. All the complete frames are cut
+from the buffer in one copy and split in one scan, or handed out one by
+one as C{memoryview} slices of the buffer without the copy. Lines (C{'\\n'}) and
+whole blank line terminated messages (C{'\\r\\n\\r\\n'}) are split the same
+way, the delimiter may be switched between the frames.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.internet import protocol
+
+COMPACT_SIZE = 65536
+
+
+class Framer(object):
+    """
+    Delimiter framer over the growable buffer.
+
+    @ivar buffer: received bytes, C{bytearray}.
+    @ivar start: offset of the first byte not yet returned as a frame.
+    @ivar scanned: offset up to which the buffer has no delimiter.
+    """
+
+    def __init__(self, delimiter='\r\n'):
+        self.buffer = bytearray()
+        self.start = 0
+        self.scanned = 0
+        self._delimiter = delimiter
+
+    def _getDelimiter(self):
+        return self._delimiter
+
+    def _setDelimiter(self, delimiter):
+        if delimiter != self._delimiter:
+            self._delimiter = delimiter
+            self.scanned = self.start
+
+    delimiter = property(_getDelimiter, _setDelimiter,
+                         doc="Frame delimiter, may be switched between frames.")
+
+    def __len__(self):
+        """
+        @return: number of the buffered bytes which are not returned yet.
+        """
+        return len(self.buffer) - self.start
+
+    def extend(self, data):
+        """
+        Append the received data.
+
+        The consumed bytes are dropped from the buffer head first when it
+        is worth it. When the previously returned frames are still
+        referenced the buffer can't be resized, so the unconsumed tail is
+        moved to a new one.
+        """
+        buffer, start = self.buffer, self.start
+        try:
+            if start and (start == len(buffer) or start > COMPACT_SIZE
+                          or start * 2 > len(buffer)):
+                del buffer[:start]
+                self.scanned -= start
+                self.start = 0
+            buffer.extend(data)
+        except BufferError:
+            self.buffer = bytearray(buffer[start:])
+            self.buffer.extend(data)
+            self.scanned -= start
+            self.start = 0
+
+    def next(self):
+        """
+        @return: next complete frame without the delimiter as the
+            C{memoryview}, valid until the next L{extend}, or C{None}.
+        """
+        buffer, delimiter = self.buffer, self._delimiter
+        index = buffer.find(delimiter, self.scanned)
+        if index == -1:
+            self.scanned = max(self.start, len(buffer) - len(delimiter) + 1)
+            return None
+        frame = memoryview(buffer)[self.start:index]
+        self.start = self.scanned = index + len(delimiter)
+        return frame
+
+    def split(self):
+        """
+        Copy the complete frames out of the buffer in one C{str} and split
+        it. The frames of the short lines are too many to slice the
+        C{memoryview} one by one, that is twice as slow.
+
+        @return: list of all the complete frames as C{str}.
+        """
+        buffer, delimiter = self.buffer, self._delimiter
+        end = buffer.rfind(delimiter, self.scanned)
+        if end == -1:
+            self.scanned = max(self.start, len(buffer) - len(delimiter) + 1)
+            return []
+        frames = memoryview(buffer)[self.start:end].tobytes().split(delimiter)
+        self.start = self.scanned = end + len(delimiter)
+        return frames
+
+    def unread(self, frames, delimiter):
+        """
+        Return the frames, just taken by the L{split} with the given
+        delimiter, back to the buffer.
+        """
+        size = sum(len(frame) for frame in frames)
+        self.start -= size + len(frames) * len(delimiter)
+        self.scanned = self.start
+
+    def clear(self):
+        """
+        Drop the buffered data.
+        """
+        self.buffer = bytearray()
+        self.start = self.scanned = 0
+
+
+class FramedReceiver(protocol.Protocol):
+    """
+    Drop in replacement of L{basic.LineOnlyReceiver} built on the L{Framer}.
+
+    @ivar delimiter: line delimiter.
+    @ivar MAX_LENGTH: maximum frame size, the whole message when the
+        delimiter is switched to the message terminator.
+    @ivar framer: L{Framer} of the connection, created on the first data.
+    """
+    delimiter = '\r\n'
+    MAX_LENGTH = 16384
+    framer = None
+
+    def dataReceived(self, data):
+        """
+        Split the received data into frames.
+        """
+        framer = self.framer
+        if framer is None:
+            framer = self.framer = Framer(self.delimiter)
+        framer.extend(data)
+
+        maxLength = self.MAX_LENGTH
+        transport = self.transport
+        receive = self.frameReceived
+        if getattr(receive, 'im_func', None) is self._frameReceived.im_func:
+            receive = self.lineReceived
+        while not transport.disconnecting:
+            # The delimiter property is too slow for the per frame check.
+            delimiter = framer._delimiter
+            start = framer.start
+            frames = framer.split()
+            if not frames:
+                break
+            checkLength = framer.start - start > maxLength
+            index = 0
+            for frame in frames:
+                if transport.disconnecting:
+                    return
+                if checkLength and len(frame) > maxLength:
+                    framer.clear()
+                    return self.lineLengthExceeded(frame)
+                receive(frame)
+                index += 1
+                if framer._delimiter is not delimiter:
+                    framer.unread(frames[index:], delimiter)
+                    break
+
+        if len(framer) > maxLength:
+            data = framer.buffer[framer.start:]
+            framer.clear()
+            return self.lineLengthExceeded(str(data))
+
+    def frameReceived(self, frame):
+        """
+        Override this to handle the frame split by the current delimiter of
+        the L{framer}.
+
+        @param frame: C{str} frame without the delimiter.
+        """
+        return self.lineReceived(frame)
+
+    _frameReceived = frameReceived
+
+    def lineReceived(self, line):
+        """
+        Override this for when each line is received.
+        """
+        raise NotImplementedError
+
+    def sendLine(self, line):
+        """
+        Sends a line to the other end of the connection.
+        """
+        return self.transport.write(line + self.delimiter)
+
+    def lineLengthExceeded(self, line):
+        """
+        Called when the maximum frame length has been reached.
+        """
+        return self.transport.loseConnection()
+
+
+__all__ = ['Framer', 'FramedReceiver']
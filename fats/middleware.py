@@ -0,0 +1,164 @@
+# -*- test-case-name: twisted.fats.test.test_middleware -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Middleware of the FastAGI calls
+
+API Stability: unstable
+
+The L{FastAGIFactory.middleware} wraps every call with the hooks of its
+items, without subclassing the factory::
+
+    class Authenticate(Middleware):
+        def before(self, agi):
+            if agi.env.get('agi_accountcode') not in ACCOUNTS:
+                return agi.hangup()
+
+    factory = FastAGIFactory()
+    factory.middleware = [CallMetrics(), Authenticate(),
+                          AccountcodeLimit({'acme': 10})]
+
+The middleware defines any of the hooks:
+
+ - C{before(agi)}, in order, before the admission and the handler;
+   returns C{None} to go on, or the result of the call (the value, the
+   deferred or the failure) to stop it: the handler does not start and
+   the later before hooks are skipped;
+ - C{after(agi, result)}, in the reverse order, when the handler or the
+   stopping before hook succeeded;
+ - C{error(agi, failure)}, in the reverse order, when they failed.
+
+The after and error hooks observe every call, even the stopped ones and
+those rejected by the admission (with the C{False} result), and their
+return value is ignored. The hooks are collected into the tuples by
+L{FastAGIFactory.compileMiddleware} when the factory starts, so the call
+runs just the hooks which are defined, the empty tuples cost nothing, and
+the after and error hooks share one callback of the handler deferred.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.python import log
+
+from twisted.fats.errors import AGIHangup
+
+
+class Middleware(object):
+    """
+    Base of the middleware, defines no hook.
+    """
+
+
+class AccountcodeLimit(Middleware):
+    """
+    Limit of the concurrent calls per accountcode.
+
+    @ivar limits: dictionary of the limits by the accountcode, or one limit
+        for every accountcode.
+    @ivar fallback: callable which sends the call over the limit to the
+        dialplan, returns the deferred, like the
+        L{twisted.fats.admission.overflowTo}; the call is just finished by
+        default.
+    @ivar active: dictionary of the running calls by the accountcode.
+    @ivar rejected: number of the calls over the limit.
+    """
+
+    def __init__(self, limits, fallback=None):
+        self.limits = limits
+        self.fallback = fallback
+        self.active = {}
+        self.rejected = 0
+        self._counted = set()
+
+    def _limit(self, accountcode):
+        if isinstance(self.limits, dict):
+            return self.limits.get(accountcode)
+        return self.limits
+
+    def before(self, agi):
+        accountcode = agi.env.get('agi_accountcode', '')
+        limit = self._limit(accountcode)
+        if limit is None:
+            return None
+        count = self.active.get(accountcode, 0)
+        if count >= limit:
+            self.rejected += 1
+            log.msg('Accountcode %s is over its limit of %d calls' %
+                    (accountcode, limit))
+            if self.fallback is None:
+                return False
+            return self.fallback(agi)
+        self.active[accountcode] = count + 1
+        self._counted.add(agi)
+        return None
+
+    def after(self, agi, result):
+        if agi in self._counted:
+            self._counted.discard(agi)
+            accountcode = agi.env.get('agi_accountcode', '')
+            count = self.active[accountcode] - 1
+            if count:
+                self.active[accountcode] = count
+            else:
+                del self.active[accountcode]
+
+    def error(self, agi, reason):
+        self.after(agi, None)
+
+
+class CallMetrics(Middleware):
+    """
+    Counters and the duration of the calls, of those which reached its
+    before hook: put it first to count the stopped calls too.
+
+    @ivar calls: number of the started calls.
+    @ivar completed: number of the calls finished by their handler.
+    @ivar hangups: number of the calls stopped by the hangup.
+    @ivar failures: number of the failed calls.
+    @ivar seconds: total seconds of the finished calls.
+    """
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.calls = self.completed = self.hangups = self.failures = 0
+        self.seconds = 0.0
+        self._started = {}
+
+    def before(self, agi):
+        self.calls += 1
+        self._started[agi] = self.reactor.seconds()
+
+    def _finished(self, agi):
+        started = self._started.pop(agi, None)
+        if started is None:
+            return False
+        self.seconds += self.reactor.seconds() - started
+        return True
+
+    def after(self, agi, result):
+        if self._finished(agi):
+            self.completed += 1
+
+    def error(self, agi, reason):
+        if not self._finished(agi):
+            return
+        if reason.check(AGIHangup):
+            self.hangups += 1
+        else:
+            self.failures += 1
+
+    def stats(self):
+        finished = self.completed + self.hangups + self.failures
+        return {'calls': self.calls,
+                'active': len(self._started),
+                'completed': self.completed,
+                'hangups': self.hangups,
+                'failures': self.failures,
+                'averageTime': finished and self.seconds / finished}
+
+
+__all__ = ['Middleware', 'AccountcodeLimit', 'CallMetrics']
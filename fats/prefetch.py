@@ -0,0 +1,224 @@
+# -*- test-case-name: twisted.fats.test.test_prefetch -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Learned prefetch of the channel variables
+
+API Stability: unstable
+
+Most of the handlers start with the same few C{GET VARIABLE} and
+C{GET FULL VARIABLE} commands, one round trip each. The L{Prefetcher}
+records, per L{URL.path}, which variables and expressions the route reads
+in its first commands. Once the route has enough calls, the variables read
+by the most of them are fetched by one C{GET FULL VARIABLE} as soon as the
+environment is parsed, and the first read of each is answered locally.
+The functions, like C{CDR(billsec)}, are never prefetched, and the values
+of the variables set by the handler are dropped::
+
+    FastAGIProtocol.prefetcher = Prefetcher()
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.internet import defer
+from twisted.python import log
+
+from twisted.fats.agi import Command
+
+
+class _Route(object):
+    """
+    Reads recorded for the route.
+
+    @ivar calls: number of the recorded calls.
+    @ivar reads: dictionary of the number of the calls which read the
+        variable by C{(command name, argument)}.
+    @ivar profile: reads prefetched for the route.
+    """
+    __slots__ = ('calls', 'reads', 'profile')
+
+    def __init__(self):
+        self.calls = 0
+        self.reads = {}
+        self.profile = ()
+
+
+class _Call(object):
+    """
+    Prefetch state of the call.
+
+    @ivar route: L{_Route} of the call.
+    @ivar firstCommand: number of the commands sent before the handler.
+    @ivar reads: reads recorded in the first commands.
+    @ivar values: prefetched values not read yet, by the read.
+    @ivar deferred: deferred of the running prefetch or C{None}.
+    """
+    __slots__ = ('route', 'firstCommand', 'reads', 'values', 'deferred')
+
+    def __init__(self, route):
+        self.route = route
+        self.firstCommand = 0
+        self.reads = set()
+        self.values = {}
+        self.deferred = None
+
+
+class Prefetcher(object):
+    """
+    Per route profiles of the variable reads and their prefetch.
+
+    @ivar commands: number of the first commands of the call whose reads
+        are recorded.
+    @ivar learnCalls: number of the calls of the route recorded before the
+        prefetch starts.
+    @ivar threshold: share of the calls which must read the variable for
+        its prefetch.
+    @ivar maxVariables: maximum number of the prefetched reads per call.
+    @ivar maxRoutes: maximum number of the profiled routes.
+    @ivar routes: dictionary of the L{_Route} by the path.
+    @ivar hits: number of the reads answered by the prefetch.
+    @ivar misses: number of the reads in the first commands which were
+        sent to the Asterisk.
+    @ivar prefetched: number of the prefetched values.
+    @ivar unused: number of the prefetched values never read.
+    """
+
+    def __init__(self, commands=5, learnCalls=20, threshold=0.5,
+                 maxVariables=16, maxRoutes=1000):
+        self.commands = commands
+        self.learnCalls = learnCalls
+        self.threshold = threshold
+        self.maxVariables = maxVariables
+        self.maxRoutes = maxRoutes
+        self.routes = {}
+        self.hits = self.misses = self.prefetched = self.unused = 0
+
+    def callStarted(self, agi):
+        """
+        Start recording the call and prefetch the profile of its route.
+        """
+        path = agi.url is not None and agi.url.path or ()
+        route = self.routes.get(path)
+        if route is None:
+            if len(self.routes) >= self.maxRoutes:
+                return
+            route = self.routes[path] = _Route()
+        call = agi.prefetchCall = _Call(route)
+        if route.profile:
+            self._prefetch(agi, call, route.profile)
+        call.firstCommand = agi.commandsSent
+
+    def _prefetch(self, agi, call, profile):
+        expressions = [argument if name == 'GET FULL VARIABLE'
+                       else '${%s}' % argument
+                       for name, argument in profile]
+        def fetched(command):
+            values = (command.extra or '').split(agi.variablesDelimiter)
+            if len(values) == len(profile):
+                call.values.update(zip(profile, values))
+                self.prefetched += len(values)
+            call.deferred = None
+        def failed(failure):
+            log.msg('Prefetch failed: %s' % failure.getErrorMessage())
+            call.deferred = None
+        call.deferred = agi.sendCommand('GET FULL VARIABLE', '"%s"' %
+            agi.variablesDelimiter.join(expressions))
+        call.deferred.addCallbacks(fetched, failed)
+
+    def read(self, agi, name, argument):
+        """
+        Record the read and answer it by the prefetched value.
+
+        @param name: command name, C{GET VARIABLE} or C{GET FULL VARIABLE}.
+        @param argument: variable name or expression.
+        @return: deferred L{Command} or C{None} when the command must be
+            sent.
+        """
+        call = agi.prefetchCall
+        if call is None:
+            return None
+        key = name, argument
+        if agi.commandsSent - call.firstCommand < self.commands:
+            call.reads.add(key)
+        if call.deferred is not None and key in call.route.profile:
+            df = defer.Deferred()
+            def wait(result):
+                self._answer(agi, call, key).chainDeferred(df)
+                return result
+            call.deferred.addBoth(wait)
+            return df
+        return self._answer(agi, call, key, True)
+
+    def _answer(self, agi, call, key, orNone=False):
+        value = call.values.pop(key, None)
+        # The empty variable may be the unset one, GET VARIABLE fails then.
+        if value is None or (not value and key[0] == 'GET VARIABLE'):
+            if key in call.reads:
+                self.misses += 1
+            if orNone:
+                return None
+            return agi.sendCommand(*key)
+        self.hits += 1
+        return defer.succeed(Command(key[0], '1', value))
+
+    def invalidate(self, agi, names=()):
+        """
+        Drop the prefetched values of the variables changed by the call,
+        of all of them when no names are given. The values of the running
+        prefetch are dropped when it is answered too.
+        """
+        call = agi.prefetchCall
+        if call is None or not call.values and call.deferred is None:
+            return
+        def drop(result=None):
+            if not names:
+                call.values.clear()
+                return result
+            for key in call.values.keys():
+                for name in names:
+                    if key[1] == name or '${%s}' % name in key[1]:
+                        del call.values[key]
+                        break
+            return result
+        drop()
+        if call.deferred is not None:
+            call.deferred.addBoth(drop)
+
+    def callEnded(self, agi):
+        """
+        Add the reads of the call to the profile of its route.
+        """
+        call = agi.prefetchCall
+        if call is None:
+            return
+        agi.prefetchCall = None
+        self.unused += len(call.values)
+        route = call.route
+        route.calls += 1
+        for key in call.reads:
+            route.reads[key] = route.reads.get(key, 0) + 1
+        if route.calls >= self.learnCalls:
+            minimum = route.calls * self.threshold
+            frequent = sorted([(-count, key)
+                               for key, count in route.reads.iteritems()
+                               if count >= minimum and '"' not in key[1]
+                               and '(' not in key[1]])
+            route.profile = tuple([key for _, key
+                                   in frequent[:self.maxVariables]])
+
+    def stats(self):
+        """
+        @return: dictionary of the prefetch metrics.
+        """
+        reads = self.hits + self.misses
+        return {'routes': len(self.routes),
+                'hits': self.hits,
+                'misses': self.misses,
+                'prefetched': self.prefetched,
+                'unused': self.unused,
+                'hitRate': reads and float(self.hits) / reads}
+
+
+__all__ = ['Prefetcher']
@@ -0,0 +1,450 @@
+# -*- test-case-name: twisted.fats.test.test_prefork -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Prefork FastAGI server
+
+API Stability: unstable
+
+One reactor uses one core. The L{Supervisor} runs the workers which accept
+the calls on the same port: either on the listening socket created by the
+supervisor and passed to the workers, or, with C{reusePort}, each on its
+own socket bound with C{SO_REUSEPORT}, so the kernel spreads the
+connections evenly. Crashed workers are started again. The server is run
+by the C{fats} twistd plugin (see L{twisted.fats.tap})::
+
+    twistd fats --factory=myivr.factory --workers=4 --port=4573
+
+The workers are the fresh Python processes started by the
+C{reactor.spawnProcess}, which load the factory by its fully qualified
+name, so nothing of the supervisor reactor (its descriptors, its timers,
+its threads) gets into them. The listening socket is passed as the
+descriptor 4, the worker reports that it listens through the descriptor 3
+and its log lines come to the log of the supervisor.
+
+The stopped worker closes its port and drains its calls (see
+L{FastAGIFactory.drain}). On C{SIGHUP} the supervisor starts the new
+workers, which load the new handler code, and stops the old ones once all
+the new ones listen, so the deploy drops no call: the new workers take the
+new calls while the old ones finish theirs. The old workers are kept when
+a new one fails to start.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import os, sys, ast, fcntl, signal, socket
+
+from twisted.application import service
+from twisted.internet import defer, error, protocol, tcp
+from twisted.python import log
+
+# Descriptors of the worker process.
+_READY_FD = 3
+_SOCKET_FD = 4
+
+
+class InheritedPort(tcp.Port):
+    """
+    TCP port which accepts on the listening socket created by the other
+    process.
+    """
+
+    def __init__(self, skt, factory, reactor=None):
+        interface, port = skt.getsockname()[:2]
+        tcp.Port.__init__(self, port, factory, interface=interface,
+                          reactor=reactor)
+        self._inherited = skt
+
+    def startListening(self):
+        skt = self._inherited
+        skt.setblocking(0)
+        fd = skt.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self._realPortNumber = skt.getsockname()[1]
+        log.msg('%s starting on the inherited %s' %
+                (self.factory.__class__, self._realPortNumber))
+        self.factory.doStart()
+        self.connected = True
+        self.socket = skt
+        self.fileno = skt.fileno
+        self.numberAccepts = 100
+        self.startReading()
+
+    def _closeSocket(self):
+        # The shutdown of the tcp.Port would stop the listening socket of
+        # all the workers, close only the descriptor of this one.
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class ReusePort(tcp.Port):
+    """
+    TCP port bound with C{SO_REUSEPORT}, every worker listens on its own
+    socket of the same port.
+    """
+
+    def createInternetSocket(self):
+        skt = tcp.Port.createInternetSocket(self)
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return skt
+
+
+def listeningSocket(port, interface='', backlog=50):
+    """
+    @return: listening socket to be passed to the workers.
+    """
+    skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    skt.bind((interface, port))
+    skt.listen(backlog)
+    return skt
+
+
+def pinToCPU(cpu):
+    """
+    Bind the current process to the CPU.
+
+    @return: whether the affinity is set.
+    """
+    import ctypes, ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    mask = ctypes.c_ulong(1 << cpu)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)):
+        log.msg('Can not pin the worker to the CPU %d: %s' %
+                (cpu, os.strerror(ctypes.get_errno())))
+        return False
+    return True
+
+
+class Worker(service.Service):
+    """
+    Service of the worker process: listens with the factory, then drains
+    its calls when stopped.
+
+    @ivar factory: L{FastAGIFactory} of the worker.
+    @ivar options: dictionary of the worker options passed by the
+        L{Supervisor}.
+    """
+    listeningPort = None
+
+    def __init__(self, factory, options, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.factory = factory
+        self.options = options
+
+    def startService(self):
+        service.Service.startService(self)
+        options = self.options
+        if options.get('cpu') is not None:
+            pinToCPU(options['cpu'])
+        if options['reusePort']:
+            self.listeningPort = ReusePort(options['port'], self.factory,
+                                           options['backlog'],
+                                           options['interface'],
+                                           self.reactor)
+        else:
+            skt = socket.fromfd(_SOCKET_FD, socket.AF_INET,
+                                socket.SOCK_STREAM)
+            os.close(_SOCKET_FD)
+            self.listeningPort = InheritedPort(skt, self.factory,
+                                               self.reactor)
+        self.listeningPort.startListening()
+        os.write(_READY_FD, 'ready\n')
+        os.close(_READY_FD)
+
+    def stopService(self):
+        """
+        @return: deferred fired when the calls are drained.
+        """
+        service.Service.stopService(self)
+        if self.listeningPort is None:
+            return None
+        df = defer.maybeDeferred(self.listeningPort.stopListening)
+        return df.addCallback(
+            lambda _: self.factory.drain(self.options['drainTimeout']))
+
+
+def _logToParent(event):
+    """
+    Log observer of the worker, the supervisor adds the time and the worker
+    to the lines.
+    """
+    text = log.textFromEventDict(event)
+    if text is not None:
+        sys.stdout.write(text.replace('\n', '\n\t') + '\n')
+        sys.stdout.flush()
+
+
+def _workerMain():
+    """
+    Entry point of the worker process, the options are in the last
+    argument.
+    """
+    from twisted.internet import reactor
+    from twisted.fats.tap import loadFactory
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    log.startLoggingWithObserver(_logToParent, setStdout=False)
+    options = ast.literal_eval(sys.argv[-1])
+    worker = Worker(loadFactory(options['factory']), options, reactor)
+    failed = []
+    def start():
+        try:
+            worker.startService()
+        except:
+            log.err(None, 'Worker failed to start')
+            failed.append(True)
+            reactor.stop()
+    reactor.callWhenRunning(start)
+    reactor.addSystemEventTrigger('before', 'shutdown', worker.stopService)
+    reactor.run()
+    sys.exit(failed and 1 or 0)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """
+    Worker process seen from the L{Supervisor}.
+
+    @ivar index: index of the worker.
+    @ivar ready: whether the worker listens.
+    @ivar ended: deferred fired when the process exits.
+    """
+    ready = False
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.ended = defer.Deferred()
+        self._lines = {}
+
+    @property
+    def pid(self):
+        return self.transport.pid
+
+    def signal(self, name):
+        try:
+            self.transport.signalProcess(name)
+        except error.ProcessExitedAlready:
+            pass
+
+    def childDataReceived(self, childFD, data):
+        if childFD == _READY_FD:
+            if not self.ready:
+                self.ready = True
+                self.supervisor._ready(self)
+            return
+        lines = (self._lines.get(childFD, '') + data).split('\n')
+        self._lines[childFD] = lines.pop()
+        for line in lines:
+            log.msg('[worker %d, pid %s] %s' % (self.index, self.pid, line))
+
+    def processEnded(self, reason):
+        self.supervisor._exited(self, reason)
+        self.ended.callback(None)
+
+
+class Supervisor(service.Service):
+    """
+    Starts the workers which serve the factory on the shared port, and
+    starts them again when they exit.
+
+    @ivar factory: fully qualified name of the factory served by the
+        workers, see L{twisted.fats.tap.loadFactory}.
+    @ivar workers: number of the workers.
+    @ivar reusePort: whether every worker binds its own C{SO_REUSEPORT}
+        socket, otherwise they share the socket of the supervisor.
+    @ivar cpus: CPUs the workers are pinned to in turn, C{None} to not pin
+        them.
+    @ivar restartDelay: seconds before the exited worker is started again.
+    @ivar drainTimeout: seconds the stopped worker lets its calls finish.
+    @ivar stopTimeout: seconds the workers have to exit after the
+        C{SIGTERM}, then they are killed; a bit over the L{drainTimeout}
+        by default.
+    @ivar processes: dictionary of the running L{WorkerProcess} by the
+        worker index.
+    @ivar retiring: set of the stopped L{WorkerProcess}es which have not
+        exited yet.
+    @ivar restarts: number of the restarts of the exited workers.
+    """
+    _previousHandler = None
+
+    def __init__(self, factory, port, workers=None, interface='',
+                 reusePort=False, cpus=None, restartDelay=1, drainTimeout=30,
+                 stopTimeout=None, backlog=50, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        self.reactor = reactor
+        self.factory = factory
+        self.port = port
+        self.workers = workers
+        self.interface = interface
+        self.reusePort = reusePort
+        self.cpus = cpus
+        self.restartDelay = restartDelay
+        self.drainTimeout = drainTimeout
+        if stopTimeout is None:
+            stopTimeout = drainTimeout + 5
+        self.stopTimeout = stopTimeout
+        self.backlog = backlog
+        self.processes = {}
+        self.retiring = set()
+        self.restarts = 0
+        self.socket = None
+        self._starting = None
+        self._restarting = {}
+
+    def startService(self):
+        service.Service.startService(self)
+        if not self.reusePort:
+            self.socket = listeningSocket(self.port, self.interface,
+                                          self.backlog)
+        for index in range(self.workers):
+            self.processes[index] = self._spawn(index)
+        self._previousHandler = (signal.signal(signal.SIGHUP, self._hangup)
+                                 or signal.SIG_DFL)
+
+    def getPort(self):
+        """
+        @return: number of the listening port, the one bound by the kernel
+            when the L{port} is 0 and the socket is shared.
+        """
+        if self.socket is not None:
+            return self.socket.getsockname()[1]
+        return self.port
+
+    def _spawn(self, index):
+        options = {'factory': self.factory, 'port': self.port,
+                   'interface': self.interface, 'reusePort': self.reusePort,
+                   'backlog': self.backlog, 'drainTimeout': self.drainTimeout,
+                   'cpu': self.cpus and self.cpus[index % len(self.cpus)]}
+        childFDs = {0: 'w', 1: 'r', 2: 'r', _READY_FD: 'r'}
+        if self.socket is not None:
+            childFDs[_SOCKET_FD] = self.socket.fileno()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.abspath(path)
+                                             for path in sys.path])
+        process = WorkerProcess(self, index)
+        self.reactor.spawnProcess(
+            process, sys.executable,
+            [sys.executable, '-c', 'from twisted.fats.prefork import '
+             '_workerMain; _workerMain()', repr(options)],
+            env, childFDs=childFDs)
+        log.msg('Worker %d started, pid %d' % (index, process.pid))
+        return process
+
+    def _ready(self, process):
+        if self._starting is None or \
+               self._starting.get(process.index) is not process:
+            return
+        if [new for new in self._starting.itervalues() if not new.ready]:
+            return
+        old, self.processes, self._starting = (self.processes,
+                                               self._starting, None)
+        for call in self._restarting.values():
+            call.cancel()
+        self._restarting = {}
+        log.msg('New workers listen, stopping the old ones')
+        self._retire(old.values())
+
+    def _retire(self, processes):
+        for process in processes:
+            self.retiring.add(process)
+            process.signal('TERM')
+
+    def _exited(self, process, reason):
+        status = getattr(reason.value, 'exitCode', None)
+        if status is None:
+            status = 'signal %s' % getattr(reason.value, 'signal', None)
+        log.msg('Worker %d (pid %s) exited with the status %s' %
+                (process.index, process.transport.pid, status))
+        if process in self.retiring:
+            self.retiring.discard(process)
+        elif self._starting is not None and \
+                 self._starting.get(process.index) is process:
+            log.msg('New worker %d failed to start, the old workers are '
+                    'kept' % process.index)
+            starting, self._starting = self._starting, None
+            self._retire([new for new in starting.values()
+                          if new is not process])
+        elif self.processes.get(process.index) is process:
+            del self.processes[process.index]
+            if self.running and process.index not in self._restarting:
+                self._restarting[process.index] = self.reactor.callLater(
+                    self.restartDelay, self._restart, process.index)
+
+    def _restart(self, index):
+        del self._restarting[index]
+        if self.running and index not in self.processes:
+            self.restarts += 1
+            self.processes[index] = self._spawn(index)
+
+    def _hangup(self, signum, frame):
+        self.reactor.callFromThread(self.reload)
+
+    def reload(self):
+        """
+        Start the new workers, which load the handler code again, and stop
+        the old ones once all the new ones listen. The old workers are kept
+        when a new one fails to start.
+        """
+        if not self.running or self._starting is not None:
+            return
+        log.msg('Reloading the workers')
+        self._starting = {}
+        for index in range(self.workers):
+            self._starting[index] = self._spawn(index)
+
+    def stopService(self):
+        """
+        Stop the workers, they drain their calls.
+
+        @return: deferred fired when the workers exit.
+        """
+        service.Service.stopService(self)
+        if self._previousHandler is not None:
+            signal.signal(signal.SIGHUP, self._previousHandler)
+            self._previousHandler = None
+        for call in self._restarting.values():
+            call.cancel()
+        self._restarting = {}
+        processes = self.processes.values()
+        if self._starting is not None:
+            processes.extend(self._starting.values())
+            self._starting = None
+        self.processes = {}
+        self._retire(processes)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        return self._waitWorkers()
+
+    def _waitWorkers(self):
+        processes = list(self.retiring)
+        def kill():
+            for process in processes:
+                if process in self.retiring:
+                    process.signal('KILL')
+        killer = self.reactor.callLater(self.stopTimeout, kill)
+        def exited(result):
+            if killer.active():
+                killer.cancel()
+            return result
+        return defer.DeferredList([process.ended for process in processes]
+                                  ).addCallback(exited)
+
+    def stats(self):
+        return {'workers': len(self.processes), 'retiring': len(self.retiring),
+                'restarts': self.restarts}
+
+
+__all__ = ['Supervisor', 'Worker', 'WorkerProcess', 'InheritedPort',
+           'ReusePort', 'listeningSocket', 'pinToCPU']
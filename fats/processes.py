@@ -0,0 +1,433 @@
+# -*- test-case-name: twisted.fats.test.test_processes -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Process pool for the CPU bound work of the call handlers
+
+API Stability: unstable
+
+Scoring or normalisation over the big tables holds the GIL, so in the
+reactor (or in the worker thread of L{twisted.fats.blocking}) it stalls all
+the sessions of the server. The L{ProcessPool} runs such tasks in the warm
+worker processes and returns the deferred result::
+
+    class Screening(CallHandler):
+        def startCall(self):
+            return self.deferToProcess(fraudScore, self.agi['agi_callerid'],
+                                       self.agi['agi_dnid'],
+                                       ).addCallback(self.route)
+
+The task function and its arguments are pickled, so the function must be
+importable on the module level. The workers are separate Python processes
+spawned by the C{reactor.spawnProcess} (the fork is followed by the exec,
+so no lock of the server threads is inherited), the tasks and the results
+go through their pipes.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import os, sys, time, signal, struct, traceback, cPickle, collections
+
+from twisted.internet import defer, error, protocol
+from twisted.python import log
+
+from twisted.fats.errors import TaskQueueFull, TaskError, AGICommandTimeout
+from twisted.fats.timer import getWheel
+
+_HEADER = struct.Struct('!I')
+
+
+def _initWorker():
+    """
+    Restore the default signal handling in the worker process.
+
+    The ignored signals are inherited through the exec. C{SIGINT} goes to
+    the whole process group on Ctrl-C and is left to the server.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+
+def _runTask(payload):
+    """
+    Run the pickled task in the worker process.
+
+    The result is pickled here as well, so an unpicklable result comes
+    back as the task error instead of killing the worker.
+
+    @return: pickled tuple of the success flag, the result or the exception
+        description, the start time and the finish time.
+    """
+    startedAt = time.time()
+    try:
+        func, args, kwargs = cPickle.loads(payload)
+        result = True, func(*args, **kwargs)
+    except BaseException, e:
+        result = False, (e.__class__.__name__, str(e), traceback.format_exc())
+    result += (startedAt, time.time())
+    try:
+        return cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        return cPickle.dumps((False, (e.__class__.__name__, str(e),
+                                      traceback.format_exc())) + result[2:],
+                             cPickle.HIGHEST_PROTOCOL)
+
+
+def _readExactly(fd, size):
+    chunks = []
+    while size:
+        chunk = os.read(fd, size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _workerMain(inFD=0, outFD=3):
+    """
+    Main loop of the worker process: read the tasks from the C{inFD}, write
+    their results to the C{outFD}, exit when the input is closed.
+    """
+    _initWorker()
+    while True:
+        header = _readExactly(inFD, _HEADER.size)
+        if header is None:
+            return
+        payload = _readExactly(inFD, _HEADER.unpack(header)[0])
+        if payload is None:
+            return
+        result = _runTask(payload)
+        data = _HEADER.pack(len(result)) + result
+        while data:
+            data = data[os.write(outFD, data):]
+
+
+class _Worker(protocol.ProcessProtocol):
+    """
+    Worker process of the L{ProcessPool}.
+
+    @ivar key: key of the running task or C{None}.
+    @ivar tasks: number of the tasks run by the worker.
+    @ivar ended: deferred fired when the process exits.
+    """
+    key = None
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.tasks = 0
+        self.ended = defer.Deferred()
+        self._buffer = ''
+
+    def run(self, key, payload):
+        self.key = key
+        self.transport.write(_HEADER.pack(len(payload)) + payload)
+
+    def retire(self):
+        """
+        Let the worker exit once it has read its tasks.
+        """
+        self.transport.closeStdin()
+
+    def kill(self):
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def childDataReceived(self, childFD, data):
+        self._buffer += data
+        while len(self._buffer) >= _HEADER.size:
+            size = _HEADER.unpack(self._buffer[:_HEADER.size])[0]
+            end = _HEADER.size + size
+            if len(self._buffer) < end:
+                break
+            result, self._buffer = self._buffer[_HEADER.size:end], \
+                                   self._buffer[end:]
+            key, self.key = self.key, None
+            self.tasks += 1
+            self.pool._finished(self, key, result)
+
+    def processEnded(self, reason):
+        self.pool._exited(self, reason)
+        self.ended.callback(None)
+
+
+class ProcessPool(object):
+    """
+    Bounded pool of the worker processes.
+
+    The pool dispatches the tasks itself, so it knows the worker of every
+    task: the worker is replaced after L{maxTasks} tasks, the worker of the
+    timed out task is killed and replaced, and the task of the worker which
+    dies fails with L{TaskError}. Tasks still running or queued when the
+    pool is stopped fail with L{defer.CancelledError}.
+
+    @ivar processes: number of the worker processes.
+    @ivar maxTasks: tasks after which the worker is replaced, C{None} keeps
+        the workers forever.
+    @ivar maxQueue: maximum number of the tasks waiting for the worker,
+        others fail with L{TaskQueueFull}.
+    @ivar timeout: default seconds the task may take from the submission,
+        C{None} for the unlimited tasks.
+    @ivar pending: number of the submitted tasks which are neither finished
+        nor timed out.
+    @ivar totalWait: seconds the finished tasks spent in the queue.
+    @ivar totalRun: seconds the finished tasks ran in the workers.
+    """
+
+    def __init__(self, processes=None, maxTasks=1000, maxQueue=100,
+                 timeout=60, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if not processes:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.maxTasks = maxTasks
+        self.maxQueue = maxQueue
+        self.timeout = timeout
+        self.started = False
+        self.pending = 0
+        self.completed = self.failed = self.rejected = self.timedOut = 0
+        self.recycled = 0
+        self.totalWait = self.totalRun = 0.0
+        self.maxWait = self.maxRun = 0.0
+        self._workers = set()
+        self._alive = set()
+        self._idle = []
+        self._queue = collections.deque()
+        self._running = {}
+        self._shutdownTrigger = None
+
+    def start(self):
+        """
+        Spawn the workers.
+        """
+        if self.started:
+            return
+        self.started = True
+        for index in range(self.processes):
+            self._spawn()
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+                'during', 'shutdown', self._shutdown)
+
+    def _spawn(self):
+        worker = _Worker(self)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.abspath(path)
+                                             for path in sys.path])
+        self.reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable, '-c', 'from twisted.fats.processes import '
+             '_workerMain; _workerMain()'],
+            env, childFDs={0: 'w', 1: 1, 2: 2, 3: 'r'})
+        self._workers.add(worker)
+        self._alive.add(worker)
+        self._idle.append(worker)
+
+    def _shutdown(self):
+        self._shutdownTrigger = None
+        return self.stop()
+
+    def stop(self):
+        """
+        Kill the workers and fail the pending tasks.
+
+        @return: deferred fired when the workers have exited.
+        """
+        if self._shutdownTrigger is not None:
+            self.reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        self.started = False
+        self._workers.clear()
+        self._idle = []
+        self._queue.clear()
+        ended = []
+        for worker in list(self._alive):
+            ended.append(worker.ended)
+            worker.kill()
+        for key in self._running.keys():
+            df = self._release(key)
+            df.errback(defer.CancelledError('process pool stopped'))
+        return defer.DeferredList(ended)
+
+    def _release(self, key):
+        """
+        Forget the finished task and free its place in the queue.
+
+        @return: deferred of the task, C{None} when it is already released.
+        """
+        entry = self._running.pop(key, None)
+        if entry is None:
+            return None
+        df, timer, worker, queuedAt = entry
+        if timer is not None and timer.active():
+            timer.cancel()
+        self.pending -= 1
+        return df
+
+    def _dispatch(self):
+        while self._idle and self._queue:
+            key, payload = self._queue.popleft()
+            worker = self._idle.pop()
+            entry = self._running[key]
+            self._running[key] = entry[:2] + (worker,) + entry[3:]
+            worker.run(key, payload)
+
+    def _replace(self, worker):
+        """
+        Drop the worker from the pool and spawn the new one.
+        """
+        self._workers.discard(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+        if self.started:
+            self._spawn()
+
+    def _finished(self, worker, key, result):
+        if worker not in self._workers:
+            # Killed by the timeout or by the stop, the task is released.
+            return
+        if self.maxTasks and worker.tasks >= self.maxTasks:
+            self.recycled += 1
+            worker.retire()
+            self._replace(worker)
+        else:
+            self._idle.append(worker)
+        entry = self._running.get(key)
+        df = self._release(key)
+        if df is not None:
+            queuedAt = entry[3]
+            success, value, startedAt, finishedAt = cPickle.loads(result)
+            wait, run = max(startedAt - queuedAt, 0), finishedAt - startedAt
+            self.totalWait += wait
+            self.totalRun += run
+            self.maxWait = max(self.maxWait, wait)
+            self.maxRun = max(self.maxRun, run)
+            if success:
+                self.completed += 1
+                df.callback(value)
+            else:
+                self.failed += 1
+                df.errback(TaskError(*value))
+        self._dispatch()
+
+    def _exited(self, worker, reason):
+        """
+        Fail the task of the dead worker and replace it.
+        """
+        self._alive.discard(worker)
+        if worker not in self._workers:
+            return
+        log.msg('Process pool worker exited: %s' % reason.getErrorMessage())
+        self._replace(worker)
+        if worker.key is not None:
+            df = self._release(worker.key)
+            if df is not None:
+                self.failed += 1
+                df.errback(TaskError('WorkerExited',
+                                     reason.getErrorMessage(), ''))
+        self._dispatch()
+
+    def _timedOut(self, key, name):
+        entry = self._running.get(key)
+        if entry is None:
+            return
+        worker = entry[2]
+        self._release(key)
+        self.timedOut += 1
+        if worker is None:
+            for index, (queued, payload) in enumerate(self._queue):
+                if queued is key:
+                    del self._queue[index]
+                    break
+        else:
+            # The worker can't be interrupted, replace it.
+            worker.key = None
+            worker.kill()
+            self._replace(worker)
+            self._dispatch()
+        entry[0].errback(AGICommandTimeout(name))
+
+    def stats(self):
+        """
+        @return: dictionary of the pool metrics. Queue wait and execution
+            time are the seconds per finished task.
+        """
+        finished = self.completed + self.failed
+        return {'processes': self.processes,
+                'pending': self.pending,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'timedOut': self.timedOut,
+                'recycled': self.recycled,
+                'averageWait': finished and self.totalWait / finished,
+                'averageRun': finished and self.totalRun / finished,
+                'maxWait': self.maxWait,
+                'maxRun': self.maxRun}
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run the task in the worker process.
+
+        @param timeout: keyword only, seconds since now after which the
+            deferred fails with L{AGICommandTimeout}, the L{timeout} by
+            default. The worker running the task is killed and replaced.
+        @return: deferred result of the task, fails with L{TaskError} when
+            the task raises, its result can't be pickled or its worker dies.
+        """
+        timeout = kwargs.pop('timeout', self.timeout)
+        if self.pending >= self.processes + self.maxQueue:
+            self.rejected += 1
+            return defer.fail(TaskQueueFull(self.pending))
+        try:
+            payload = cPickle.dumps((func, args, kwargs),
+                                    cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return defer.fail()
+
+        self.start()
+        self.pending += 1
+        df = defer.Deferred()
+        key = object()
+        timer = None
+        if timeout is not None:
+            timer = getWheel(self.reactor).callLater(
+                timeout, self._timedOut, key,
+                getattr(func, '__name__', 'task'))
+        self._running[key] = df, timer, None, time.time()
+        self._queue.append((key, payload))
+        self._dispatch()
+        return df
+
+
+_pool = None
+
+
+def getProcessPool():
+    """
+    @return: L{ProcessPool} shared by the call handlers.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPool()
+    return _pool
+
+
+def deferToProcess(func, *args, **kwargs):
+    """
+    Run the task in the shared L{ProcessPool}.
+
+    @return: deferred result of the task.
+    """
+    return getProcessPool().submit(func, *args, **kwargs)
+
+
+__all__ = ['ProcessPool', 'TaskError', 'getProcessPool', 'deferToProcess']
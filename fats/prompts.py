@@ -0,0 +1,252 @@
+# -*- test-case-name: twisted.fats.test.test_prompts -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Catalog of the prompt files
+
+API Stability: unstable
+
+The C{STREAM FILE} of the missing prompt costs the round trip which ends
+with L{FailureOnOpen}, and usually one more with the prompt of the fallback
+language. The L{PromptCatalog} is built once at the start from the sounds
+directory of the Asterisk (or from the manifest when the sounds are on the
+other host), and the L{FastAGIProtocol} with the catalog resolves the
+language fallback locally and fails the missing prompt without sending
+anything. The absolute paths outside the sounds directory, like the
+voicemail greetings or the recordings, are not indexed and are sent as
+they are::
+
+    FastAGIProtocol.prompts = PromptCatalog.fromDirectory(
+        '/var/lib/asterisk/sounds')
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import os, re, struct
+
+# Bytes per second of the raw formats, the durations are computed from the
+# file size.
+RAW_FORMATS = {'ulaw': 8000, 'alaw': 8000, 'al': 8000, 'ul': 8000,
+               'pcm': 8000, 'sln': 16000, 'raw': 16000, 'sln16': 32000,
+               'g722': 8000, 'g729': 1000, 'gsm': 1650}
+FORMATS = frozenset(RAW_FORMATS) | frozenset(['wav', 'WAV', 'wav49', 'g723',
+                                              'g726', 'ilbc', 'ogg',
+                                              'speex', 'h263', 'h264'])
+
+_LANGUAGE = re.compile(r'^[a-z]{2}(_[A-Za-z]{2})?$')
+
+
+def wavDuration(header, size):
+    """
+    @param header: first bytes of the RIFF WAVE file.
+    @param size: size of the file.
+    @return: seconds of the sound or C{None} for the unknown header.
+    """
+    if header[:4] != 'RIFF' or header[8:12] != 'WAVE':
+        return None
+    byteRate = dataSize = None
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk, length = struct.unpack('<4sI', header[offset:offset + 8])
+        if chunk == 'fmt ':
+            byteRate = struct.unpack('<I', header[offset + 16:offset + 20])[0]
+        elif chunk == 'data':
+            dataSize = min(length, size - offset - 8)
+            break
+        offset += 8 + length + (length & 1)
+    if not byteRate or dataSize is None:
+        return None
+    return float(dataSize) / byteRate
+
+
+def fileDuration(path, format):
+    """
+    @return: seconds of the sound file, C{None} for the formats without
+        the fixed bit rate.
+    """
+    size = os.path.getsize(path)
+    if format in RAW_FORMATS:
+        return float(size) / RAW_FORMATS[format]
+    if format in ('wav', 'WAV'):
+        sound = open(path, 'rb')
+        try:
+            return wavDuration(sound.read(256), size)
+        finally:
+            sound.close()
+    return None
+
+
+class PromptCatalog(object):
+    """
+    Index of the prompts by the name and the language.
+
+    The prompt path relative to the sounds directory starts with the
+    language directory (C{ru/digits/1.gsm}) or has none (C{digits/1.gsm},
+    the prompt of the default sounds).
+
+    @ivar prompts: dictionary of the dictionaries of the formats by the
+        language by the prompt name, the language of the default sounds is
+        C{''}. The format sets are shared between the prompts.
+    @ivar durations: dictionary of the seconds by C{(language, name)}.
+    @ivar defaultLanguage: language tried after the language of the
+        channel and before the default sounds.
+    @ivar root: absolute path of the sounds directory, the absolute prompt
+        paths under it are checked by the catalog, the others (the
+        voicemail greetings, the recordings) are sent unchanged.
+    """
+
+    def __init__(self, defaultLanguage='en', root=None):
+        self.prompts = {}
+        self.durations = {}
+        self.defaultLanguage = defaultLanguage
+        if root is not None:
+            root = os.path.abspath(root).rstrip('/')
+        self.root = root
+        self._formats = {}
+
+    def __len__(self):
+        return len(self.prompts)
+
+    def add(self, language, name, format, duration=None):
+        """
+        Index the prompt file.
+        """
+        name = intern(name)
+        languages = self.prompts.setdefault(name, {})
+        formats = languages.get(language, frozenset()) | frozenset([format])
+        languages[intern(language)] = self._formats.setdefault(formats,
+                                                                formats)
+        if duration is not None:
+            self.durations[language, name] = duration
+
+    def addPath(self, path, duration=None):
+        """
+        Index the prompt by its path relative to the sounds directory.
+
+        @return: whether the path is the known sound format.
+        """
+        base, format = os.path.splitext(path.replace(os.sep, '/'))
+        format = format[1:]
+        if format not in FORMATS:
+            return False
+        language = ''
+        head, slash, tail = base.partition('/')
+        if slash and _LANGUAGE.match(head):
+            language, base = head, tail
+        self.add(language, base, format, duration)
+        return True
+
+    def languages(self, language):
+        """
+        @return: languages tried for the channel language, like
+            C{['en_GB', 'en', '']}.
+        """
+        chain = []
+        for candidate in (language, language and language.split('_')[0],
+                          self.defaultLanguage, ''):
+            if candidate is not None and candidate not in chain:
+                chain.append(candidate)
+        return chain
+
+    def _contains(self, path):
+        """
+        @return: whether the prompt path relative to the sounds directory,
+            with its language directory, is indexed.
+        """
+        language = ''
+        head, slash, tail = path.partition('/')
+        if slash and _LANGUAGE.match(head):
+            language, path = head, tail
+        return language in self.prompts.get(path, ())
+
+    def resolve(self, name, language):
+        """
+        @return: name of the prompt to send for the channel language, with
+            the language directory when the fallback language is found, or
+            C{None} for the missing prompt. The absolute path outside the
+            L{root} is returned unchanged, the one under it is checked
+            as is, without the language fallback.
+        """
+        if name.startswith('/'):
+            if self.root is None or not name.startswith(self.root + '/'):
+                return name
+            if self._contains(name[len(self.root) + 1:]):
+                return name
+            return None
+        languages = self.prompts.get(name)
+        if languages is None:
+            return None
+        for candidate in self.languages(language):
+            if candidate in languages:
+                if candidate == language or not candidate:
+                    return name
+                return '%s/%s' % (candidate, name)
+        return None
+
+    def formats(self, name, language):
+        """
+        @return: formats of the prompt in the first language found.
+        """
+        languages = self.prompts.get(name, {})
+        for candidate in self.languages(language):
+            if candidate in languages:
+                return languages[candidate]
+        return frozenset()
+
+    def duration(self, name, language):
+        """
+        @return: seconds of the prompt in the first language found, C{None}
+            when it is not known.
+        """
+        languages = self.prompts.get(name, {})
+        for candidate in self.languages(language):
+            if candidate in languages:
+                return self.durations.get((candidate, name))
+        return None
+
+    @classmethod
+    def fromDirectory(cls, path, durations=False, defaultLanguage='en'):
+        """
+        Index the sounds directory.
+
+        @param durations: whether to read the durations of the files.
+        @return: L{PromptCatalog}.
+        """
+        catalog = cls(defaultLanguage, path)
+        for directory, dirs, files in os.walk(path):
+            relative = os.path.relpath(directory, path)
+            for filename in files:
+                if relative != os.curdir:
+                    filename = os.path.join(relative, filename)
+                duration = None
+                if durations:
+                    format = os.path.splitext(filename)[1][1:]
+                    if format in FORMATS:
+                        duration = fileDuration(os.path.join(path, filename),
+                                                format)
+                catalog.addPath(filename, duration)
+        return catalog
+
+    @classmethod
+    def fromManifest(cls, lines, defaultLanguage='en', root=None):
+        """
+        Index the manifest, the lines with the path relative to the sounds
+        directory and the optional seconds of the sound.
+
+        @param root: path of the sounds directory on the Asterisk host.
+        @return: L{PromptCatalog}.
+        """
+        catalog = cls(defaultLanguage, root)
+        for line in lines:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            duration = len(fields) > 1 and float(fields[1]) or None
+            catalog.addPath(fields[0], duration)
+        return catalog
+
+
+__all__ = ['PromptCatalog', 'FORMATS', 'RAW_FORMATS', 'fileDuration',
+           'wavDuration']
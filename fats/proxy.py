@@ -0,0 +1,434 @@
+# -*- test-case-name: twisted.fats.test.test_proxy -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""FastAGI load balancing proxy
+
+API Stability: unstable
+
+The Asterisk points at the one C{agi://} endpoint, the L{ProxyFactory}
+spreads the calls over the pool of the FastAGI backends. The proxy reads
+the environment block with the L{Framer}, picks the backend by the policy
+of the L{BackendPool}, replays the block to it and from then on just
+passes the bytes between both connections, with the flow control, without
+looking at the lines::
+
+    pool = BackendPool([Backend('10.0.0.1'), Backend('10.0.0.2')],
+                       policy=byPath({'queue': ['10.0.0.2:4573']}))
+    reactor.listenTCP(4573, ProxyFactory(pool))
+
+The policies are L{leastOutstanding}, L{accountcodeHash} and L{byPath}.
+Until the backend sends its first command the call fails over to the next
+backend: when the connection is refused or timed out, or reset before the
+handler started. The failed backend is marked down and is taken back by
+the health check which connects to it every L{BackendPool.checkInterval}.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import zlib
+
+from twisted.internet import error, protocol, task
+from twisted.python import log
+
+from twisted.fats.agi import parseURL
+from twisted.fats.environment import AGIEnvironment
+from twisted.fats.framing import Framer
+
+
+class Backend(object):
+    """
+    FastAGI server of the pool and its statistics.
+
+    @ivar host: host of the server.
+    @ivar port: port of the server.
+    @ivar name: name of the backend in the policies and the statistics,
+        C{host:port} by default.
+    @ivar healthy: whether the backend takes the calls.
+    @ivar active: number of the proxied calls.
+    @ivar calls: number of the calls sent to the backend.
+    @ivar failures: number of the failed connections.
+    @ivar connectTime: average seconds of the connection.
+    @ivar responseTime: average seconds from the environment block to the
+        first command, the latency of the handler start.
+    """
+    smoothing = 0.2
+
+    def __init__(self, host, port=4573, name=None):
+        self.host = host
+        self.port = port
+        self.name = name or '%s:%d' % (host, port)
+        self.healthy = True
+        self.active = self.calls = self.failures = 0
+        self.connectTime = self.responseTime = None
+        self._checking = False
+
+    def __repr__(self):
+        return '<Backend %s>' % self.name
+
+    def _average(self, average, seconds):
+        if average is None:
+            return seconds
+        return average + (seconds - average) * self.smoothing
+
+    def connected(self, seconds):
+        self.connectTime = self._average(self.connectTime, seconds)
+
+    def responded(self, seconds):
+        self.responseTime = self._average(self.responseTime, seconds)
+
+    def stats(self):
+        return {'healthy': self.healthy,
+                'active': self.active,
+                'calls': self.calls,
+                'failures': self.failures,
+                'connectTime': self.connectTime,
+                'responseTime': self.responseTime}
+
+
+def leastOutstanding(backends, env, url):
+    """
+    @return: backend with the least proxied calls.
+    """
+    return min(backends, key=lambda backend: backend.active)
+
+
+def accountcodeHash(backends, env, url):
+    """
+    @return: backend of the accountcode by the rendezvous hash, which moves
+        only the accountcodes of the failed backend; the least loaded one
+        for the calls without the accountcode.
+    """
+    accountcode = env.get('agi_accountcode')
+    if not accountcode:
+        return leastOutstanding(backends, env, url)
+    return max(backends, key=lambda backend:
+               zlib.crc32('%s/%s' % (backend.name, accountcode)))
+
+
+def byPath(table, fallback=leastOutstanding):
+    """
+    @param table: dictionary of the backend names by the path prefix, the
+        string of the C{/} separated segments.
+    @param fallback: policy of the other paths, also picks one of the
+        backends of the path.
+    @return: policy which sends the calls of the longest matching prefix
+        to its backends.
+    """
+    prefixes = dict([(tuple([part for part in prefix.split('/') if part]),
+                      frozenset(names)) for prefix, names in table.items()])
+    def policy(backends, env, url):
+        path = url is not None and url.path or ()
+        for length in range(len(path), -1, -1):
+            names = prefixes.get(path[:length])
+            if names is not None:
+                chosen = [backend for backend in backends
+                          if backend.name in names]
+                if chosen:
+                    return fallback(chosen, env, url)
+                break
+        return fallback(backends, env, url)
+    return policy
+
+
+class _Check(protocol.Protocol):
+
+    def connectionMade(self):
+        self.transport.loseConnection()
+
+
+class BackendPool(object):
+    """
+    Backends of the proxy.
+
+    @ivar backends: list of the L{Backend}s.
+    @ivar policy: callable which picks one of the healthy backends, called
+        with the list of them, the L{AGIEnvironment} and the L{URL} of the
+        call.
+    @ivar connectTimeout: seconds to connect to the backend.
+    @ivar checkInterval: seconds between the health checks of the
+        backends.
+    @ivar unavailable: number of the calls which no backend took.
+    @ivar failovers: number of the calls sent to the next backend.
+    """
+
+    def __init__(self, backends, policy=leastOutstanding, connectTimeout=2,
+                 checkInterval=5, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.backends = list(backends)
+        self.policy = policy
+        self.connectTimeout = connectTimeout
+        self.checkInterval = checkInterval
+        self.unavailable = self.failovers = 0
+        self._checks = self._shutdownTrigger = None
+
+    def choose(self, env, url, exclude=()):
+        """
+        @param exclude: backends already tried by the call.
+        @return: L{Backend} of the call, or C{None} when no healthy backend
+            is left.
+        """
+        if self._checks is None:
+            self.startChecks()
+        backends = [backend for backend in self.backends
+                    if backend.healthy and backend not in exclude]
+        if not backends:
+            return None
+        return self.policy(backends, env, url)
+
+    def markDown(self, backend, reason):
+        if backend.healthy:
+            log.msg('FastAGI backend %s is down: %s' %
+                    (backend.name, reason.getErrorMessage()))
+        backend.healthy = False
+        backend.failures += 1
+
+    def startChecks(self):
+        """
+        Start the periodic health checks of the backends.
+        """
+        self._checks = task.LoopingCall(self.check)
+        self._checks.clock = self.reactor
+        self._checks.start(self.checkInterval, now=False)
+        if self._shutdownTrigger is None:
+            self._shutdownTrigger = self.reactor.addSystemEventTrigger(
+                'before', 'shutdown', self._shutdown)
+
+    def _shutdown(self):
+        self._shutdownTrigger = None
+        self.stop()
+
+    def stop(self):
+        """
+        Stop the health checks.
+        """
+        if self._checks is not None and self._checks.running:
+            self._checks.stop()
+
+    def check(self):
+        """
+        Connect to every backend, mark it up or down by the result.
+        """
+        for backend in self.backends:
+            if backend._checking:
+                continue
+            backend._checking = True
+            creator = protocol.ClientCreator(self.reactor, _Check)
+            creator.connectTCP(backend.host, backend.port,
+                               self.connectTimeout).addCallbacks(
+                self._checked, self._checkFailed, (backend,), None,
+                (backend,))
+
+    def _checked(self, result, backend):
+        backend._checking = False
+        if not backend.healthy:
+            log.msg('FastAGI backend %s is up' % backend.name)
+        backend.healthy = True
+
+    def _checkFailed(self, reason, backend):
+        backend._checking = False
+        if backend.healthy:
+            log.msg('FastAGI backend %s failed the check: %s' %
+                    (backend.name, reason.getErrorMessage()))
+        backend.healthy = False
+
+    def stats(self):
+        """
+        @return: dictionary of the backend statistics by their names, the
+            numbers of the failovers and of the calls no backend took.
+        """
+        return {'backends': dict([(backend.name, backend.stats())
+                                  for backend in self.backends]),
+                'failovers': self.failovers,
+                'unavailable': self.unavailable}
+
+
+class _BackendProtocol(protocol.Protocol):
+    """
+    Connection of the proxied call to the backend.
+    """
+
+    def connectionMade(self):
+        self.proxy.backendConnected(self)
+
+    def dataReceived(self, data):
+        self.proxy.backendDataReceived(data)
+
+    def connectionLost(self, reason):
+        self.proxy.backendConnectionLost(reason)
+
+
+class _BackendFactory(protocol.ClientFactory):
+    protocol = _BackendProtocol
+    noisy = False
+
+    def __init__(self, proxy, backend):
+        self.proxy = proxy
+        self.backend = backend
+
+    def buildProtocol(self, addr):
+        peer = protocol.ClientFactory.buildProtocol(self, addr)
+        peer.proxy = self.proxy
+        return peer
+
+    def clientConnectionFailed(self, connector, reason):
+        self.proxy.backendConnectionFailed(reason)
+
+
+class ProxyProtocol(protocol.Protocol):
+    """
+    Call from the Asterisk proxied to the backend.
+
+    @ivar block: raw environment block.
+    @ivar env: L{AGIEnvironment} of the call.
+    @ivar backend: L{Backend} of the current attempt.
+    @ivar peer: connection to the backend.
+    @ivar started: whether the backend sent the first command, the call
+        does not fail over then.
+    @ivar tried: backends tried by the call.
+    """
+    delimiter = '\n'
+    MAX_LENGTH = 16384
+    block = env = backend = peer = connector = None
+    started = False
+
+    def connectionMade(self):
+        self.framer = Framer(self.delimiter * 2)
+        self.pending = []
+        self.tried = []
+
+    def dataReceived(self, data):
+        peer = self.peer
+        if peer is not None:
+            peer.transport.write(data)
+        elif self.block is not None:
+            self.pending.append(data)
+        else:
+            self._readEnv(data)
+
+    def _readEnv(self, data):
+        framer = self.framer
+        if not len(framer) and data.startswith(self.delimiter):
+            # Empty environment block.
+            frame, rest = '', data[len(self.delimiter):]
+        else:
+            framer.extend(data)
+            frame = framer.next()
+            if frame is None:
+                if len(framer) > self.MAX_LENGTH:
+                    self.transport.loseConnection()
+                return
+            frame = frame.tobytes()
+            rest = str(framer.buffer[framer.start:])
+        self.framer = None
+        self.block = frame
+        if rest:
+            self.pending.append(rest)
+        self.env = AGIEnvironment(frame)
+        self._connect()
+
+    def _connect(self):
+        pool = self.factory.pool
+        url = None
+        request = self.env.get('agi_request')
+        if request:
+            url = parseURL(request)
+        backend = pool.choose(self.env, url, self.tried)
+        if backend is None:
+            pool.unavailable += 1
+            log.msg('No FastAGI backend for %s' % request)
+            self.transport.loseConnection()
+            return
+        if self.tried:
+            pool.failovers += 1
+        self.tried.append(backend)
+        self.backend = backend
+        backend.active += 1
+        backend.calls += 1
+        self._attempted = pool.reactor.seconds()
+        self.connector = pool.reactor.connectTCP(
+            backend.host, backend.port, _BackendFactory(self, backend),
+            pool.connectTimeout)
+
+    def _release(self):
+        backend, self.backend = self.backend, None
+        if backend is not None:
+            backend.active -= 1
+        return backend
+
+    def backendConnected(self, peer):
+        if self.transport.disconnecting or self.backend is None:
+            peer.transport.loseConnection()
+            return
+        now = self.factory.pool.reactor.seconds()
+        self.backend.connected(now - self._attempted)
+        self._attempted = now
+        self.peer = peer
+        pending, self.pending = self.pending, []
+        peer.transport.write(self.block + self.delimiter * 2 +
+                             ''.join(pending))
+        peer.transport.registerProducer(self.transport, True)
+        self.transport.registerProducer(peer.transport, True)
+
+    def backendDataReceived(self, data):
+        if not self.started:
+            self.started = True
+            self.backend.responded(self.factory.pool.reactor.seconds()
+                                   - self._attempted)
+        self.transport.write(data)
+
+    def backendConnectionFailed(self, reason):
+        backend = self._release()
+        if backend is None:
+            return
+        self.factory.pool.markDown(backend, reason)
+        self._connect()
+
+    def backendConnectionLost(self, reason):
+        if self.peer is not None:
+            self.peer = None
+            self.transport.unregisterProducer()
+        backend = self._release()
+        if backend is None:
+            return
+        if not self.started and not reason.check(error.ConnectionDone):
+            # Reset before the handler started, the call is not served.
+            self.factory.pool.markDown(backend, reason)
+            self._connect()
+            return
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        peer = self.peer
+        self._release()
+        if peer is not None:
+            self.peer = None
+            peer.transport.loseConnection()
+        elif self.connector is not None:
+            self.connector.disconnect()
+
+
+class ProxyFactory(protocol.ServerFactory):
+    """
+    FastAGI proxy server factory.
+
+    @ivar pool: L{BackendPool} of the proxied calls.
+    """
+    protocol = ProxyProtocol
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def stopFactory(self):
+        self.pool.stop()
+
+    def stats(self):
+        return self.pool.stats()
+
+
+__all__ = ['ProxyFactory', 'ProxyProtocol', 'BackendPool', 'Backend',
+           'leastOutstanding', 'accountcodeHash', 'byPath']
@@ -0,0 +1,238 @@
+# -*- test-case-name: twisted.fats.test.test_router -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Dispatch of the calls to the handlers by the agi_request path
+
+API Stability: unstable
+
+The L{Router} of the L{FastAGIFactory} picks the handler class of the call
+by the L{URL.path} of its agi_request. The routes are compiled to the trie
+of the path segments, so the dispatch costs one dictionary lookup per
+segment whatever the number of the routes::
+
+    router = Router(default=NotFound)
+    router.add('ivr/main', MainMenu)
+    router.add('queue/{queue}', QueueHandler)
+    router.add('queue/{queue}/stats', QueueStats)
+    router.add('files/*path', FileHandler)
+    factory = FastAGIFactory()
+    factory.router = router
+
+The segment C{{name}} captures one segment, C{*name} (the last one)
+captures the rest of the path; the captured values are in the
+L{FastAGIProtocol.routeArgs} of the call. The literal segment is preferred
+over the capture at every level, without the backtracking: with the routes
+above the C{queue/stats/stats} path goes to C{QueueStats}, but nothing
+matches C{ivr/sales}, the C{ivr} branch has no capture.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import urllib
+
+from twisted.fats.agi import getURLCache
+from twisted.fats.errors import AGIHangup
+
+
+class Route(object):
+    """
+    Handler of the path pattern and its statistics.
+
+    @ivar pattern: tuple of the pattern segments.
+    @ivar handler: call handler class.
+    @ivar name: name of the route in the L{Router.stats}.
+    @ivar names: names of the captured segments, in order.
+    @ivar calls: number of the dispatched calls.
+    @ivar active: number of the running handlers.
+    @ivar hangups: number of the handlers stopped by the hangup.
+    @ivar failures: number of the handlers failed otherwise.
+    @ivar seconds: total seconds the finished handlers ran.
+    """
+
+    def __init__(self, pattern, handler, name, names):
+        self.pattern = pattern
+        self.handler = handler
+        self.name = name
+        self.names = names
+        self.calls = self.active = self.hangups = self.failures = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return '<Route %s -> %r>' % (self.name, self.handler)
+
+    def stats(self):
+        finished = self.calls - self.active
+        return {'calls': self.calls,
+                'active': self.active,
+                'hangups': self.hangups,
+                'failures': self.failures,
+                'averageTime': finished and self.seconds / finished}
+
+
+class _Node(object):
+    """
+    Trie node of one path segment.
+    """
+    __slots__ = ('children', 'capture', 'rest', 'route')
+
+    def __init__(self):
+        self.children = {}
+        self.capture = self.rest = self.route = None
+
+
+def _segments(pattern):
+    if isinstance(pattern, basestring):
+        pattern = pattern.split('/')
+    return tuple([segment for segment in pattern if segment])
+
+
+class Router(object):
+    """
+    Path trie of the call handlers.
+
+    @ivar default: handler class of the calls matching no route, C{None}
+        for the handler of the factory.
+    @ivar routes: list of the L{Route}s in the order of addition.
+    @ivar unmatched: number of the calls matching no route.
+    """
+
+    def __init__(self, routes=(), default=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.default = default
+        self.routes = []
+        self.unmatched = 0
+        self._root = _Node()
+        for route in routes:
+            self.add(*route)
+
+    def add(self, pattern, handler, name=None):
+        """
+        Add the route of the pattern.
+
+        @param pattern: path pattern, the string of the C{/} separated
+            segments or the tuple of the segments.
+        @param name: name of the route, the pattern by default.
+        @return: the L{Route}.
+        @raise ValueError: on the invalid or duplicated pattern.
+        """
+        segments = _segments(pattern)
+        node = self._root
+        names = []
+        for index, segment in enumerate(segments):
+            if segment.startswith('*'):
+                if index != len(segments) - 1:
+                    raise ValueError('%s: the capture of the rest must be '
+                                     'the last segment' % (pattern,))
+                names.append(segment[1:])
+                break
+            if segment.startswith('{') and segment.endswith('}'):
+                names.append(segment[1:-1])
+                if node.capture is None:
+                    node.capture = _Node()
+                node = node.capture
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _Node()
+                node = child
+        rest = bool(segments) and segments[-1].startswith('*')
+        if rest:
+            defined = node.rest
+        else:
+            defined = node.route
+        if defined is not None:
+            raise ValueError('Route %s is already defined' % (pattern,))
+        route = Route(segments, handler, name or '/'.join(segments), names)
+        if rest:
+            node.rest = route
+        else:
+            node.route = route
+        self.routes.append(route)
+        return route
+
+    def match(self, path):
+        """
+        @param path: tuple of the path segments, like L{URL.path}.
+        @return: the matching L{Route} and the dictionary of its captured
+            segments, or C{(None, None)}.
+        """
+        node = self._root
+        values = []
+        route = None
+        for index, segment in enumerate(path):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.capture
+                if child is None:
+                    route = node.rest
+                    if route is None:
+                        return None, None
+                    values.append('/'.join(path[index:]))
+                    break
+                values.append(segment)
+            node = child
+        else:
+            route = node.route
+            if route is None:
+                route = node.rest
+                if route is None:
+                    return None, None
+                values.append('')
+        return route, dict(zip(route.names, map(urllib.unquote, values)))
+
+    def dispatch(self, agi):
+        """
+        Find the route of the call and set its L{FastAGIProtocol.route} and
+        L{FastAGIProtocol.routeArgs}.
+
+        @return: handler class of the call, C{None} for the handler of the
+            factory.
+        """
+        path = agi.url is not None and agi.url.path or ()
+        route, args = self.match(path)
+        if route is None:
+            self.unmatched += 1
+            return self.default
+        agi.route = route
+        agi.routeArgs = args
+        route.calls += 1
+        route.active += 1
+        return route.handler
+
+    def track(self, route, result):
+        """
+        Account the handler result of the route.
+
+        @param result: deferred of the handler.
+        @return: the same deferred.
+        """
+        started = self.reactor.seconds()
+        def finished(outcome):
+            route.active -= 1
+            route.seconds += self.reactor.seconds() - started
+            if hasattr(outcome, 'check'):
+                if outcome.check(AGIHangup):
+                    route.hangups += 1
+                else:
+                    route.failures += 1
+            return outcome
+        return result.addBoth(finished)
+
+    def stats(self):
+        """
+        @return: dictionary of the routes statistics by their name, the
+            number of the unmatched calls and the statistics of the parsed
+            URL cache.
+        """
+        return {'routes': dict([(route.name, route.stats())
+                                for route in self.routes]),
+                'unmatched': self.unmatched,
+                'urls': getURLCache().stats()}
+
+
+__all__ = ['Router', 'Route']
@@ -0,0 +1,422 @@
+# -*- test-case-name: twisted.fats.test.test_say -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Local rendering of the SAY commands into the prompt lists
+
+API Stability: unstable
+
+Every C{SAY NUMBER}, C{SAY DATE} or C{SAY TIME} is the AGI round trip, so
+the sentence like "you have 3 messages, the last one at 14:05" takes four
+or five of them. The renderers here build the same prompt files the
+Asterisk C{say.c} plays for the language, and the L{Sentence} plays the
+whole sentence by the single L{FastAGIProtocol.playlist}::
+
+    Sentence(self.agi).file('vm-youhave').number(3).file('vm-messages'
+        ).file('vm-received').time(lastTime).play()
+
+The languages without the renderer here are said by the Asterisk, the
+L{Sentence} sends their C{SAY} commands between the playlists, since the
+C{say.c} has its own rules for many of them.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import time, datetime
+
+from twisted.fats.agi import PlaylistResult
+from twisted.fats.cache import LRUCache
+
+# Format of the AGI SAY DATETIME without the format argument.
+DATETIME_FORMAT = "ABdY 'digits/at' IMp"
+
+
+def _timeTuple(value):
+    """
+    @param value: Unix time, C{datetime.datetime} or C{time.struct_time}.
+    @return: local C{time.struct_time}.
+    """
+    if isinstance(value, (int, long, float)):
+        return time.localtime(value)
+    if isinstance(value, datetime.datetime):
+        return value.timetuple()
+    return value
+
+
+def _weekday(tm):
+    """
+    @return: day of the week counted from Sunday like the C{tm_wday} of C.
+    """
+    return (tm.tm_wday + 1) % 7
+
+
+class EnglishRenderer(object):
+    """
+    Prompt files of the C{en} rules of the Asterisk C{say.c}.
+    """
+
+    def number(self, num, gender=None):
+        """
+        @return: files of C{ast_say_number_full_en}.
+        @raise ValueError: for the numbers the Asterisk can't say.
+        """
+        if num == 0:
+            return ['digits/0']
+        files = []
+        if num < 0:
+            files.append('digits/minus')
+            num = -num
+        if num >= 1000000000:
+            raise ValueError('Number is too big to say: %r' % num)
+        if num >= 1000000:
+            files.extend(self.number(num // 1000000))
+            files.append('digits/million')
+            num %= 1000000
+        if num >= 1000:
+            files.extend(self.number(num // 1000))
+            files.append('digits/thousand')
+            num %= 1000
+        if num >= 100:
+            files.extend(['digits/%d' % (num // 100), 'digits/hundred'])
+            num %= 100
+        if num >= 20:
+            files.append('digits/%d' % (num - num % 10))
+            num %= 10
+        if num:
+            files.append('digits/%d' % num)
+        return files
+
+    def digits(self, digits):
+        """
+        @return: files of C{ast_say_digit_str_full}.
+        """
+        names = {'*': 'digits/star', '#': 'digits/pound',
+                 '-': 'digits/minus'}
+        files = []
+        for digit in str(digits):
+            if digit.isdigit():
+                files.append('digits/%s' % digit)
+            elif digit in names:
+                files.append(names[digit])
+        return files
+
+    def date(self, value):
+        """
+        @return: files of C{ast_say_date_en}, used by the C{SAY DATE}.
+        """
+        tm = _timeTuple(value)
+        return (['digits/day-%d' % _weekday(tm), 'digits/mon-%d' %
+                 (tm.tm_mon - 1)] + self.number(tm.tm_mday) +
+                self.number(tm.tm_year))
+
+    def _hour(self, tm):
+        """
+        @return: 12 hour clock hour and whether it is after the noon.
+        """
+        hour = tm.tm_hour
+        if hour == 0:
+            return 12, False
+        if hour < 12:
+            return hour, False
+        if hour == 12:
+            return 12, True
+        return hour - 12, True
+
+    def time(self, value):
+        """
+        @return: files of C{ast_say_time_en}, used by the C{SAY TIME}.
+        """
+        tm = _timeTuple(value)
+        hour, pm = self._hour(tm)
+        files = self.number(hour)
+        if tm.tm_min > 9:
+            files.extend(self.number(tm.tm_min))
+        elif tm.tm_min:
+            files.append('digits/oh')
+            files.extend(self.number(tm.tm_min))
+        else:
+            files.append('digits/oclock')
+        files.append(pm and 'digits/p-m' or 'digits/a-m')
+        return files
+
+    def datetime(self, value, format=DATETIME_FORMAT):
+        """
+        @return: files of C{ast_say_date_with_format_en}, used by the
+            C{SAY DATETIME}, for the C{ABbhdeYIlMpP} format characters and
+            the quoted file names.
+        @raise ValueError: on the other format characters.
+        """
+        tm = _timeTuple(value)
+        files = []
+        index = 0
+        while index < len(format):
+            char = format[index]
+            index += 1
+            if char == "'":
+                end = format.index("'", index)
+                files.append(format[index:end])
+                index = end + 1
+            elif char in 'Aa':
+                files.append('digits/day-%d' % _weekday(tm))
+            elif char in 'Bbh':
+                files.append('digits/mon-%d' % (tm.tm_mon - 1))
+            elif char in 'de':
+                files.append('digits/h-%d' % tm.tm_mday)
+            elif char == 'Y':
+                files.extend(self._year(tm.tm_year))
+            elif char in 'Il':
+                files.append('digits/%d' % self._hour(tm)[0])
+            elif char == 'M':
+                if tm.tm_min == 0:
+                    files.append('digits/oclock')
+                elif tm.tm_min < 10:
+                    files.extend(['digits/oh', 'digits/%d' % tm.tm_min])
+                else:
+                    files.extend(self.number(tm.tm_min))
+            elif char in 'Pp':
+                files.append(tm.tm_hour > 11 and 'digits/p-m' or 'digits/a-m')
+            elif char != ' ':
+                raise ValueError('Unsupported format character: %r' % char)
+        return files
+
+    def _year(self, year):
+        if year >= 2000:
+            return self.number(year)
+        if year <= 1900:
+            return []
+        year -= 1900
+        files = ['digits/19']
+        if year <= 9:
+            files.extend(['digits/oh', 'digits/%d' % year])
+        elif year <= 20:
+            files.append('digits/%d' % year)
+        else:
+            files.append('digits/%d' % (year - year % 10))
+            if year % 10:
+                files.append('digits/%d' % (year % 10))
+        return files
+
+
+def _lastDigits(num):
+    """
+    @return: number which selects the Russian plural form, like the
+        C{get_lastdigits_ru}.
+    """
+    if num < 20:
+        return num
+    if num < 100:
+        return _lastDigits(num % 10)
+    if num < 1000:
+        return _lastDigits(num % 100)
+    return 0
+
+
+class RussianRenderer(EnglishRenderer):
+    """
+    Prompt files of the C{ru} rules of the Asterisk C{say.c}: the numbers
+    have the genders and the plural forms, the dates and the times follow
+    the English rules.
+    """
+
+    def number(self, num, gender=None):
+        """
+        @param gender: C{'f'} or C{'n'} for the feminine or the neuter
+            one and two.
+        @return: files of C{ast_say_number_full_ru}.
+        @raise ValueError: for the numbers the Asterisk can't say.
+        """
+        if num == 0:
+            return ['digits/0']
+        files = []
+        if num < 0:
+            files.append('digits/minus')
+            num = -num
+        if num >= 1000000000:
+            raise ValueError('Number is too big to say: %r' % num)
+        if num >= 1000000:
+            last = _lastDigits(num // 1000000)
+            files.extend(self.number(num // 1000000))
+            if last == 1:
+                files.append('digits/million')
+            elif 1 < last < 5:
+                files.append('digits/million-a')
+            else:
+                files.append('digits/millions')
+            num %= 1000000
+        if num >= 1000:
+            last = _lastDigits(num // 1000)
+            files.extend(self.number(num // 1000, last < 3 and 'f' or None))
+            if last == 1:
+                files.append('digits/thousand')
+            elif 1 < last < 5:
+                files.append('digits/thousands-i')
+            else:
+                files.append('digits/thousands')
+            num %= 1000
+        if num >= 100:
+            files.append('digits/%d' % (num - num % 100))
+            num %= 100
+        if num >= 20:
+            files.append('digits/%d' % (num - num % 10))
+            num %= 10
+        if num:
+            if gender and num < 3:
+                files.append('digits/%d%s' % (num, gender))
+            else:
+                files.append('digits/%d' % num)
+        return files
+
+
+RENDERERS = {'en': EnglishRenderer(), 'ru': RussianRenderer()}
+
+_cache = LRUCache(4096)
+
+
+def render(language, kind, *args):
+    """
+    Render the SAY command into the prompt files, memoised in the process
+    wide cache.
+
+    @param language: C{agi_language} of the channel.
+    @param kind: C{'number'}, C{'digits'}, C{'date'}, C{'time'} or
+        C{'datetime'}.
+    @param args: arguments of the renderer method, the times are reduced to
+        the local C{time.struct_time}.
+    @return: tuple of the prompt files with the language independent names,
+        C{None} for the language without the renderer, see L{sayCommand}.
+    """
+    renderer = RENDERERS.get(language)
+    if renderer is None:
+        return None
+    if kind in ('date', 'time', 'datetime'):
+        args = (_timeTuple(args[0]),) + args[1:]
+    key = (language, kind) + args
+    files = _cache.get(key)
+    if files is None:
+        files = tuple(getattr(renderer, kind)(*args))
+        _cache.set(key, files)
+    return files
+
+
+_SAY_METHODS = {'number': 'sayNumber', 'digits': 'sayDigits',
+                'date': 'sayDate', 'time': 'sayTime',
+                'datetime': 'sayDatetime'}
+
+
+def sayCommand(kind, *args):
+    """
+    The SAY command of the Asterisk for the language which L{render} does
+    not know. The gender of the number is left to the Asterisk.
+
+    @param kind: as of the L{render}.
+    @return: name, arguments and keyword arguments of the
+        L{FastAGIProtocol} method.
+    """
+    value = args[0]
+    if kind in ('date', 'time', 'datetime'):
+        if isinstance(value, (int, long)):
+            value = float(value)
+    elif kind == 'number':
+        value = str(value)
+    kwargs = {}
+    if kind == 'datetime' and len(args) > 1 and args[1] != DATETIME_FORMAT:
+        kwargs['format'] = args[1]
+    return _SAY_METHODS[kind], (value,), kwargs
+
+
+class Sentence(object):
+    """
+    Prompt files and the rendered SAY commands played by one playlist.
+
+    Methods return the sentence, so the calls may be chained.
+
+    @ivar agi: L{FastAGIProtocol} of the call.
+    @ivar language: language of the rules, the C{agi_language} of the call
+        by default.
+    @ivar files: prompt files of the sentence, and the L{sayCommand}s of
+        the language without the renderer.
+    """
+
+    def __init__(self, agi, language=None):
+        self.agi = agi
+        if language is None:
+            language = agi.env.get('agi_language') or 'en'
+        self.language = language
+        self.files = []
+
+    def file(self, *filenames):
+        self.files.extend(filenames)
+        return self
+
+    def _say(self, kind, *args):
+        files = render(self.language, kind, *args)
+        if files is None:
+            self.files.append(sayCommand(kind, *args))
+        else:
+            self.files.extend(files)
+        return self
+
+    def number(self, num, gender=None):
+        return self._say('number', num, gender)
+
+    def digits(self, digits):
+        return self._say('digits', str(digits))
+
+    def date(self, value):
+        return self._say('date', value)
+
+    def time(self, value):
+        return self._say('time', value)
+
+    def datetime(self, value, format=DATETIME_FORMAT):
+        return self._say('datetime', value, format)
+
+    def play(self, escapeDigits=''):
+        """
+        Play the files by the L{FastAGIProtocol.playlist}, split by the
+        SAY commands when the language has no renderer.
+
+        @return: deferred L{PlaylistResult}, the index is the one of the
+            interrupted item of the L{files}.
+        """
+        if not [item for item in self.files if isinstance(item, tuple)]:
+            return self.agi.playlist(self.files, escapeDigits)
+        parts = []
+        for index, item in enumerate(self.files):
+            if isinstance(item, tuple):
+                parts.append((index, item))
+            elif parts and isinstance(parts[-1][1], list):
+                parts[-1][1].append(item)
+            else:
+                parts.append((index, [item]))
+
+        def playNext(result, part):
+            if result is not None and result.digit is not None:
+                return result
+            if part == len(parts):
+                return PlaylistResult()
+            index, item = parts[part]
+            if isinstance(item, list):
+                df = self.agi.playlist(item, escapeDigits)
+                def shift(result):
+                    if result.index is not None:
+                        result.index += index
+                    return result
+                df.addCallback(shift)
+            else:
+                name, args, kwargs = item
+                df = getattr(self.agi, name)(*args + (escapeDigits,),
+                                             **kwargs)
+                def said(command):
+                    if command.has_dtmf:
+                        return PlaylistResult(command.result, index)
+                    return PlaylistResult()
+                df.addCallback(said)
+            return df.addCallback(playNext, part + 1)
+        return playNext(None, 0)
+
+
+__all__ = ['EnglishRenderer', 'RussianRenderer', 'RENDERERS', 'render',
+           'sayCommand', 'Sentence', 'DATETIME_FORMAT']
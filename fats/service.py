@@ -11,10 +11,12 @@ API Stability: unstable
 $Id: service.py 24 2008-02-18 12:22:42Z burus $
 """
 
-from twisted.python import log
-from twisted.internet import protocol
+from twisted.python import log, failure
+from twisted.application import internet
+from twisted.internet import protocol, defer, task
 from zope.interface import implements, Interface, Attribute
 from twisted.fats.agi import FastAGIProtocol
+from twisted.fats.errors import AGIHangup, LookupTimeout
 
 
 class IFastAGIFactory(Interface):
@@ -44,44 +46,578 @@ class ICallHandler(Interface):
     def startCall():
         """Start call script
 
-        @return: deferred
+        @return: deferred, or the generator which yields the deferreds of
+            the AGI commands (see L{CoroutineDriver})
         """
 
+    def hangupReceived():
+        """Optional, called when the channel hangs up before the script
+        ends. Pending AGI commands are already failed with L{AGIHangup}, this
+        is the place to stop the other work of the call.
+        """
+
+
+class IBlockingCallHandler(ICallHandler):
+    """Call handler with the synchronous C{startCall}, which is run in the
+    worker thread pool with the blocking proxy of the protocol as C{agi}
+    (see L{twisted.fats.blocking}).
+    """
+    pool = Attribute(
+        """Worker pool of the handler or C{None} for the shared one.
+        """)
+
+    timeout = Attribute(
+        """Seconds the call may take or C{None}.
+        """)
+
+    def startCall():
+        """Run the call script in the worker thread, calling the blocking
+        C{agi} methods.
+
+        @return: result of the call.
+        """
+
+
+class OverlapResult(object):
+    """
+    Result of the L{CallHandler.overlap}.
+
+    @ivar value: result of the lookup.
+    @ivar playback: L{PlaylistResult} of the prompts, its C{digit} is the
+        escape digit which interrupted them.
+    @ivar hidden: seconds of the lookup which passed during the playback.
+    @ivar waited: seconds the lookup was waited for after the playback.
+    """
+    __slots__ = ('value', 'playback', 'hidden', 'waited')
+
+    def __init__(self, value, playback, hidden, waited):
+        self.value = value
+        self.playback = playback
+        self.hidden = hidden
+        self.waited = waited
+
+
+class _Overlap(object):
+    """
+    Lookup run during the playback of the prompts.
+
+    While the lookup is waited for after the playback, the join deferred is
+    kept in the L{FastAGIProtocol.pendingWaits} with the deadline timer, so
+    the hangup or the end of the session fails it like any other wait.
+    """
+
+    def __init__(self, handler, lookup, prompts, escapeDigits, timeout):
+        self.handler = handler
+        self.agi = agi = handler.agi
+        self.clock = agi.wheel.clock
+        self.timeout = timeout
+        self.started = self.clock.seconds()
+        self.lookupTime = self.playbackTime = None
+        self.value = self.playback = None
+        self.deferred = defer.Deferred()
+        self.deferred.addErrback(self._failed)
+        self.lookup = lookup
+        lookup.addBoth(self._lookupDone)
+        agi.playlist(prompts, escapeDigits).addBoth(self._played)
+
+    def _lookupDone(self, result):
+        self.lookupTime = self.clock.seconds()
+        self.value = result
+        if self.playbackTime is not None and not self.deferred.called:
+            self._finish()
+
+    def _played(self, result):
+        self.playbackTime = self.clock.seconds()
+        if self.deferred.called:
+            return
+        if isinstance(result, failure.Failure):
+            self.deferred.errback(result)
+            return
+        self.playback = result
+        if self.lookupTime is not None:
+            self._finish()
+        else:
+            agi = self.agi
+            agi.pendingWaits[self.deferred] = agi.wheel.callLater(
+                self.timeout, self._expired)
+
+    def _expired(self):
+        del self.agi.pendingWaits[self.deferred]
+        self.deferred.errback(LookupTimeout(self.timeout))
+
+    def _failed(self, reason):
+        if self.lookupTime is None:
+            self.lookup.cancel()
+        return reason
+
+    def _finish(self):
+        timer = self.agi.pendingWaits.pop(self.deferred, None)
+        if timer is not None:
+            timer.cancel()
+        hidden = min(self.lookupTime, self.playbackTime) - self.started
+        self.handler.hiddenLatency += hidden
+        if isinstance(self.value, failure.Failure):
+            self.deferred.errback(self.value)
+        else:
+            self.deferred.callback(OverlapResult(
+                self.value, self.playback, hidden,
+                max(self.lookupTime - self.playbackTime, 0)))
+
 
 class CallHandler(object):
+    """
+    @ivar processPool: L{ProcessPool} for the L{deferToProcess} or C{None}
+        for the shared one.
+    @ivar overlapTimeout: default seconds the L{overlap} waits for the
+        lookup after the playback.
+    @ivar hiddenLatency: seconds of the lookups of the call which passed
+        during the playback.
+    """
     implements(ICallHandler)
     
     agi = None
+    processPool = None
+    overlapTimeout = 10
+    hiddenLatency = 0
+
+    def hangupReceived(self):
+        pass
+
+    def overlap(self, lookup, prompts, escapeDigits='', timeout=None):
+        """
+        Run the lookup while the prompts are played, then join both::
+
+            def startCall(self):
+                return self.overlap(self.deferToProcess(route, number),
+                                    'please-wait').addCallback(self.dial)
+
+        The escape digit stops the prompts, the lookup is still waited for.
+        The lookup is cancelled on the hangup, on the playback failure and
+        on the deadline.
+
+        @param lookup: deferred of the started lookup, or the callable
+            which starts it.
+        @param prompts: prompt or sequence of the prompts, see
+            L{FastAGIProtocol.playlist}.
+        @param timeout: seconds the lookup is waited for after the
+            playback, the L{overlapTimeout} by default.
+        @return: deferred L{OverlapResult}.
+        @raise LookupTimeout: when the lookup misses the deadline.
+        """
+        if timeout is None:
+            timeout = self.overlapTimeout
+        if isinstance(prompts, basestring):
+            prompts = [prompts]
+        if not isinstance(lookup, defer.Deferred):
+            lookup = defer.maybeDeferred(lookup)
+        return _Overlap(self, lookup, prompts, escapeDigits, timeout).deferred
+
+    def deferToProcess(self, func, *args, **kwargs):
+        """
+        Run the CPU bound task in the worker process, see
+        L{twisted.fats.processes}.
+
+        @param func: picklable module level function.
+        @return: deferred result of the task.
+        """
+        from twisted.fats.processes import getProcessPool
+        pool = self.processPool or getProcessPool()
+        return pool.submit(func, *args, **kwargs)
+
+
+_RUNNING, _ADDING, _WAITING = range(3)
+
+# The exception of defer.returnValue is private, take its class through the
+# public function.
+try:
+    defer.returnValue(None)
+except BaseException, e:
+    _ReturnValue = e.__class__
+    del e
+
+
+class CoroutineDriver(object):
+    """
+    Runs the generator call script like C{defer.inlineCallbacks}, but
+    without the decorator, so the factory drives any script returned by
+    C{startCall}.
+
+    The script yields the deferreds of the AGI commands and gets their
+    results (or the exceptions) back from the C{yield}. A deferred which
+    already has the result is stepped in place, without the recursion. A
+    pending deferred gets a single callback of the driver, so the reply of
+    the command resumes the script without any intermediate deferreds. The
+    script ends with C{defer.returnValue}, or just returns with C{None}.
+
+    Any object with C{send} and C{throw} methods is driven, so a native
+    coroutine works as well when its awaitables yield the deferreds.
+
+    @ivar coroutine: the call script.
+    @ivar deferred: fires with the result of the script.
+    """
+    __slots__ = ('coroutine', 'deferred', '_state', '_result')
+
+    def __init__(self, coroutine):
+        self.coroutine = coroutine
+        self.deferred = defer.Deferred()
+        self._state = _RUNNING
+        self._result = None
+
+    def start(self):
+        """
+        @return: L{deferred}
+        """
+        self._step(None)
+        return self.deferred
+
+    def _step(self, result):
+        coroutine = self.coroutine
+        while True:
+            try:
+                if isinstance(result, failure.Failure):
+                    result = result.throwExceptionIntoGenerator(coroutine)
+                else:
+                    result = coroutine.send(result)
+            except StopIteration:
+                self.deferred.callback(None)
+                return
+            except _ReturnValue, e:
+                self.deferred.callback(e.value)
+                return
+            except:
+                self.deferred.errback()
+                return
+
+            if isinstance(result, defer.Deferred):
+                self._state = _ADDING
+                result.addBoth(self._resume)
+                if self._state == _ADDING:
+                    self._state = _WAITING
+                    return
+                result, self._result = self._result, None
+
+    def _resume(self, result):
+        if self._state == _ADDING:
+            self._state = _RUNNING
+            self._result = result
+        else:
+            self._state = _RUNNING
+            self._step(result)
+
+
+def isCoroutine(obj):
+    """
+    @return: whether the object is the generator-like call script.
+    """
+    return hasattr(obj, 'send') and hasattr(obj, 'throw')
+
+
+class _Drain(object):
+    """
+    Drain of the L{FastAGIFactory} calls.
+    """
+
+    def __init__(self, factory, timeout, interval, reactor):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.factory = factory
+        self.reactor = reactor
+        self.started = reactor.seconds()
+        self.dropped = None
+        self.waiters = []
+        self.deadline = self.progress = None
+        log.msg('Draining %d FastAGI calls' % factory.activeCalls)
+        if timeout is not None:
+            self.deadline = reactor.callLater(timeout, self._expired)
+        if interval:
+            self.progress = task.LoopingCall(self._report)
+            self.progress.clock = reactor
+            self.progress.start(interval, now=False)
+
+    def _report(self):
+        log.msg('Draining FastAGI calls: %d left after %d seconds' %
+                (self.factory.activeCalls,
+                 self.reactor.seconds() - self.started))
+
+    def _expired(self):
+        self.deadline = None
+        calls = list(self.factory._calls)
+        log.msg('Drain deadline, dropping %d FastAGI calls' % len(calls))
+        self.finish(len(calls))
+        for agi in calls:
+            if agi.transport is not None:
+                agi.finish()
+
+    def finish(self, dropped=0):
+        if self.dropped is not None:
+            return
+        self.dropped = dropped
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        if self.progress is not None and self.progress.running:
+            self.progress.stop()
+        log.msg('FastAGI calls drained in %.1f seconds' %
+                (self.reactor.seconds() - self.started))
+        waiters, self.waiters = self.waiters, []
+        for df in waiters:
+            df.callback(dropped)
+
+    def wait(self):
+        if self.dropped is not None:
+            return defer.succeed(self.dropped)
+        df = defer.Deferred()
+        self.waiters.append(df)
+        return df
 
 
 class FastAGIFactory(protocol.ServerFactory):
     """FastAGI server factory.
 
     Produces protocol instances for asterisk's  call sessions
-    and handle incoming call.
+    and handle incoming call. The handler class of the call is picked by
+    the agi_request path when the L{router} (see L{twisted.fats.router})
+    is set.
+
+    @ivar middleware: sequence of the L{twisted.fats.middleware.Middleware}
+        which wrap every call, in order.
+    @ivar activeCalls: number of the connected calls.
+    @ivar draining: whether the L{drain} is started.
     """
     implements(IFastAGIFactory)
     protocol = FastAGIProtocol
     handler = CallHandler
+    admission = None
+    router = None
+    middleware = ()
+    activeCalls = 0
+    draining = False
+    _calls = None
+    _drain = None
+    _before = _after = _error = None
 
     def handleCall(self, agi):
-        """Start call handler
+        """Start call handler, when the L{admission} controller (see
+        L{twisted.fats.admission}) admits the call. The call is active
+        until its connection is lost, see L{drain}.
         """
-        def onResult(result):
-            log.msg('Call handler result:', result)
-            agi.finish()
+        if self._calls is None:
+            self._calls = set()
+        self._calls.add(agi)
+        self.activeCalls += 1
+        if self._before is None:
+            self.compileMiddleware()
+        for hook in self._before:
+            try:
+                result = hook(agi)
+            except:
+                result = failure.Failure()
+            if result is not None:
+                return self._shortCircuit(result, agi)
+        return self._admitCall(agi)
 
-        def onError(result):
-            log.msg('Call handler err result:', result.getTraceback())
-            agi.finish()
+    def startFactory(self):
+        self.compileMiddleware()
+
+    def compileMiddleware(self):
+        """
+        Flatten the hooks of the L{middleware} into the tuples run by every
+        call. Called when the factory starts, call it again after the
+        L{middleware} is changed.
+        """
+        middleware = list(self.middleware)
+        def hooks(name, order):
+            return tuple([getattr(item, name) for item in order
+                          if getattr(item, name, None) is not None])
+        self._before = hooks('before', middleware)
+        middleware.reverse()
+        self._after = hooks('after', middleware)
+        self._error = hooks('error', middleware)
+
+    def callEnded(self, agi):
+        """
+        Called by the protocol when the connection of the call is lost.
+        """
+        if self._calls is not None and agi in self._calls:
+            self._calls.discard(agi)
+            self.activeCalls -= 1
+            if self._drain is not None and not self.activeCalls:
+                self._drain.finish()
+
+    def drain(self, timeout=30, interval=5, reactor=None):
+        """
+        Let the active calls finish, the listening port must be stopped
+        first. The progress is logged every C{interval} seconds, the calls
+        still active at the deadline are dropped.
+
+        @param timeout: seconds the calls have to finish, C{None} to wait
+            for them forever.
+        @return: deferred fired with the number of the dropped calls.
+        """
+        self.draining = True
+        if self._drain is None:
+            self._drain = _Drain(self, timeout, interval, reactor)
+            if not self.activeCalls:
+                self._drain.finish()
+        return self._drain.wait()
+
+    def _admitCall(self, agi):
+        admission = self.admission
+        if admission is None:
+            return self._startHandler(agi)
 
+        def admitted(admit):
+            if not admit:
+                if self._after:
+                    self._runAfter(False, agi)
+                return
+            if admission.adaptive:
+                agi.commandObserver = admission.commandCompleted
+            result = self._startHandler(agi)
+            if result is None:
+                admission.release(agi)
+                return
+            def release(result):
+                admission.release(agi)
+                return result
+            return result.addBoth(release)
+        return admission.admit(agi).addCallback(admitted)
+
+    def _startHandler(self, agi):
+        handlerClass = self.handler
+        if self.router is not None:
+            handlerClass = self.router.dispatch(agi) or handlerClass
         try:
-            handler = ICallHandler(self.handler())
+            handler = ICallHandler(handlerClass())
             handler.agi = agi
+            agi.handler = handler
             #print handler.agi == agi
-            return handler.startCall(
-                ).addCallbacks(onResult, onError)
+            if IBlockingCallHandler.providedBy(handler):
+                result = self._runBlocking(handler)
+            else:
+                result = handler.startCall()
+            if isCoroutine(result):
+                result = CoroutineDriver(result).start()
+            if agi.route is not None:
+                result = self.router.track(agi.route, result)
+            return self._finishCall(result, agi)
         except TypeError:
+            if agi.route is not None:
+                agi.route.active -= 1
+            if self._error:
+                self._runError(failure.Failure(), agi)
             log.err(
                 'CallHandler[%s] must implement ICallHandler interface.'
-                % self.handler)
+                % handlerClass)
+
+    def _finishCall(self, result, agi):
+        """
+        Run the after or error hooks of the middleware on the call result,
+        then drop the call.
+        """
+        if self._after or self._error:
+            result.addCallbacks(self._runAfter, self._runError, (agi,), None,
+                                (agi,))
+        return result.addCallbacks(self._handlerDone, self._handlerFailed,
+                                   (agi,), None, (agi,))
+
+    def _handlerDone(self, result, agi):
+        log.msg('Call handler result:', result)
+        agi.finish()
+
+    def _handlerFailed(self, result, agi):
+        if result.check(AGIHangup):
+            log.msg('Call handler stopped by hangup')
+        else:
+            log.msg('Call handler err result:', result.getTraceback())
+        agi.finish()
+
+    def _runAfter(self, result, agi):
+        for hook in self._after:
+            try:
+                hook(agi, result)
+            except:
+                log.err(None, 'Middleware after hook %r failed' % (hook,))
+        return result
+
+    def _runError(self, reason, agi):
+        for hook in self._error:
+            try:
+                hook(agi, reason)
+            except:
+                log.err(None, 'Middleware error hook %r failed' % (hook,))
+        return reason
+
+    def _shortCircuit(self, result, agi):
+        """
+        Finish the call stopped by the before hook with its result.
+        """
+        if isinstance(result, failure.Failure):
+            result = defer.fail(result)
+        elif not isinstance(result, defer.Deferred):
+            result = defer.succeed(result)
+        return self._finishCall(result, agi)
+
+    def _runBlocking(self, handler):
+        """
+        Run the blocking handler in its worker pool.
+        """
+        from twisted.fats.blocking import BlockingAGI, getPool
+        pool = handler.pool or getPool()
+        handler.agi = BlockingAGI(handler.agi, handler.timeout, pool=pool)
+        return pool.run(handler.startCall, timeout=handler.timeout)
+
+
+def reloadHandlers(factory):
+    """
+    Reload the modules of the handler classes of the factory and of its
+    router, and bind the reloaded classes. The new calls are served by the
+    new code, the running ones finish on the old classes. The modules of
+    the C{__main__} and of the C{twisted} package are not reloaded.
+
+    @return: names of the reloaded modules.
+    @raise Exception: the error of the module reload, no class is rebound
+        then.
+    """
+    import sys
+    slots = [(factory, 'handler')]
+    router = factory.router
+    if router is not None:
+        slots.append((router, 'default'))
+        slots.extend([(route, 'handler') for route in router.routes])
+    bound = [(owner, name, getattr(owner, name)) for owner, name in slots
+             if getattr(owner, name) is not None]
+    names = []
+    for owner, name, handler in bound:
+        module = getattr(handler, '__module__', None)
+        if (module not in names and module in sys.modules
+            and module != '__main__' and not module.startswith('twisted.')):
+            names.append(module)
+    modules = dict([(name, reload(sys.modules[name])) for name in names])
+    for owner, name, handler in bound:
+        module = modules.get(getattr(handler, '__module__', None))
+        if module is not None:
+            setattr(owner, name, getattr(module, handler.__name__, handler))
+    log.msg('Reloaded the FastAGI handlers of %s' % ', '.join(names))
+    return names
+
+
+class FastAGIServer(internet.TCPServer):
+    """
+    TCP server of the L{FastAGIFactory} which drains the calls when it is
+    stopped::
+
+        FastAGIServer(4573, factory).setServiceParent(application)
+
+    @ivar factory: L{FastAGIFactory} of the server.
+    @ivar drainTimeout: seconds the active calls have to finish.
+    """
+    drainTimeout = 30
+
+    def __init__(self, port, factory, *args, **kwargs):
+        internet.TCPServer.__init__(self, port, factory, *args, **kwargs)
+        self.factory = factory
+
+    def stopService(self):
+        df = defer.maybeDeferred(internet.TCPServer.stopService, self)
+        return df.addCallback(lambda _: self.factory.drain(self.drainTimeout))
@@ -0,0 +1,85 @@
+# -*- test-case-name: twisted.fats.test.test_prefork -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Support for creating the FastAGI server from twistd (mktap)
+
+API Stability: unstable
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import types
+
+from twisted.python import usage, reflect
+
+from twisted.fats.prefork import Supervisor
+
+
+class Options(usage.Options):
+    """
+    Options of the prefork FastAGI server.
+    """
+    optParameters = [
+        ['port', 'p', 4573, 'Port to listen on.', int],
+        ['interface', 'i', '', 'Interface to listen on.'],
+        ['factory', 'f', None,
+         'Fully qualified name of the FastAGI factory, or of the callable '
+         'which returns it.'],
+        ['workers', 'w', None,
+         'Number of the worker processes, the number of the CPUs by '
+         'default.', int],
+        ['cpus', 'c', None,
+         'Comma separated CPUs the workers are pinned to in turn.'],
+        ['restart-delay', None, 1,
+         'Seconds before the exited worker is started again.', float],
+        ['drain-timeout', None, 30,
+         'Seconds the stopped worker lets its calls finish.', float],
+        ['stop-timeout', None, None,
+         'Seconds the workers have to exit on the stop, then they are '
+         'killed; 5 seconds over the --drain-timeout by default.', float],
+    ]
+    optFlags = [
+        ['reuse-port', 'r',
+         'Every worker binds its own SO_REUSEPORT socket instead of '
+         'inheriting the socket of the supervisor.'],
+    ]
+
+    def postOptions(self):
+        if self['factory'] is None:
+            raise usage.UsageError('The --factory is required.')
+        if self['workers'] is not None and self['workers'] < 1:
+            raise usage.UsageError('At least one worker is required.')
+        if self['cpus'] is not None:
+            try:
+                self['cpus'] = [int(cpu) for cpu in self['cpus'].split(',')]
+            except ValueError:
+                raise usage.UsageError('Invalid --cpus: %s' % self['cpus'])
+
+
+def loadFactory(name):
+    """
+    @return: factory of the fully qualified name, or the instance of the
+        class or the factory returned by the callable of the name.
+    """
+    factory = reflect.namedAny(name)
+    if (isinstance(factory, (type, types.ClassType))
+        or not hasattr(factory, 'buildProtocol')):
+        factory = factory()
+    return factory
+
+
+def makeService(config):
+    # The workers load the factory themselves, it is loaded here to report
+    # the wrong name before they start.
+    loadFactory(config['factory'])
+    return Supervisor(config['factory'], config['port'],
+                      workers=config['workers'],
+                      interface=config['interface'],
+                      reusePort=config['reuse-port'],
+                      cpus=config['cpus'],
+                      restartDelay=config['restart-delay'],
+                      drainTimeout=config['drain-timeout'],
+                      stopTimeout=config['stop-timeout'])
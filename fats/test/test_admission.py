@@ -0,0 +1,158 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Admission control tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.protocol import FileWrapper
+from twisted.test.test_protocols import StringIOWithoutClosing as SIOWC
+
+from twisted.fats.admission import AdmissionController, overflowTo
+from twisted.fats.service import FastAGIFactory, CallHandler
+from twisted.fats.timer import TimerWheel
+from twisted.fats.test.asterisk import ENV
+from twisted.fats.test.test_astdb import ShutdownClock
+
+
+class PendingHandler(CallHandler):
+    calls = []
+
+    def startCall(self):
+        df = defer.Deferred()
+        PendingHandler.calls.append(df)
+        return df
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = ShutdownClock()
+        self.factory = FastAGIFactory()
+        self.factory.handler = PendingHandler
+        PendingHandler.calls = []
+
+    def control(self, **kwargs):
+        kwargs.setdefault('reactor', self.clock)
+        self.admission = AdmissionController(**kwargs)
+        self.factory.admission = self.admission
+        return self.admission
+
+    def call(self, path='menu', accountcode='', **env):
+        agi = self.factory.buildProtocol(None)
+        agi.makeConnection(FileWrapper(SIOWC()))
+        agi.writes = []
+        agi.transport.write = agi.writes.append
+        agi.finished = False
+        def finish():
+            agi.finished = True
+        agi.finish = finish
+        agi._startCall(dict(ENV, agi_request='agi://localhost/%s' % path,
+                            agi_accountcode=accountcode, **env))
+        return agi
+
+    def endCall(self, index=0):
+        PendingHandler.calls.pop(index).callback(None)
+
+    def test_limit(self):
+        self.control(maxCalls=2)
+        self.call(), self.call(), self.call()
+        self.assertEqual(len(PendingHandler.calls), 2)
+        self.assertEqual(self.admission.stats()['waiting'], 1)
+        self.endCall()
+        self.assertEqual(len(PendingHandler.calls), 2)
+        self.assertEqual(self.admission.active, 2)
+
+    def test_pathLimit(self):
+        self.control(maxPerPath={('queue',): 1})
+        self.call('queue'), self.call('queue'), self.call('menu')
+        self.assertEqual(len(PendingHandler.calls), 2)
+        self.assertEqual(self.admission.paths, {('queue',): 1, ('menu',): 1})
+
+    def test_priorities(self):
+        self.control(maxCalls=1, priorities={'vip': 0})
+        self.call()
+        plain = self.call(accountcode='plain')
+        vip = self.call(accountcode='vip')
+        self.endCall()
+        self.assertNotIdentical(vip.handler, None)
+        self.assertIdentical(plain.handler, None)
+        self.assertIdentical(self.admission.queue[0][2], plain)
+
+    def test_queueFull(self):
+        self.control(maxCalls=1, queueSize=1,
+                     fallback=overflowTo('overflow'))
+        self.call()
+        self.call()
+        rejected = self.call()
+        self.assertEqual(rejected.writes,
+                         ['SET CONTEXT overflow\nSET EXTENSION s\n'
+                          'SET PRIORITY 1\n'])
+        for line in ('200 result=0',) * 3:
+            rejected.lineReceived(line)
+        self.assertTrue(rejected.finished)
+        self.assertEqual(self.admission.rejected, 1)
+
+    def test_higherPriorityEvicts(self):
+        self.control(maxCalls=1, queueSize=1, priorities={'vip': 0})
+        self.call()
+        plain = self.call()
+        self.call(accountcode='vip')
+        self.assertTrue(plain.finished)
+        self.assertEqual(self.admission.queue[0][0], 0)
+
+    def test_queueTimeout(self):
+        self.control(maxCalls=1, queueTimeout=2)
+        self.call()
+        waiting = self.call()
+        self.clock.pump([0.5] * 6)
+        self.assertTrue(waiting.finished)
+        self.assertEqual(self.admission.stats()['timedOut'], 1)
+
+    def test_deadCallSkipped(self):
+        self.control(maxCalls=1)
+        self.call()
+        dead = self.call()
+        dead.transport.disconnecting = True
+        self.endCall()
+        self.assertEqual(self.admission.active, 0)
+        self.assertEqual(PendingHandler.calls, [])
+
+    def test_adaptiveDecrease(self):
+        admission = self.control(maxCalls=10, adaptive=True,
+                                 targetLatency=0.5)
+        agi = self.call()
+        self.assertEqual(agi.commandObserver, admission.commandCompleted)
+        admission.commandCompleted(2.0)
+        self.clock.advance(1)
+        self.assertEqual(admission.limit, 9)
+        self.assertEqual(admission.latency, 2.0)
+
+    def test_adaptiveIncrease(self):
+        admission = self.control(maxCalls=10, adaptive=True)
+        admission.limit = 1
+        self.call(), self.call()
+        self.clock.advance(1)
+        self.assertEqual(admission.limit, 2)
+        self.assertEqual(len(PendingHandler.calls), 2)
+
+    def test_lag(self):
+        admission = self.control(maxCalls=10, adaptive=True, targetLag=0.1)
+        self.call()
+        self.clock.advance(1.5)
+        self.assertEqual(admission.lag, 0.5)
+        self.assertEqual(admission.limit, 9)
+
+    def test_commandLatency(self):
+        admission = self.control(maxCalls=10, adaptive=True)
+        agi = self.call()
+        agi.wheel = TimerWheel(self.clock)
+        agi.noop()
+        self.clock.advance(0.25)
+        agi.lineReceived('200 result=0')
+        self.assertEqual((admission._commands, admission._latencies),
+                         (1, 0.25))
@@ -140,6 +140,16 @@ class AMIProtocolTest(AMITestCase):
         return df.addCallback(self.assertEqual,
                               {'response': 'Success',
                                'message': 'Authentication accepted'})
+    def test_dbPutFailed(self):
+        df = self.ami.dbPut('flags', 'a', '1')
+
+        self.ami.lineReceived('Asterisk Call Manager/1.0')
+        self.ami.lineReceived('Response: Error')
+        self.ami.lineReceived('Message: Failed to update entry')
+        self.ami.lineReceived('\r\n')
+
+        return self.assertFailure(df, AMIFailure)
+
     def test_event(self):
         self.assertEqual(self.ami.getEvent(), None)
 
@@ -162,3 +172,27 @@ class AMIProtocolTest(AMITestCase):
                            'event': 'Newchannel',
                            'channel': 'SIP/fats-08173788'})
         
+
+    def test_loginFramed(self):
+        df = self.ami.login('name', 'passwd', 'off')
+
+        self.ami.dataReceived('Asterisk Call Manager/1.0\r\nResponse: Suc')
+        self.ami.dataReceived('cess\r\nMessage: Authentication accepted\r\n')
+        self.ami.dataReceived('\r\n')
+
+        return df.addCallback(self.assertEqual,
+                              {'response': 'Success',
+                               'message': 'Authentication accepted'})
+
+    def test_eventsFramed(self):
+        self.ami.login('name', 'passwd', 'on')
+        self.ami.dataReceived('Asterisk Call Manager/1.0\r\n'
+                              'Response: Success\r\n\r\n'
+                              'Event: Hangup\r\nUniqueid: 1.1\r\n\r\n'
+                              'Event: Hangup\r\nUniqueid: 1.2\r\n\r\n')
+        return self.ami.getEvent(
+            ).addCallback(self.assertEqual,
+                          {'event': 'Hangup', 'uniqueid': '1.1'}
+            ).addCallback(lambda _: self.ami.getEvent()
+            ).addCallback(self.assertEqual,
+                          {'event': 'Hangup', 'uniqueid': '1.2'})
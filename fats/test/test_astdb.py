@@ -0,0 +1,168 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""AstDB cache tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.internet import defer, task
+from twisted.internet.protocol import FileWrapper
+from twisted.test.test_protocols import StringIOWithoutClosing as SIOWC
+
+from twisted.fats.agi import FastAGIProtocol
+from twisted.fats.astdb import AstDBCache
+from twisted.fats.errors import AGICommandFailure, AMIFailure
+from twisted.fats.test.asterisk import AGITestCase, ENV, MockFastAGIFactory
+
+
+class ShutdownClock(task.Clock):
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, eventType, func, *args):
+        self.triggers.append((phase, eventType, func))
+        return len(self.triggers)
+
+
+class FakeAMI(object):
+
+    def __init__(self):
+        self.puts = []
+
+    def dbPut(self, family, key, val):
+        df = defer.Deferred()
+        self.puts.append((family, key, val, df))
+        return df
+
+
+class AstDBCacheTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.writes = []
+        self.agi.transport.write = self.writes.append
+        self.clock = ShutdownClock()
+        self.cache = AstDBCache(ttl=10, flushDelay=0.1, reactor=self.clock)
+
+    def test_getCached(self):
+        df = self.cache.get(self.agi, 'forward', '100')
+        self.agi.lineReceived('200 result=1 (200)')
+        second = self.cache.get(self.agi, 'forward', '100')
+        self.assertEqual(self.writes, ['DATABASE GET forward 100\n'])
+        self.assertEqual(self.cache.stats()['roundTripsSaved'], 1)
+        return second.addCallback(self.assertEqual, '200')
+
+    def test_getMissing(self):
+        df = self.cache.get(self.agi, 'forward', '100')
+        self.agi.lineReceived('200 result=0')
+        self.cache.get(self.agi, 'forward', '100')
+        self.assertEqual(len(self.writes), 1)
+        return df.addCallback(self.assertEqual, None)
+
+    def test_getFailure(self):
+        df = self.cache.get(self.agi, 'forward', '100')
+        self.agi.lineReceived('511 Command Not Permitted on a dead channel')
+        self.assertEqual(len(self.cache.cache), 0)
+        return self.assertFailure(df, AGICommandFailure)
+
+    def test_expiration(self):
+        self.cache.get(self.agi, 'forward', '100')
+        self.agi.lineReceived('200 result=1 (200)')
+        self.clock.advance(10)
+        self.cache.get(self.agi, 'forward', '100')
+        self.assertEqual(len(self.writes), 2)
+
+    def test_putCoalesced(self):
+        self.cache.put(self.agi, 'flags', 'a', 1)
+        self.cache.put(self.agi, 'flags', 'b', 2)
+        self.cache.put(self.agi, 'flags', 'a', 3)
+        df = self.cache.get(self.agi, 'flags', 'a')
+        self.assertEqual(self.writes, [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.writes, ['DATABASE PUT flags b 2\n'
+                                       'DATABASE PUT flags a 3\n'])
+        self.assertEqual(self.cache.stats()['roundTripsSaved'], 2)
+        return df.addCallback(self.assertEqual, '3')
+
+    def test_putFailureRetried(self):
+        self.cache.put(self.agi, 'flags', 'a', 1)
+        self.cache.put(self.agi, 'flags', 'b', 2)
+        self.clock.advance(0.1)
+        self.agi.lineReceived('200 result=0')
+        self.agi.lineReceived('200 result=1')
+        self.assertEqual(self.cache.dirty.items(), [(('flags', 'a'), '1')])
+        self.assertEqual(self.cache.failedWrites, 1)
+        self.clock.advance(0.1)
+        self.assertEqual(self.writes[-1], 'DATABASE PUT flags a 1\n')
+
+    def test_putOfOwnSession(self):
+        other = FastAGIProtocol()
+        other.factory = MockFastAGIFactory()
+        other.makeConnection(FileWrapper(SIOWC()))
+        other._setEnv(ENV)
+        otherWrites = []
+        other.transport.write = otherWrites.append
+        self.cache.put(self.agi, 'flags', 'a', 1)
+        self.cache.put(other, 'flags', 'b', 2)
+        self.clock.advance(0.1)
+        self.assertEqual(self.writes, ['DATABASE PUT flags a 1\n'])
+        self.assertEqual(otherWrites, ['DATABASE PUT flags b 2\n'])
+
+    def test_putOfHungupSessionLost(self):
+        self.cache.put(self.agi, 'flags', 'a', 1)
+        self.agi.hungup = True
+        self.clock.advance(0.1)
+        self.assertEqual(self.writes, [])
+        self.assertEqual(self.cache.dirty, {})
+        self.assertEqual(self.cache.stats()['lostWrites'], 1)
+
+    def test_putThroughAMI(self):
+        ami = FakeAMI()
+        self.cache.ami = ami
+        self.cache.put(self.agi, 'flags', 'a', 1)
+        self.cache.put(self.agi, 'flags', 'b', 2)
+        self.agi.hungup = True
+        self.clock.advance(0.1)
+        self.assertEqual(self.writes, [])
+        self.assertEqual([put[:3] for put in ami.puts],
+                         [('flags', 'a', '1'), ('flags', 'b', '2')])
+        ami.puts[0][3].errback(AMIFailure('Error'))
+        ami.puts[1][3].callback({'response': 'Success'})
+        self.assertEqual(self.cache.dirty.items(), [(('flags', 'a'), '1')])
+        self.clock.advance(0.1)
+        self.assertEqual(ami.puts[-1][:3], ('flags', 'a', '1'))
+
+    def test_shutdownFlush(self):
+        self.cache.put(self.agi, 'flags', 'a', 1)
+        [(phase, eventType, flush)] = self.clock.triggers
+        self.assertEqual((phase, eventType), ('before', 'shutdown'))
+        flush()
+        self.assertEqual(self.writes, ['DATABASE PUT flags a 1\n'])
+
+    def test_invalidateFamily(self):
+        self.cache.put(self.agi, 'flags', 'a', 1)
+        self.cache.put(self.agi, 'other', 'a', 1)
+        self.cache.invalidate('flags')
+        self.assertEqual(self.cache.dirty.keys(), [('other', 'a')])
+        self.cache.get(self.agi, 'flags', 'a')
+        self.assertEqual(self.writes, ['DATABASE GET flags a\n'])
+
+    def test_eventReceived(self):
+        self.cache.cache.set(('flags', 'a'), '1')
+        self.cache.cache.set(('flags', 'b'), '1')
+        self.cache.eventReceived({'event': 'UserEvent',
+                                  'userevent': 'AstDBChanged',
+                                  'family': 'flags', 'key': 'a'})
+        self.assertEqual(self.cache.cache.entries.keys(), [('flags', 'b')])
+
+    def test_delete(self):
+        self.cache.put(self.agi, 'flags', 'a', 1)
+        self.cache.delete(self.agi, 'flags', 'a')
+        self.assertEqual(self.writes, ['DATABASE DEL flags a\n'])
+        self.cache.get(self.agi, 'flags', 'a').addCallback(
+            self.assertEqual, None)
+        self.assertEqual(self.cache.dirty, {})
@@ -0,0 +1,105 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""AsyncAGI tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import urllib
+
+from twisted.trial import unittest
+from twisted.internet.protocol import FileWrapper
+from twisted.test.test_protocols import StringIOWithoutClosing as SIOWC
+
+from twisted.fats.ami import AMI
+from twisted.fats.asyncagi import AsyncAGIManager
+from twisted.fats.service import FastAGIFactory, CallHandler
+
+
+class Handler(CallHandler):
+    results = []
+
+    def startCall(self):
+        result = yield self.agi.answer()
+        Handler.results.append((self.agi['agi_channel'], result.result))
+        result = yield self.agi.getVariable('LANG')
+        Handler.results.append((self.agi['agi_channel'], result.extra))
+
+
+def start(channel):
+    env = ('agi_request: async\nagi_channel: %s\nagi_language: en\n\n'
+           % channel)
+    return ('Event: AsyncAGI\r\nSubEvent: Start\r\nChannel: %s\r\n'
+            'Env: %s\r\n\r\n' % (channel, urllib.quote(env)))
+
+
+def execute(channel, commandID, result):
+    return ('Event: AsyncAGI\r\nSubEvent: Exec\r\nChannel: %s\r\n'
+            'CommandID: %s\r\nResult: %s\r\n\r\n' %
+            (channel, commandID, urllib.quote(result + '\n')))
+
+
+def end(channel):
+    return 'Event: AsyncAGI\r\nSubEvent: End\r\nChannel: %s\r\n\r\n' % channel
+
+QUEUED = 'Response: Success\r\nMessage: Added AGI command to queue\r\n\r\n'
+
+
+class AsyncAGITest(unittest.TestCase):
+
+    def setUp(self):
+        self.tunnel = SIOWC()
+        self.ami = AMI()
+        self.ami.makeConnection(FileWrapper(self.tunnel))
+        self.ami.dataReceived('Asterisk Call Manager/1.1\r\n')
+        factory = FastAGIFactory()
+        factory.handler = Handler
+        Handler.results = []
+        self.manager = AsyncAGIManager(self.ami, factory)
+
+    def actions(self):
+        value = self.tunnel.getvalue()
+        self.tunnel.truncate(0)
+        self.tunnel.seek(0)
+        return [dict([line.split(': ', 1) for line in action.split('\r\n')])
+                for action in value.split('\r\n\r\n') if action]
+
+    def test_session(self):
+        self.ami.dataReceived(start('SIP/1-1'))
+        self.assertEqual(self.actions(),
+                         [{'action': 'AGI', 'channel': 'SIP/1-1',
+                           'command': 'ANSWER', 'commandid': '1'}])
+        self.ami.dataReceived(QUEUED + execute('SIP/1-1', '1',
+                                               '200 result=0'))
+        self.assertEqual(Handler.results, [('SIP/1-1', '0')])
+        self.assertEqual(self.actions()[0]['command'], 'GET VARIABLE LANG')
+        self.ami.dataReceived(QUEUED + execute('SIP/1-1', '2',
+                                               '200 result=1 (en)'))
+        self.assertEqual(Handler.results[1:], [('SIP/1-1', 'en')])
+        self.assertEqual(self.actions()[0]['command'], 'ASYNCAGI BREAK')
+        self.ami.dataReceived(QUEUED + end('SIP/1-1'))
+        self.assertEqual(self.manager.sessions, {})
+
+    def test_multiplexed(self):
+        self.ami.dataReceived(start('SIP/1-1') + start('SIP/2-1'))
+        self.assertEqual(len(self.manager.sessions), 2)
+        self.ami.dataReceived(QUEUED * 2 +
+                              execute('SIP/2-1', '2', '200 result=0') +
+                              execute('SIP/1-1', '1', '200 result=0'))
+        self.assertEqual(Handler.results, [('SIP/2-1', '0'),
+                                           ('SIP/1-1', '0')])
+
+    def test_hangup(self):
+        self.ami.dataReceived(start('SIP/1-1'))
+        self.actions()
+        self.ami.dataReceived(QUEUED + end('SIP/1-1'))
+        self.assertEqual(self.manager.sessions, {})
+        self.assertEqual(Handler.results, [])
+        self.assertEqual(self.actions(), [])
+
+    def test_otherEvents(self):
+        self.ami.dataReceived('Event: Hangup\r\nChannel: SIP/1-1\r\n\r\n')
+        self.assertEqual(self.manager.sessions, {})
+        self.assertEqual(self.ami.getEvent(), None)
@@ -0,0 +1,202 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Blocking call handlers tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.internet.base import _ThreePhaseEvent
+
+from twisted.fats.blocking import BlockingAGI, CallPool, ThreadedCallHandler
+from twisted.fats.errors import AGICommandTimeout, CallPoolFull
+from twisted.fats.service import FastAGIFactory
+
+
+class MockTransport:
+    disconnecting = False
+
+
+class MockAGI:
+    """
+    Protocol with the ready and the never answered commands.
+    """
+    transport = MockTransport()
+    env = {'agi_channel': 'SIP/tester'}
+
+    def noop(self):
+        self.thread = threading.currentThread()
+        return defer.succeed('noop')
+
+    def fail(self):
+        return defer.fail(ValueError())
+
+    def silent(self):
+        return defer.Deferred()
+
+
+class BlockingAGITest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = CallPool(maxThreads=2)
+        self.mock = MockAGI()
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_result(self):
+        agi = BlockingAGI(self.mock)
+        def script():
+            return agi.noop(), agi['agi_channel'], agi.env
+        def check(result):
+            self.assertEqual(result, ('noop', 'SIP/tester', MockAGI.env))
+            self.assertIdentical(self.mock.thread, threading.currentThread())
+        return self.pool.run(script).addCallback(check)
+
+    def test_exception(self):
+        agi = BlockingAGI(self.mock)
+        return self.assertFailure(self.pool.run(agi.fail), ValueError)
+
+    def test_timeout(self):
+        agi = BlockingAGI(self.mock, timeout=0.1)
+        return self.assertFailure(self.pool.run(agi.silent),
+                                  AGICommandTimeout)
+
+    def test_stopFailsWaiting(self):
+        agi = BlockingAGI(self.mock, pool=self.pool)
+        df = self.pool.run(agi.silent)
+        def stop():
+            if not self.pool._waiting:
+                return task.deferLater(reactor, 0.01, stop)
+            self.pool.stop()
+        return task.deferLater(reactor, 0.01, stop).addCallback(
+            lambda ignored: self.assertFailure(df, defer.CancelledError))
+
+    def test_closedConnection(self):
+        self.mock.transport = MockTransport()
+        self.mock.transport.disconnecting = True
+        agi = BlockingAGI(self.mock)
+        return self.assertFailure(self.pool.run(agi.noop), Exception)
+
+
+class CallPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = CallPool(maxThreads=1, maxQueue=1)
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.pool.stop()
+
+    def test_queueLimit(self):
+        first = self.pool.run(self.release.wait)
+        second = self.pool.run(lambda: 'second')
+        third = self.pool.run(lambda: 'third')
+        self.assertEqual(self.pool.rejected, 1)
+        self.release.set()
+        self.assertFailure(third, CallPoolFull)
+        return defer.gatherResults([first, second, third])
+
+    def test_stats(self):
+        def check(result):
+            stats = self.pool.stats()
+            self.assertEqual(stats['completed'], 1)
+            self.assertEqual(stats['failed'], 1)
+            self.assertEqual(stats['queued'], 0)
+            self.assertEqual(stats['running'], 0)
+        first = self.pool.run(lambda: None)
+        second = self.assertFailure(self.pool.run(lambda: 1 / 0),
+                                    ZeroDivisionError)
+        return defer.gatherResults([first, second]).addCallback(check)
+
+    def test_callTimeout(self):
+        df = self.pool.run(self.release.wait, timeout=0.1)
+        def check(result):
+            self.assertEqual(self.pool.timedOut, 1)
+        return self.assertFailure(df, AGICommandTimeout).addCallback(check)
+
+
+class ShutdownReactor:
+    """
+    Reactor with the own shutdown event.
+    """
+
+    def __init__(self):
+        self.shutdown = _ThreePhaseEvent()
+
+    def addSystemEventTrigger(self, phase, eventType, func, *args):
+        return eventType, self.shutdown.addTrigger(phase, func, *args)
+
+    def removeSystemEventTrigger(self, triggerID):
+        self.shutdown.removeTrigger(triggerID[1])
+
+    def callFromThread(self, func, *args):
+        reactor.callFromThread(func, *args)
+
+
+class ShutdownTest(unittest.TestCase):
+
+    def test_shutdown(self):
+        pool = CallPool(maxThreads=1, reactor=ShutdownReactor())
+        def check(result):
+            pool.reactor.shutdown.fireEvent()
+            self.assertTrue(pool.threadpool.joined)
+            self.assertEqual(pool.reactor.shutdown.before, [])
+            self.assertEqual(pool.reactor.shutdown.during, [])
+        return pool.run(lambda: None).addCallback(check)
+
+
+class AnsweringTransport:
+    """
+    Replies C{200 result=0} to every command.
+    """
+    disconnecting = False
+
+    def __init__(self, agi):
+        self.agi = agi
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+        for line in data.splitlines():
+            reactor.callLater(0, self.agi.lineReceived, '200 result=0')
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+class Answer(ThreadedCallHandler):
+    pool = CallPool(maxThreads=1)
+    calls = []
+
+    def startCall(self):
+        self.agi.answer()
+        self.agi.noop()
+        Answer.calls.append(self.agi['agi_network'])
+
+
+class ThreadedCallHandlerTest(unittest.TestCase):
+
+    def tearDown(self):
+        Answer.pool.stop()
+
+    def test_handleCall(self):
+        factory = FastAGIFactory()
+        factory.handler = Answer
+        agi = factory.buildProtocol(None)
+        agi.transport = AnsweringTransport(agi)
+        agi.connectionMade()
+        agi.env = {'agi_network': 'yes'}
+        agi.readingEnv = False
+
+        def check(result):
+            self.assertEqual(Answer.calls, ['yes'])
+            self.assertEqual(agi.transport.written, ['ANSWER\n', 'NOOP\n'])
+            self.assertTrue(agi.transport.disconnecting)
+        return factory.handleCall(agi).addCallback(check)
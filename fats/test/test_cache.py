@@ -0,0 +1,59 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Process wide caches tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from twisted.fats.cache import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = LRUCache(maxSize=2, ttl=10, clock=self.clock)
+
+    def test_get(self):
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('b', 'missing'), 'missing')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.evicted, 1)
+
+    def test_expiration(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=20)
+        self.clock.advance(10)
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(self.cache.expired, 1)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_removeMatching(self):
+        self.cache.set(('f', 'a'), 1)
+        self.cache.set(('g', 'a'), 2)
+        self.assertEqual(
+            self.cache.removeMatching(lambda key: key[0] == 'f'), 1)
+        self.assertEqual(self.cache.get(('g', 'a')), 2)
+
+    def test_stats(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+        stats = self.cache.stats()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['hitRate'], 0.5)
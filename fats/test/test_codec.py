@@ -0,0 +1,83 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""FastAGI response codec tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+
+from twisted.fats.agi import COMMANDS, CODEC
+from twisted.fats.codec import ResponseCodec, ResultShape
+
+
+class ResultShapeTest(unittest.TestCase):
+
+    def test_codeOnly(self):
+        shape = ResultShape('ANSWER', *COMMANDS['ANSWER'])
+        self.assertEqual((shape.success, shape.failure), ('0', '-1'))
+        self.assertTrue(shape.codeOnly)
+        self.assertFalse(shape.hasExtra)
+        self.assertFalse(shape.hasEndpos)
+
+    def test_endpos(self):
+        shape = ResultShape('STREAM FILE', *COMMANDS['STREAM FILE'])
+        self.assertTrue(shape.hasEndpos)
+        self.assertFalse(shape.hasExtra)
+        self.assertFalse(shape.codeOnly)
+
+    def test_extra(self):
+        shape = ResultShape('RECORD FILE', *COMMANDS['RECORD FILE'])
+        self.assertTrue(shape.hasEndpos)
+        self.assertTrue(shape.hasExtra)
+
+    def test_table(self):
+        self.assertEqual(sorted(CODEC.shapes), sorted(COMMANDS))
+
+
+class ResponseCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = ResponseCodec(COMMANDS)
+
+    def assertDecoded(self, name, line, expected):
+        self.assertEqual(self.codec.decode(name, line), expected)
+
+    def test_code(self):
+        self.assertDecoded('ANSWER', '0', ('0', None, None))
+        self.assertDecoded('ANSWER', '-1', ('-1', None, None))
+
+    def test_parenthesised(self):
+        self.assertDecoded('DATABASE GET', '1 (some value)',
+                           ('1', 'some value', None))
+
+    def test_emptyParenthesised(self):
+        self.assertDecoded('GET FULL VARIABLE', '1 ()', ('1', '', None))
+
+    def test_bareValue(self):
+        self.assertDecoded('GET FULL VARIABLE', '1 two words',
+                           ('1', 'two words', None))
+
+    def test_timeout(self):
+        self.assertDecoded('GET DATA', '123 (timeout)',
+                           ('123', 'timeout', None))
+
+    def test_endpos(self):
+        self.assertDecoded('STREAM FILE', '55 endpos=12345',
+                           ('55', '', 12345))
+
+    def test_extraEndpos(self):
+        self.assertDecoded('RECORD FILE', '0 (hangup) endpos=800',
+                           ('0', 'hangup', 800))
+
+    def test_extraNoEndpos(self):
+        self.assertDecoded('RECORD FILE', '-1 (writefile)',
+                           ('-1', 'writefile', None))
+
+    def test_unexpectedExtra(self):
+        self.assertDecoded('ANSWER', '0 (ignored)', ('0', 'ignored', None))
+
+    def test_unknownCommand(self):
+        self.assertDecoded('FOO', '1 (bar) endpos=1', ('1', 'bar', 1))
@@ -0,0 +1,77 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""FastAGI environment block tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+
+from twisted.fats.environment import AGIEnvironment, internKey, shareValue
+from twisted.fats.test.asterisk import ENV
+
+
+BLOCK = ''.join('%s: %s\n' % item for item in sorted(ENV.items()))
+
+
+class AGIEnvironmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.env = AGIEnvironment(BLOCK)
+
+    def test_lazyLookup(self):
+        self.assertEqual(self.env['agi_channel'], ENV['agi_channel'])
+        self.assertEqual(self.env.values.keys(), ['agi_channel'])
+        self.assertNotEqual(self.env.block, None)
+
+    def test_emptyValue(self):
+        env = AGIEnvironment('agi_accountcode: \nagi_dnid: 1\n')
+        self.assertEqual(env['agi_accountcode'], '')
+        self.assertEqual(env['agi_dnid'], '1')
+
+    def test_lastLineWithoutNewline(self):
+        self.assertEqual(AGIEnvironment('agi_dnid: 1  ')['agi_dnid'], '1')
+
+    def test_missingKey(self):
+        self.assertRaises(KeyError, self.env.__getitem__, 'agi_arg_1')
+        self.assertEqual(self.env.block, None)
+        self.assertEqual(self.env.get('agi_arg_1'), None)
+        self.assertEqual(self.env['agi_type'], ENV['agi_type'])
+
+    def test_dict(self):
+        self.assertEqual(dict(self.env), ENV)
+        self.assertEqual(len(self.env), len(ENV))
+        self.assertTrue('agi_request' in self.env)
+
+    def test_upperCaseKeys(self):
+        env = AGIEnvironment('AGI_Network: yes\n')
+        self.assertEqual(env['agi_network'], 'yes')
+
+    def test_setAndDelete(self):
+        self.env['agi_dnid'] = '100'
+        self.assertEqual(self.env['agi_dnid'], '100')
+        self.assertEqual(dict(self.env)['agi_dnid'], '100')
+        del self.env['agi_dnid']
+        self.assertFalse('agi_dnid' in self.env)
+
+    def test_sharedValues(self):
+        first = AGIEnvironment('agi_language: %s\n' % ''.join(['r', 'u']))
+        second = AGIEnvironment('agi_language: %s\n' % ''.join(['r', 'u']))
+        self.assertTrue(first['agi_language'] is second['agi_language'])
+        self.assertEqual(first['agi_language'], 'ru')
+
+    def test_internedKeys(self):
+        key = ''.join(['agi_', 'dnid'])
+        self.assertTrue(internKey(key) is intern('agi_dnid'))
+        self.assertTrue(internKey('AGI_DNID') is intern('agi_dnid'))
+
+    def test_uniqueValuesNotShared(self):
+        value = ''.join(['12345', '.1'])
+        self.assertTrue(shareValue('agi_uniqueid', value) is value)
+
+    def test_customerValuesNotShared(self):
+        for key in ('agi_context', 'agi_accountcode', 'agi_rdnis'):
+            value = ''.join(['from-', key])
+            self.assertTrue(shareValue(key, value) is value)
@@ -8,11 +8,15 @@ $Id: test_fastagi.py 24 2008-02-18 12:22:42Z burus $
 """
 
 from twisted.fats.errors import AGICommandFailure, UndefinedTimeFormat, \
-     AGICommandTimeout, FailureOnOpen
+     AGICommandTimeout, FailureOnOpen, AGIPipelineAborted, AGIHangup
 from twisted.fats.test.asterisk import ENV, AGITestCase, COMMANDS
-from twisted.fats.agi import URL, Command
+from twisted.fats.agi import URL, Command, ResultCode, FastAGIProtocol, \
+     PlaylistResult
+from twisted.fats.timer import TimerWheel
 import time, datetime
 
+from twisted.internet import task
+
 
 from twisted.trial import unittest
 
@@ -25,21 +29,21 @@ class CommandTest(unittest.TestCase):
     def test_string(self):
         cmd_t = Command('cmd', '0')
         self.cmd.result = '0'
-        self.cmd.value = None
+        self.cmd.extra = None
         self.cmd.endpos = None
         self.assertEqual(cmd_t, self.cmd)
 
     def test_different_string(self):
         cmd_t = Command('cmd', '0')
         self.cmd.result = '1'
-        self.cmd.value = None
+        self.cmd.extra = None
         self.cmd.endpos = None
         self.assertNotEqual(cmd_t, self.cmd)
         
     def test_string_endpos(self):
         cmd_t = Command('cmd', '1', endpos=10)
         self.cmd.result = '1'
-        self.cmd.value = None
+        self.cmd.extra = None
         self.cmd.endpos = 10
         self.assertEqual(cmd_t, self.cmd)
 
@@ -47,10 +51,55 @@ class CommandTest(unittest.TestCase):
         cmd_t = Command('cmd', '55', endpos=10)
         cmd_t.convert_dtmf()
         self.cmd.result = '7'
-        self.cmd.value = None
+        self.cmd.extra = None
         self.cmd.endpos = 10
         self.assertEqual(cmd_t, self.cmd)
-        
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.cmd, '__dict__'))
+        self.assertRaises(AttributeError, setattr, self.cmd, 'value', None)
+
+    def test_resultCodes(self):
+        cmd = Command('set variable', '1')
+        self.assertEqual(cmd.name, 'SET VARIABLE')
+        self.assertTrue(cmd.is_success())
+        self.assertTrue(cmd.is_failure())
+        self.assertFalse(cmd.has_error())
+
+    def test_unknownResultCodes(self):
+        cmd = Command('cmd', '0')
+        self.assertFalse(cmd.is_success())
+        self.assertFalse(cmd.has_error())
+        self.assertEqual(Command('exec_').name, 'EXEC')
+
+    def test_notEqualToString(self):
+        self.assertNotEqual(Command('cmd', '0'), '0')
+
+
+class ResultCodeTest(unittest.TestCase):
+
+    def test_codes(self):
+        cmd = ResultCode('ANSWER', '-1')
+        self.assertTrue(cmd.is_failure())
+        self.assertTrue(cmd.has_error())
+        self.assertEqual((cmd.extra, cmd.endpos), (None, None))
+        self.assertFalse(hasattr(cmd, '__dict__'))
+
+    def test_equalToCommand(self):
+        self.assertEqual(ResultCode('NOOP', '0'), Command('noop', '0'))
+        self.assertNotEqual(ResultCode('NOOP', '0'), Command('answer', '0'))
+
+    def test_convert_dtmf(self):
+        cmd = ResultCode('SAY DIGITS', '55')
+        cmd.convert_dtmf()
+        self.assertEqual((cmd.result, cmd.has_dtmf), ('7', True))
+
+    def test_codeOnlyReply(self):
+        self.assertEqual(type(FastAGIProtocol._returnCommandValues(
+            '0', 'ANSWER')), ResultCode)
+        self.assertEqual(type(FastAGIProtocol._returnCommandValues(
+            '0 endpos=10', 'STREAM FILE')), Command)
+
 
 class FastAGIProtocolTest(AGITestCase):
 
@@ -62,6 +111,31 @@ class FastAGIProtocolTest(AGITestCase):
         self.agi.lineReceived('\n\n')
         self.assertEqual(self.agi.readingEnv, False)
 
+    def test_environmentBlock(self):
+        calls = []
+        self.agi.factory.handleCall = calls.append
+        self.agi.readingEnv = True
+        block = ''.join('%s: %s\n' % item for item in ENV.items()) + '\n'
+        self.agi.dataReceived(block[:100])
+        self.assertEqual(self.agi.readingEnv, True)
+        self.agi.dataReceived(block[100:] + '200 result=0\n')
+        self.assertEqual(self.agi.readingEnv, False)
+        self.assertEqual(calls, [self.agi])
+        self.assertEqual(dict(self.agi.env), ENV)
+        self.assertEqual(self.agi.url.params, {'foo': 'bar'})
+
+    def test_environmentBlockEmpty(self):
+        self.agi.readingEnv = True
+        self.agi.dataReceived('\n')
+        self.assertEqual(self.agi.readingEnv, False)
+        self.assertEqual(dict(self.agi.env), {})
+
+    def test_environmentBlockReply(self):
+        self.agi.readingEnv = True
+        df = self.agi.noop()
+        self.agi.dataReceived('agi_network: yes\n\n200 result=0\n')
+        return df.addCallback(self.assertEqual, Command('NOOP', '0'))
+
     def test_sendCommand(self):
         for cmd in COMMANDS:
             df = self.agi.sendCommand(cmd)
@@ -301,6 +375,13 @@ class FastAGIProtocolTest(AGITestCase):
     def test_sayDatetimeDigitPressed(self):
         return self.assertCommandResponse(('say datetime', '7'), '55', time.time())
 
+    def test_sayDatetimeFormat(self):
+        writes = []
+        self.agi.transport.write = writes.append
+        self.agi.sayDatetime(1204725900.0, '#', 'HM', 'UTC')
+        self.assertEqual(writes,
+                         ['SAY DATETIME 1204725900.0 \'#\' "HM" UTC\n'])
+
     def test_sayDatetimeFailure(self):
         self.assertCommandException(('say datetime', '-1'), '-1',
                                     time=datetime.datetime.now())
@@ -439,6 +520,273 @@ class FastAGIProtocolTest(AGITestCase):
                                            timeout=0.123)
 
 
+class CommandPipelineTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.writes = []
+        write = self.agi.transport.write
+        def countWrites(data):
+            self.writes.append(data)
+            write(data)
+        self.agi.transport.write = countWrites
+
+    def test_oneWrite(self):
+        self.agi.pipeline().answer().setVariable('FOO', 'bar'
+            ).streamFile('test_audio').run()
+        self.assertEqual(self.writes,
+                         ["ANSWER\nSET VARIABLE FOO 'bar'\n"
+                          "STREAM FILE test_audio ''\n"])
+        self.assertEqual(len(self.agi.pendingMessages), 3)
+
+    def test_results(self):
+        df = self.agi.pipeline().answer().setVariable('FOO', 'bar'
+            ).streamFile('test_audio').run()
+        for line in ('0', '1', '0 endpos=100'):
+            self.agi.lineReceived('200 result=%s' % line)
+        return df.addCallback(self.assertEqual,
+                              [Command('ANSWER', '0'),
+                               Command('SET VARIABLE', '1'),
+                               Command('STREAM FILE', '0', None, 100)])
+
+    def test_failureShortCircuit(self):
+        df = self.agi.pipeline().answer().streamFile('test_audio').noop().run()
+        for line in ('-1', '0 endpos=100', '0'):
+            self.agi.lineReceived('200 result=%s' % line)
+        self.assertEqual(self.agi.pendingMessages, [])
+
+        def checkError(err):
+            self.assertFalse(isinstance(err, AGIPipelineAborted))
+            self.assertEqual(err.result, Command('ANSWER', '-1'))
+        return self.assertFailure(df, AGICommandFailure).addCallback(checkError)
+
+    def test_outsidePipeline(self):
+        self.agi.pipeline().answer()
+        self.agi.noop()
+        self.assertEqual(self.writes, ['NOOP\n'])
+
+    def test_unknownMethod(self):
+        self.assertRaises(AttributeError, getattr, self.agi.pipeline(),
+                          'foo')
+
+    def test_raisingMethod(self):
+        pipeline = self.agi.pipeline().answer().streamFile()
+        self.assertRaises(TypeError, pipeline.run)
+        self.assertEqual(self.writes, [])
+        self.assertEqual(self.agi.pendingMessages, [])
+        df = self.agi.noop()
+        self.agi.lineReceived('200 result=0')
+        return df.addCallback(self.assertEqual, Command('NOOP', '0'))
+
+
+class DeadlineTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.clock = task.Clock()
+        self.agi.wheel = TimerWheel(self.clock)
+
+    def test_commandTimeout(self):
+        df = self.agi.sendCommand('NOOP', timeout=1)
+        self.clock.pump([0.5] * 3)
+        return self.assertFailure(df, AGICommandTimeout)
+
+    def test_defaultTimeout(self):
+        self.agi.commandTimeout = 1
+        df = self.agi.noop()
+        self.clock.pump([0.5] * 3)
+        return self.assertFailure(df, AGICommandTimeout)
+
+    def test_replyInTime(self):
+        self.agi.commandTimeout = 1
+        df = self.agi.noop()
+        self.agi.lineReceived('200 result=0')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        return df.addCallback(self.assertEqual, Command('NOOP', '0'))
+
+    def test_lateReply(self):
+        first = self.agi.sendCommand('NOOP', timeout=1)
+        second = self.agi.answer()
+        self.clock.pump([0.5] * 3)
+        self.agi.lineReceived('200 result=0')
+        self.agi.lineReceived('200 result=-1')
+        self.assertEqual(self.agi.pendingMessages, [])
+        self.assertFailure(second, AGICommandFailure)
+        return self.assertFailure(first, AGICommandTimeout)
+
+    def test_sessionTimeout(self):
+        self.agi.sessionTimeout = 10
+        self.agi._startCall(ENV)
+        df = self.agi.noop()
+        self.clock.advance(10.1)
+        self.assertTrue(self.agi.transport.closed)
+        return self.assertFailure(df, AGICommandTimeout)
+
+    def test_sessionTimerCancelled(self):
+        self.agi.sessionTimeout = 10
+        self.agi._startCall(ENV)
+        self.agi.connectionLost(None)
+        self.assertEqual(len(self.agi.wheel), 0)
+
+    def test_wait(self):
+        fired = []
+        self.agi.wait(1).addCallback(fired.append)
+        self.clock.pump([0.5, 0.4])
+        self.assertEqual(fired, [])
+        self.clock.advance(0.2)
+        self.assertEqual(fired, [0])
+
+
+class HangupTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.clock = task.Clock()
+        self.agi.wheel = TimerWheel(self.clock)
+        self.hangups = []
+        self.agi.handler = self
+
+    def hangupReceived(self):
+        self.hangups.append(self.agi.pendingMessages[:])
+
+    def test_pendingCommands(self):
+        first, second = self.agi.answer(), self.agi.noop()
+        self.agi.lineReceived('HANGUP')
+        self.assertEqual(len(self.hangups), 1)
+        self.assertTrue(self.agi.transport.closed)
+        self.assertFailure(first, AGIHangup)
+        return self.assertFailure(second, AGIHangup)
+
+    def test_notAReply(self):
+        df = self.agi.noop()
+        self.agi.lineReceived('HANGUP')
+        self.agi.lineReceived('511 Command Not Permitted on a dead channel')
+        self.assertEqual(self.agi.pendingMessages, [])
+        return self.assertFailure(df, AGIHangup)
+
+    def test_wait(self):
+        df = self.agi.wait(10)
+        self.agi.lineReceived('HANGUP')
+        self.assertEqual(len(self.agi.wheel), 0)
+        self.assertEqual(self.agi.pendingWaits, {})
+        return self.assertFailure(df, AGIHangup)
+
+    def test_deadline(self):
+        df = self.agi.sendCommand('NOOP', timeout=1)
+        self.agi.lineReceived('HANGUP')
+        self.assertEqual(len(self.agi.wheel), 0)
+        return self.assertFailure(df, AGIHangup)
+
+    def test_commandAfterHangup(self):
+        self.agi.lineReceived('HANGUP')
+        df = self.agi.noop()
+        self.assertEqual(self.tunnel.getvalue(), '')
+        return self.assertFailure(df, AGIHangup)
+
+
+class VariablesTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.writes = []
+        self.agi.transport.write = self.writes.append
+
+    def test_getVariables(self):
+        df = self.agi.getVariables('LANG', 'GROUP', 'LANG')
+        self.assertEqual(self.writes,
+                         ['GET FULL VARIABLE "${LANG}|~|${GROUP}"\n'])
+        self.agi.lineReceived('200 result=1 (en|~|)')
+        return df.addCallback(self.assertEqual, {'LANG': 'en', 'GROUP': ''})
+
+    def test_cachedVariables(self):
+        self.agi.getVariables('LANG', 'GROUP_COUNT(vip)')
+        self.agi.lineReceived('200 result=1 (en|~|3)')
+        df = self.agi.getVariables('LANG', 'GROUP_COUNT(vip)')
+        self.assertEqual(self.writes[1:],
+                         ['GET FULL VARIABLE "${GROUP_COUNT(vip)}"\n'])
+        self.agi.lineReceived('200 result=1 (4)')
+        return df.addCallback(self.assertEqual,
+                              {'LANG': 'en', 'GROUP_COUNT(vip)': '4'})
+
+    def test_delimiterInValue(self):
+        df = self.agi.getVariables('A', 'B')
+        self.agi.lineReceived('200 result=1 (a|~|b|~|c)')
+        self.assertEqual(self.agi.variables, {})
+        return self.assertFailure(df, AGICommandFailure)
+
+    def test_setVariableCached(self):
+        self.agi.setVariable('LANG', 'ru')
+        self.agi.lineReceived('200 result=1')
+        df = self.agi.getVariables('LANG')
+        self.assertEqual(len(self.writes), 1)
+        return df.addCallback(self.assertEqual, {'LANG': 'ru'})
+
+    def test_setVariables(self):
+        df = self.agi.setVariables({'B': 2, 'A': 'x'})
+        self.assertEqual(self.writes, ['EXEC MSet "A=x|B=2"\n'])
+        self.agi.lineReceived('200 result=0')
+        def check(result):
+            self.assertEqual(self.agi.variables, {'A': 'x', 'B': '2'})
+        return df.addCallback(check)
+
+    def test_setVariablesFailure(self):
+        df = self.agi.setVariables({'A': 'x'})
+        self.agi.lineReceived('200 result=-2')
+        self.assertEqual(self.agi.variables, {})
+        return self.assertFailure(df, AGICommandFailure)
+
+    def test_setVariablesBadValue(self):
+        self.assertRaises(ValueError, self.agi.setVariables, {'A': 'x|y'})
+        self.assertEqual(self.writes, [])
+
+    def test_invalidateVariables(self):
+        self.agi.variables.update({'A': '1', 'B': '2'})
+        self.agi.invalidateVariables('A')
+        self.assertEqual(self.agi.variables, {'B': '2'})
+        self.agi.invalidateVariables()
+        self.assertEqual(self.agi.variables, {})
+
+
+class PlaylistTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.writes = []
+        self.agi.transport.write = self.writes.append
+
+    def test_playback(self):
+        df = self.agi.playlist(['welcome', 'menu', 'digits/1'])
+        self.assertEqual(self.writes,
+                         ['EXEC Playback "welcome&menu&digits/1"\n'])
+        self.agi.lineReceived('200 result=0')
+        return df.addCallback(self.assertEqual, PlaylistResult())
+
+    def test_playbackFailure(self):
+        df = self.agi.playlist(['welcome'])
+        self.agi.lineReceived('200 result=-1')
+        return self.assertFailure(df, AGICommandFailure)
+
+    def test_interrupted(self):
+        df = self.agi.playlist(['welcome', 'menu', 'goodbye'], '12')
+        self.agi.lineReceived('200 result=0 endpos=8000')
+        self.agi.lineReceived('200 result=50 endpos=1200')
+        self.assertEqual(self.writes, ["STREAM FILE welcome '12'\n",
+                                       "STREAM FILE menu '12'\n"])
+        return df.addCallback(self.assertEqual,
+                              PlaylistResult('2', 1, 1200))
+
+    def test_notInterrupted(self):
+        df = self.agi.playlist(['welcome', 'menu'], '12')
+        self.agi.lineReceived('200 result=0 endpos=8000')
+        self.agi.lineReceived('200 result=0 endpos=9000')
+        self.assertEqual(len(self.writes), 2)
+        return df.addCallback(self.assertEqual, PlaylistResult())
+
+    def test_ampersandName(self):
+        self.agi.playlist(['a&b'])
+        self.assertEqual(self.writes, ["STREAM FILE a&b ''\n"])
+
+
 class TestURLParser(unittest.TestCase):
 
     def _test_URL(self, url_string, path, params):
@@ -0,0 +1,113 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""IVR flow tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+
+from twisted.fats.flow import Flow, _BATCH, _MENU, _END
+from twisted.fats.test.asterisk import AGITestCase
+
+RECEPTION = {
+    'main': [('answer',),
+             ('set', {'CDR(userfield)': 'ivr'}),
+             ('play', 'welcome'),
+             ('say', 'number', 42),
+             ('menu', ['press-1-sales', 'press-2-support'],
+              {'1': 'sales', '2': 'support'},
+              {'retries': 2, 'invalid': 'invalid', 'timeout': 3}),
+             ('hangup',)],
+    'sales': [('collect', 'ext', 'enter-ext', 4),
+              ('set', {'EXT': '%(ext)s'}),
+              ('transfer', 'SIP/%(ext)s')],
+    'support': [('transfer', 'SIP/support', 30)]}
+
+
+class CompileTest(unittest.TestCase):
+
+    def test_batches(self):
+        flow = Flow(RECEPTION)
+        ops = flow.nodes['main']
+        self.assertEqual([code for code, arg in ops],
+                         [_BATCH, _MENU, _BATCH, _END])
+        calls, dynamic = ops[0][1]
+        self.assertEqual([name for name, args, kwargs in calls],
+                         ['answer', 'setVariables', 'playlist'])
+        self.assertEqual(calls[2][1],
+                         (('welcome', 'digits/40', 'digits/2'),))
+        self.assertFalse(dynamic)
+        self.assertTrue(flow.nodes['sales'][1][1][1])
+
+    def test_unsupportedLanguage(self):
+        calls, dynamic = Flow(RECEPTION, language='de').nodes['main'][0][1]
+        self.assertEqual(calls[2:], (('playlist', (('welcome',),), {}),
+                                     ('sayNumber', ('42',), {})))
+
+    def test_unknownNode(self):
+        self.assertRaises(ValueError, Flow, {'main': [('goto', 'nowhere')]})
+        self.assertRaises(ValueError, Flow, {'other': [('hangup',)]})
+
+    def test_unknownStep(self):
+        self.assertRaises(ValueError, Flow, {'main': [('dance',)]})
+
+    def test_stepAfterTerminal(self):
+        self.assertRaises(ValueError, Flow,
+                          {'main': [('hangup',), ('answer',)]})
+
+
+class RunTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.writes = []
+        self.agi.transport.write = self.writes.append
+        self.flow = Flow(RECEPTION)
+
+    def reply(self, *lines):
+        for line in lines:
+            self.agi.lineReceived(line)
+
+    def start(self):
+        df = self.flow.run(self.agi)
+        self.assertEqual(self.writes, [
+            'ANSWER\nEXEC MSet "CDR(userfield)=ivr"\n'
+            'EXEC Playback "welcome&digits/40&digits/2"\n'])
+        self.reply('200 result=0', '200 result=0', '200 result=0')
+        self.assertEqual(self.writes[1:],
+                         ["STREAM FILE press-1-sales '12'\n"])
+        return df
+
+    def test_menuChoice(self):
+        df = self.start()
+        self.reply('200 result=50 endpos=100')
+        self.assertEqual(self.writes[2:], ['EXEC Dial "SIP/support|30"\n'])
+        self.reply('200 result=0')
+        return df.addCallback(self.assertEqual, {})
+
+    def test_collect(self):
+        df = self.start()
+        self.reply('200 result=0 endpos=100',
+                   '200 result=0 endpos=100')
+        self.assertEqual(self.writes[3:], ['WAIT FOR DIGIT 3000\n'])
+        self.reply('200 result=49')
+        self.assertEqual(self.writes[4:], ['GET DATA enter-ext 5000 4\n'])
+        self.reply('200 result=1234')
+        self.assertEqual(self.writes[5:], ['EXEC MSet "EXT=1234"\n'
+                                           'EXEC Dial "SIP/1234"\n'])
+        self.reply('200 result=0', '200 result=0')
+        return df.addCallback(self.assertEqual, {'ext': '1234'})
+
+    def test_noChoice(self):
+        df = self.start()
+        self.reply('200 result=51 endpos=100')
+        self.assertEqual(self.writes[2:], ['EXEC Playback "invalid"\n'])
+        self.reply('200 result=0',
+                   '200 result=0 endpos=100', '200 result=0 endpos=100')
+        self.reply('200 result=0')
+        self.assertEqual(self.writes[-1], 'HANGUP\n')
+        self.reply('200 result=1')
+        return df.addCallback(self.assertEqual, {})
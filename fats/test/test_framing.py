@@ -0,0 +1,133 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Stream framing tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+from twisted.internet.protocol import FileWrapper
+from twisted.test.test_protocols import StringIOWithoutClosing as SIOWC
+
+from twisted.fats.framing import Framer, FramedReceiver
+
+
+class FramerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.framer = Framer('\n')
+
+    def frames(self, data):
+        self.framer.extend(data)
+        frames = []
+        while True:
+            frame = self.framer.next()
+            if frame is None:
+                return frames
+            frames.append(frame.tobytes())
+
+    def test_lines(self):
+        self.assertEqual(self.frames('foo\nbar\n\nbaz'), ['foo', 'bar', ''])
+        self.assertEqual(len(self.framer), 3)
+        self.assertEqual(self.frames('\n'), ['baz'])
+        self.assertEqual(len(self.framer), 0)
+
+    def test_partial(self):
+        for chunk in ('fo', 'o', 'ba'):
+            self.assertEqual(self.frames(chunk), [])
+        self.assertEqual(self.framer.scanned, len(self.framer.buffer))
+        self.assertEqual(self.frames('r\nx'), ['foobar'])
+
+    def test_splitDelimiter(self):
+        self.framer.delimiter = '\r\n\r\n'
+        self.assertEqual(self.frames('a: 1\r\nb: 2\r\n\r'), [])
+        self.assertEqual(self.frames('\n'), ['a: 1\r\nb: 2'])
+
+    def test_switchDelimiter(self):
+        self.framer.delimiter = '\n\n'
+        self.framer.extend('a\nb\n\nc\nd\n')
+        self.assertEqual(self.framer.next().tobytes(), 'a\nb')
+        self.framer.delimiter = '\n'
+        self.assertEqual(self.frames(''), ['c', 'd'])
+
+    def test_split(self):
+        self.framer.extend('foo\nbar\n\nba')
+        self.assertEqual(self.framer.split(), ['foo', 'bar', ''])
+        self.assertEqual(self.framer.split(), [])
+        self.framer.extend('z\n')
+        self.assertEqual(self.framer.split(), ['baz'])
+        self.assertEqual(len(self.framer), 0)
+
+    def test_unread(self):
+        self.framer.extend('a\nbb\nccc\n')
+        frames = self.framer.split()
+        self.framer.unread(frames[1:], '\n')
+        self.framer.delimiter = '\nc'
+        self.assertEqual(self.frames(''), ['bb'])
+
+    def test_compaction(self):
+        self.frames('foo\nbar\nb')
+        self.framer.extend('az\n')
+        self.assertEqual(str(self.framer.buffer), 'baz\n')
+        self.assertEqual(self.framer.start, 0)
+
+    def test_referencedFrame(self):
+        self.framer.extend('foo\nbar')
+        frame = self.framer.next()
+        self.framer.extend('\n')
+        self.assertEqual(frame.tobytes(), 'foo')
+        self.assertEqual(self.frames(''), ['bar'])
+
+
+class LineCollector(FramedReceiver):
+    delimiter = '\n'
+    MAX_LENGTH = 10
+
+    def __init__(self):
+        self.lines = []
+        self.exceeded = []
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+
+    def lineLengthExceeded(self, line):
+        self.exceeded.append(line)
+
+
+class FramedReceiverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proto = LineCollector()
+        self.tunnel = SIOWC()
+        self.proto.makeConnection(FileWrapper(self.tunnel))
+
+    def test_lines(self):
+        for chunk in ('result', '=0\nre', 'sult=1\n\n'):
+            self.proto.dataReceived(chunk)
+        self.assertEqual(self.proto.lines, ['result=0', 'result=1', ''])
+        self.assertEqual(self.proto.exceeded, [])
+
+    def test_maxLength(self):
+        self.proto.dataReceived('0123456789abc')
+        self.assertEqual(self.proto.exceeded, ['0123456789abc'])
+        self.proto.dataReceived('ok\n')
+        self.assertEqual(self.proto.lines, ['ok'])
+
+    def test_longLineInBatch(self):
+        self.proto.dataReceived('ok\n0123456789abc\nlost\n')
+        self.assertEqual(self.proto.lines, ['ok'])
+        self.assertEqual(self.proto.exceeded, ['0123456789abc'])
+
+    def test_switchInBatch(self):
+        def frameReceived(frame):
+            self.proto.lines.append(frame)
+            self.proto.framer.delimiter = '\n\n'
+        self.proto.frameReceived = frameReceived
+        self.proto.dataReceived('a\nb\nc\n\nd\n')
+        self.assertEqual(self.proto.lines, ['a', 'b\nc'])
+
+    def test_sendLine(self):
+        self.proto.sendLine('NOOP')
+        self.assertEqual(self.tunnel.getvalue(), 'NOOP\n')
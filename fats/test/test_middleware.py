@@ -0,0 +1,234 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Middleware tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.internet.protocol import FileWrapper
+from twisted.python import failure
+from twisted.test.test_protocols import StringIOWithoutClosing as SIOWC
+
+from twisted.fats.admission import AdmissionController
+from twisted.fats.errors import AGIHangup
+from twisted.fats.middleware import Middleware, AccountcodeLimit, CallMetrics
+from twisted.fats.service import FastAGIFactory, CallHandler
+from twisted.fats.test.asterisk import ENV
+from twisted.fats.test.test_astdb import ShutdownClock
+
+
+class PendingHandler(CallHandler):
+    calls = []
+
+    def startCall(self):
+        df = defer.Deferred()
+        PendingHandler.calls.append(df)
+        return df
+
+
+class Recorder(Middleware):
+
+    def __init__(self, name, events, stop=None):
+        self.name = name
+        self.events = events
+        self.stop = stop
+
+    def before(self, agi):
+        self.events.append(('before', self.name))
+        return self.stop
+
+    def after(self, agi, result):
+        self.events.append(('after', self.name, result))
+
+    def error(self, agi, reason):
+        self.events.append(('error', self.name, reason.type))
+
+
+class BeforeOnly(Middleware):
+
+    def before(self, agi):
+        pass
+
+
+class CallMixin:
+
+    def setUp(self):
+        self.factory = FastAGIFactory()
+        self.factory.handler = PendingHandler
+        self.events = []
+        PendingHandler.calls = []
+
+    def use(self, *middleware):
+        self.factory.middleware = middleware
+        self.factory.compileMiddleware()
+
+    def call(self, accountcode=''):
+        agi = self.factory.buildProtocol(None)
+        agi.makeConnection(FileWrapper(SIOWC()))
+        agi.finished = False
+        def finish():
+            agi.finished = True
+        agi.finish = finish
+        agi._startCall(dict(ENV, agi_request='agi://localhost/menu',
+                            agi_accountcode=accountcode))
+        return agi
+
+
+class MiddlewareTest(CallMixin, unittest.TestCase):
+
+    def test_noMiddleware(self):
+        self.factory.compileMiddleware()
+        self.assertEqual((self.factory._before, self.factory._after,
+                          self.factory._error), ((), (), ()))
+        agi = self.call()
+        PendingHandler.calls.pop().callback(None)
+        self.failUnless(agi.finished)
+
+    def test_compile(self):
+        self.use(Middleware(), BeforeOnly())
+        self.assertEqual(len(self.factory._before), 1)
+        self.assertEqual((self.factory._after, self.factory._error),
+                         ((), ()))
+
+    def test_order(self):
+        self.use(Recorder('a', self.events), Recorder('b', self.events))
+        agi = self.call()
+        self.assertEqual(self.events, [('before', 'a'), ('before', 'b')])
+        PendingHandler.calls.pop().callback('done')
+        self.assertEqual(self.events[2:], [('after', 'b', 'done'),
+                                           ('after', 'a', 'done')])
+        self.failUnless(agi.finished)
+
+    def test_error(self):
+        self.use(Recorder('a', self.events), Recorder('b', self.events))
+        agi = self.call()
+        PendingHandler.calls.pop().errback(AGIHangup())
+        self.assertEqual(self.events[2:], [('error', 'b', AGIHangup),
+                                           ('error', 'a', AGIHangup)])
+        self.failUnless(agi.finished)
+
+    def test_shortCircuit(self):
+        self.use(Recorder('a', self.events),
+                 Recorder('b', self.events, stop='busy'),
+                 Recorder('c', self.events))
+        agi = self.call()
+        self.assertEqual(PendingHandler.calls, [])
+        self.assertEqual(self.events, [('before', 'a'), ('before', 'b'),
+                                       ('after', 'c', 'busy'),
+                                       ('after', 'b', 'busy'),
+                                       ('after', 'a', 'busy')])
+        self.failUnless(agi.finished)
+
+    def test_shortCircuitDeferred(self):
+        stopped = defer.Deferred()
+        self.use(Recorder('a', self.events, stop=stopped))
+        agi = self.call()
+        self.failIf(agi.finished)
+        stopped.callback('played')
+        self.assertEqual(self.events[1:], [('after', 'a', 'played')])
+        self.failUnless(agi.finished)
+        self.assertEqual(PendingHandler.calls, [])
+
+    def test_shortCircuitFailure(self):
+        self.use(Recorder('a', self.events,
+                          stop=failure.Failure(AGIHangup())))
+        agi = self.call()
+        self.assertEqual(self.events[1:], [('error', 'a', AGIHangup)])
+        self.failUnless(agi.finished)
+
+    def test_beforeRaises(self):
+        class Broken(Middleware):
+            def before(self, agi):
+                raise ValueError()
+        self.use(Recorder('a', self.events), Broken())
+        agi = self.call()
+        self.assertEqual(PendingHandler.calls, [])
+        self.assertEqual(self.events[1:], [('error', 'a', ValueError)])
+        self.failUnless(agi.finished)
+
+    def test_afterRaises(self):
+        class Broken(Middleware):
+            def after(self, agi, result):
+                raise ValueError()
+        self.use(Recorder('a', self.events), Broken())
+        agi = self.call()
+        PendingHandler.calls.pop().callback('done')
+        self.assertEqual(self.events[1:], [('after', 'a', 'done')])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.failUnless(agi.finished)
+
+    def test_admissionRejected(self):
+        clock = ShutdownClock()
+        self.factory.admission = AdmissionController(
+            maxCalls=1, queueTimeout=1, reactor=clock)
+        self.use(Recorder('a', self.events))
+        self.call(), self.call()
+        clock.advance(1.5)
+        self.assertEqual(len(PendingHandler.calls), 1)
+        self.assertEqual(self.events, [('before', 'a'), ('before', 'a'),
+                                       ('after', 'a', False)])
+
+
+class AccountcodeLimitTest(CallMixin, unittest.TestCase):
+
+    def test_limit(self):
+        limit = AccountcodeLimit({'acme': 1})
+        self.use(limit)
+        first = self.call('acme')
+        second = self.call('acme')
+        self.call('other')
+        self.assertEqual(len(PendingHandler.calls), 2)
+        self.assertEqual(limit.rejected, 1)
+        self.failUnless(second.finished)
+        self.assertEqual(limit.active, {'acme': 1})
+        PendingHandler.calls.pop(0).callback(None)
+        self.failUnless(first.finished)
+        self.assertEqual(limit.active, {})
+        self.call('acme')
+        self.assertEqual(limit.active, {'acme': 1})
+
+    def test_fallback(self):
+        redirected = []
+        def fallback(agi):
+            redirected.append(agi)
+            return defer.succeed(None)
+        limit = AccountcodeLimit(2, fallback)
+        self.use(limit)
+        self.call('acme'), self.call('acme')
+        third = self.call('acme')
+        self.assertEqual(redirected, [third])
+        self.assertEqual(limit.active, {'acme': 2})
+        PendingHandler.calls.pop().errback(AGIHangup())
+        self.assertEqual(limit.active, {'acme': 1})
+
+
+class CallMetricsTest(CallMixin, unittest.TestCase):
+
+    def setUp(self):
+        CallMixin.setUp(self)
+        self.clock = task.Clock()
+
+    def test_stats(self):
+        metrics = CallMetrics(reactor=self.clock)
+        self.use(metrics)
+        self.call(), self.call(), self.call()
+        self.assertEqual(metrics.stats()['active'], 3)
+        self.clock.advance(2)
+        PendingHandler.calls.pop().callback(None)
+        PendingHandler.calls.pop().errback(AGIHangup())
+        PendingHandler.calls.pop().errback(ValueError())
+        self.assertEqual(metrics.stats(), {'calls': 3, 'active': 0,
+                                           'completed': 1, 'hangups': 1,
+                                           'failures': 1,
+                                           'averageTime': 2.0})
+
+    def test_stopped(self):
+        metrics = CallMetrics(reactor=self.clock)
+        self.use(metrics, AccountcodeLimit(0))
+        self.call()
+        self.assertEqual(PendingHandler.calls, [])
+        self.assertEqual(metrics.stats()['completed'], 1)
@@ -0,0 +1,163 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Variable prefetch tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+from twisted.internet import error
+from twisted.internet.protocol import FileWrapper
+from twisted.python import failure
+from twisted.test.test_protocols import StringIOWithoutClosing as SIOWC
+
+from twisted.fats.agi import FastAGIProtocol
+from twisted.fats.errors import AGICommandFailure
+from twisted.fats.prefetch import Prefetcher
+from twisted.fats.test.asterisk import ENV, MockFastAGIFactory
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prefetcher = Prefetcher(commands=3, learnCalls=2)
+
+    def startCall(self, path='menu'):
+        agi = FastAGIProtocol()
+        agi.factory = MockFastAGIFactory()
+        agi.prefetcher = self.prefetcher
+        agi.makeConnection(FileWrapper(SIOWC()))
+        agi.writes = []
+        agi.transport.write = agi.writes.append
+        agi._startCall(dict(ENV, agi_request='agi://localhost/%s' % path))
+        return agi
+
+    def endCall(self, agi):
+        agi.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    def learn(self, path='menu'):
+        """
+        Record the calls which read C{LANG} and C{VIP}.
+        """
+        for _ in range(2):
+            agi = self.startCall(path)
+            agi.getVariable('LANG')
+            agi.lineReceived('200 result=1 (en)')
+            agi.getFullVariable('${VIP}')
+            agi.lineReceived('200 result=1 (vip)')
+            self.endCall(agi)
+
+    def test_learning(self):
+        agi = self.startCall()
+        agi.getVariable('LANG')
+        self.assertEqual(agi.writes, ['GET VARIABLE LANG\n'])
+        agi.lineReceived('200 result=1 (en)')
+        self.endCall(agi)
+        self.assertEqual(self.prefetcher.routes[('menu',)].profile, ())
+
+    def test_prefetch(self):
+        self.learn()
+        agi = self.startCall()
+        self.assertEqual(agi.writes, ['GET FULL VARIABLE '
+                                      '"${VIP}|~|${LANG}"\n'])
+        agi.lineReceived('200 result=1 (vip|~|en)')
+        results = []
+        agi.getVariable('LANG').addCallback(results.append)
+        agi.getFullVariable('${VIP}').addCallback(results.append)
+        self.assertEqual([command.extra for command in results],
+                         ['en', 'vip'])
+        self.assertEqual(len(agi.writes), 1)
+        self.assertEqual(self.prefetcher.hits, 2)
+
+    def test_functionsNotPrefetched(self):
+        for _ in range(2):
+            agi = self.startCall()
+            agi.getFullVariable('${CDR(billsec)}')
+            agi.lineReceived('200 result=1 (0)')
+            self.endCall(agi)
+        self.assertEqual(self.prefetcher.routes[('menu',)].profile, ())
+
+    def test_setThenGet(self):
+        self.learn()
+        agi = self.startCall()
+        agi.lineReceived('200 result=1 (vip|~|en)')
+        agi.setVariable('LANG', 'ru')
+        agi.invalidateVariables('VIP')
+        agi.getVariable('LANG')
+        agi.getFullVariable('${VIP}')
+        self.assertEqual(agi.writes[1:], ["SET VARIABLE LANG 'ru'\n",
+                                          'GET VARIABLE LANG\n',
+                                          'GET FULL VARIABLE ${VIP}\n'])
+        self.assertEqual(self.prefetcher.hits, 0)
+
+    def test_setWhilePrefetching(self):
+        self.learn()
+        agi = self.startCall()
+        agi.setVariables({'LANG': 'ru'})
+        agi.lineReceived('200 result=1 (vip|~|en)')
+        agi.getVariable('LANG')
+        self.assertEqual(agi.writes[-1], 'GET VARIABLE LANG\n')
+
+    def test_readWhilePrefetching(self):
+        self.learn()
+        agi = self.startCall()
+        df = agi.getVariable('LANG')
+        self.assertEqual(len(agi.writes), 1)
+        agi.lineReceived('200 result=1 (vip|~|ru)')
+        return df.addCallback(lambda command:
+                              self.assertEqual(command.extra, 'ru'))
+
+    def test_secondReadSent(self):
+        self.learn()
+        agi = self.startCall()
+        agi.lineReceived('200 result=1 (vip|~|en)')
+        agi.getVariable('LANG')
+        agi.getVariable('LANG')
+        self.assertEqual(agi.writes[1:], ['GET VARIABLE LANG\n'])
+
+    def test_emptyVariableSent(self):
+        self.learn()
+        misses = self.prefetcher.misses
+        agi = self.startCall()
+        agi.lineReceived('200 result=1 (vip|~|)')
+        df = agi.getVariable('LANG')
+        self.assertEqual(agi.writes[1:], ['GET VARIABLE LANG\n'])
+        agi.lineReceived('200 result=0')
+        self.assertEqual(self.prefetcher.misses, misses + 1)
+        return self.assertFailure(df, AGICommandFailure)
+
+    def test_prefetchFailure(self):
+        self.learn()
+        agi = self.startCall()
+        df = agi.getVariable('LANG')
+        agi.lineReceived('510 Invalid or unknown command')
+        self.assertEqual(agi.writes[1:], ['GET VARIABLE LANG\n'])
+        agi.lineReceived('200 result=1 (en)')
+        return df.addCallback(lambda command:
+                              self.assertEqual(command.extra, 'en'))
+
+    def test_routes(self):
+        self.learn('menu')
+        agi = self.startCall('queue')
+        self.assertEqual(agi.writes, [])
+
+    def test_lateReadsIgnored(self):
+        for _ in range(2):
+            agi = self.startCall()
+            for index in range(3):
+                agi.answer()
+                agi.lineReceived('200 result=0')
+            agi.getVariable('LATE')
+            agi.lineReceived('200 result=1 (late)')
+            self.endCall(agi)
+        self.assertEqual(self.prefetcher.routes[('menu',)].reads, {})
+
+    def test_unused(self):
+        self.learn()
+        agi = self.startCall()
+        agi.lineReceived('200 result=1 (vip|~|en)')
+        self.endCall(agi)
+        stats = self.prefetcher.stats()
+        self.assertEqual((stats['prefetched'], stats['unused']), (2, 2))
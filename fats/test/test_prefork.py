@@ -0,0 +1,252 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Prefork server tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import os, time, signal, socket
+
+from twisted.trial import unittest
+from twisted.internet import defer, protocol, reactor, task
+from twisted.python import usage
+
+from twisted.fats import prefork, tap
+from twisted.fats.service import FastAGIFactory
+
+
+class AcceptFactory(protocol.ServerFactory):
+
+    def __init__(self):
+        self.accepted = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        self.accepted.callback(addr)
+        return protocol.Protocol()
+
+
+def freePort():
+    skt = socket.socket()
+    skt.bind(('127.0.0.1', 0))
+    port = skt.getsockname()[1]
+    skt.close()
+    return port
+
+
+class PortTest(unittest.TestCase):
+
+    def connect(self, port):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(('127.0.0.1', port.getHost().port))
+        self.addCleanup(client.close)
+
+    def test_inherited(self):
+        skt = prefork.listeningSocket(0, '127.0.0.1')
+        factory = AcceptFactory()
+        port = prefork.InheritedPort(skt, factory)
+        port.startListening()
+        self.addCleanup(port.stopListening)
+        self.assertEqual(port.getHost().port, skt.getsockname()[1])
+        self.connect(port)
+        return factory.accepted
+
+    def test_inheritedStop(self):
+        skt = prefork.listeningSocket(0, '127.0.0.1')
+        shared = socket.fromfd(skt.fileno(), socket.AF_INET,
+                               socket.SOCK_STREAM)
+        first = prefork.InheritedPort(shared, AcceptFactory())
+        first.startListening()
+        factory = AcceptFactory()
+        second = prefork.InheritedPort(skt, factory)
+        second.startListening()
+        self.addCleanup(second.stopListening)
+        df = defer.maybeDeferred(first.stopListening)
+        df.addCallback(lambda _: self.connect(second))
+        return df.addCallback(lambda _: factory.accepted)
+
+    def test_reusePort(self):
+        first = prefork.ReusePort(0, AcceptFactory(), interface='127.0.0.1')
+        first.startListening()
+        factory = AcceptFactory()
+        second = prefork.ReusePort(first.getHost().port, factory,
+                                   interface='127.0.0.1')
+        second.startListening()
+        self.addCleanup(second.stopListening)
+        df = defer.maybeDeferred(first.stopListening)
+        df.addCallback(lambda _: self.connect(second))
+        return df.addCallback(lambda _: factory.accepted)
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        test_reusePort.skip = 'SO_REUSEPORT is not supported'
+
+
+class PidProtocol(protocol.Protocol):
+
+    def connectionMade(self):
+        self.transport.write('%d\n' % os.getpid())
+        self.transport.loseConnection()
+
+
+class PidFactory(FastAGIFactory):
+    protocol = PidProtocol
+
+
+def pidFactory():
+    if os.environ.get('FATS_TEST_BROKEN'):
+        raise RuntimeError('broken handler code')
+    return PidFactory()
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(signal.signal, signal.SIGHUP,
+                        signal.getsignal(signal.SIGHUP))
+        self.supervisor = prefork.Supervisor(
+            'twisted.fats.test.test_prefork.pidFactory', 0, workers=2,
+            interface='127.0.0.1', restartDelay=0.1, drainTimeout=1,
+            stopTimeout=5)
+
+    def tearDown(self):
+        if self.supervisor.running:
+            return self.supervisor.stopService()
+
+    def until(self, condition, timeout=30):
+        """
+        @return: deferred fired when the condition is true.
+        """
+        deadline = time.time() + timeout
+        def check():
+            if condition():
+                return None
+            if time.time() > deadline:
+                self.fail('Condition is not met in %s seconds' % timeout)
+            return task.deferLater(reactor, 0.05, check)
+        return defer.maybeDeferred(check)
+
+    def listening(self):
+        processes = self.supervisor.processes.values()
+        return (len(processes) == self.supervisor.workers and
+                not [process for process in processes if not process.ready]
+                and self.supervisor._starting is None)
+
+    def pids(self):
+        return sorted([process.pid
+                       for process in self.supervisor.processes.values()])
+
+    def served(self):
+        """
+        @return: process id of the worker which accepted the connection.
+        """
+        client = socket.create_connection(
+            ('127.0.0.1', self.supervisor.getPort()), 10)
+        try:
+            return int(client.makefile().readline())
+        finally:
+            client.close()
+
+    def start(self):
+        self.supervisor.startService()
+        return self.until(self.listening)
+
+    def test_start(self):
+        def check(_):
+            self.assertIn(self.served(), self.pids())
+        return self.start().addCallback(check)
+
+    def test_reusePort(self):
+        self.supervisor.reusePort = True
+        self.supervisor.port = freePort()
+        def check(_):
+            self.assertIn(self.served(), self.pids())
+        return self.start().addCallback(check)
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        test_reusePort.skip = 'SO_REUSEPORT is not supported'
+
+    def test_restart(self):
+        def crash(_):
+            self.crashed = self.supervisor.processes[0].pid
+            os.kill(self.crashed, signal.SIGKILL)
+            return self.until(lambda: self.supervisor.restarts == 1 and
+                              self.listening())
+        def check(_):
+            self.assertNotIn(self.crashed, self.pids())
+            self.assertEqual(self.supervisor.stats(),
+                             {'workers': 2, 'retiring': 0, 'restarts': 1})
+        return self.start().addCallback(crash).addCallback(check)
+
+    def test_stop(self):
+        def stop(_):
+            self.processes = self.supervisor.processes.values()
+            return self.supervisor.stopService()
+        def check(_):
+            self.assertEqual(self.supervisor.stats(),
+                             {'workers': 0, 'retiring': 0, 'restarts': 0})
+            for process in self.processes:
+                self.assertTrue(process.ended.called)
+        return self.start().addCallback(stop).addCallback(check)
+
+    def test_reload(self):
+        def reload(_):
+            self.old = self.pids()
+            self.supervisor.reload()
+            return self.until(lambda: self.listening() and
+                              not self.supervisor.retiring)
+        def check(_):
+            self.assertEqual(set(self.pids()) & set(self.old), set())
+            self.assertIn(self.served(), self.pids())
+        return self.start().addCallback(reload).addCallback(check)
+
+    def test_reloadFailed(self):
+        def reload(_):
+            self.old = self.pids()
+            os.environ['FATS_TEST_BROKEN'] = '1'
+            self.addCleanup(os.environ.pop, 'FATS_TEST_BROKEN')
+            self.supervisor.reload()
+            return self.until(lambda: self.supervisor._starting is None and
+                              not self.supervisor.retiring)
+        def check(_):
+            self.assertEqual(self.pids(), self.old)
+            self.assertIn(self.served(), self.old)
+        return self.start().addCallback(reload).addCallback(check)
+
+    def test_hangupSignal(self):
+        self.supervisor.startService()
+        self.assertEqual(signal.getsignal(signal.SIGHUP),
+                         self.supervisor._hangup)
+        df = self.supervisor.stopService()
+        self.assertNotEqual(signal.getsignal(signal.SIGHUP),
+                            self.supervisor._hangup)
+        return df
+
+
+class OptionsTest(unittest.TestCase):
+
+    def test_options(self):
+        config = tap.Options()
+        config.parseOptions(['--factory', 'twisted.fats.service.FastAGIFactory',
+                             '--workers', '4', '--cpus', '0,2', '-r',
+                             '--drain-timeout', '60'])
+        self.assertEqual((config['port'], config['workers'], config['cpus'],
+                          config['reuse-port']), (4573, 4, [0, 2], True))
+        supervisor = tap.makeService(config)
+        self.assertEqual(supervisor.factory,
+                         'twisted.fats.service.FastAGIFactory')
+        self.assertEqual((supervisor.workers, supervisor.drainTimeout,
+                          supervisor.stopTimeout), (4, 60, 65))
+
+    def test_unknownFactory(self):
+        config = tap.Options()
+        config.parseOptions(['--factory', 'twisted.fats.service.Missing'])
+        self.assertRaises(AttributeError, tap.makeService, config)
+
+    def test_factoryRequired(self):
+        self.assertRaises(usage.UsageError, tap.Options().parseOptions, [])
+
+    def test_invalidCPUs(self):
+        self.assertRaises(usage.UsageError, tap.Options().parseOptions,
+                          ['-f', 'twisted.fats.service.FastAGIFactory',
+                           '--cpus', 'all'])
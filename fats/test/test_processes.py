@@ -0,0 +1,139 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Process pool tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import os, time
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from twisted.fats.errors import TaskQueueFull, TaskError, AGICommandTimeout
+from twisted.fats.processes import ProcessPool
+from twisted.fats.service import CallHandler
+
+
+def square(x):
+    return x * x
+
+
+def pid():
+    return os.getpid()
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+def fail():
+    raise ValueError('bad number')
+
+
+def crash():
+    os._exit(3)
+
+
+def unpicklable():
+    return lambda: None
+
+
+class ProcessPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ProcessPool(processes=1, maxTasks=2, maxQueue=2)
+
+    def tearDown(self):
+        return self.pool.stop()
+
+    def test_result(self):
+        return self.pool.submit(square, 7).addCallback(self.assertEqual, 49)
+
+    def test_otherProcess(self):
+        return self.pool.submit(pid).addCallback(self.assertNotEqual,
+                                                 os.getpid())
+
+    def test_error(self):
+        def check(error):
+            self.assertEqual(error.type, 'ValueError')
+            self.assertEqual(error.value, 'bad number')
+            self.assertIn('fail', error.traceback)
+            self.assertEqual(self.pool.failed, 1)
+        return self.assertFailure(self.pool.submit(fail), TaskError
+                                  ).addCallback(check)
+
+    def test_recycling(self):
+        df = defer.gatherResults([self.pool.submit(pid) for i in range(3)])
+        def check(pids):
+            self.assertEqual(len(set(pids)), 2)
+            self.assertEqual(self.pool.recycled, 1)
+        return df.addCallback(check)
+
+    def test_unpicklableTask(self):
+        df = self.pool.submit(lambda: None)
+        self.assertEqual(self.pool.pending, 0)
+        return self.assertFailure(df, Exception)
+
+    def test_unpicklableResult(self):
+        def check(error):
+            self.assertEqual(self.pool.pending, 0)
+            self.assertEqual(self.pool.failed, 1)
+        return self.assertFailure(self.pool.submit(unpicklable), TaskError
+                                  ).addCallback(check)
+
+    def test_queueLimit(self):
+        dfs = [self.pool.submit(square, i) for i in range(4)]
+        self.assertEqual(self.pool.rejected, 1)
+        self.assertFailure(dfs[-1], TaskQueueFull)
+        return defer.gatherResults(dfs)
+
+    def test_timeout(self):
+        df = self.pool.submit(sleep, 0.5, timeout=0.1)
+        def check(result):
+            self.assertEqual(self.pool.timedOut, 1)
+            self.assertEqual(self.pool.pending, 0)
+        return self.assertFailure(df, AGICommandTimeout).addCallback(check)
+
+    def test_timeoutReplacesWorker(self):
+        df = self.pool.submit(sleep, 30, timeout=0.1)
+        self.assertFailure(df, AGICommandTimeout)
+        started = time.time()
+        def check(result):
+            self.assertTrue(time.time() - started < 10)
+        later = self.pool.submit(square, 5)
+        later.addCallback(self.assertEqual, 25).addCallback(check)
+        return defer.gatherResults([df, later])
+
+    def test_workerDied(self):
+        def check(error):
+            self.assertEqual(error.type, 'WorkerExited')
+            return self.pool.submit(square, 4).addCallback(self.assertEqual,
+                                                           16)
+        return self.assertFailure(self.pool.submit(crash), TaskError
+                                  ).addCallback(check)
+
+    def test_stats(self):
+        def check(result):
+            stats = self.pool.stats()
+            self.assertEqual(stats['completed'], 2)
+            self.assertEqual(stats['pending'], 0)
+            self.assertTrue(stats['maxRun'] >= 0.1)
+            self.assertTrue(stats['maxWait'] >= stats['averageWait'] >= 0)
+        df = defer.gatherResults([self.pool.submit(sleep, 0.1),
+                                  self.pool.submit(square, 2)])
+        return df.addCallback(check)
+
+    def test_callHandler(self):
+        handler = CallHandler()
+        handler.processPool = self.pool
+        return handler.deferToProcess(square, 3).addCallback(
+            self.assertEqual, 9)
+
+    def test_stopFailsPending(self):
+        df = self.pool.submit(sleep, 5)
+        self.pool.stop()
+        self.assertEqual(self.pool.pending, 0)
+        return self.assertFailure(df, defer.CancelledError)
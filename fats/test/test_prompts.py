@@ -0,0 +1,135 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Prompt catalog tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import os, struct
+
+from twisted.trial import unittest
+
+from twisted.fats.errors import FailureOnOpen
+from twisted.fats.prompts import PromptCatalog, wavDuration
+from twisted.fats.test.asterisk import AGITestCase
+
+
+def wavFile(seconds, byteRate=16000):
+    data = '\0' * int(seconds * byteRate)
+    fmt = struct.pack('<HHIIHH', 1, 1, byteRate / 2, byteRate, 2, 16)
+    return ('RIFF' + struct.pack('<I', 4 + 8 + len(fmt) + 8 + len(data)) +
+            'WAVE' + 'fmt ' + struct.pack('<I', len(fmt)) + fmt +
+            'data' + struct.pack('<I', len(data)) + data)
+
+
+class PromptCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        files = {'vm-intro.gsm': 'x' * 3300,
+                 'vm-intro.wav': wavFile(2),
+                 'digits/1.gsm': '',
+                 'ru/digits/1.gsm': '',
+                 'ru/vm-ru-only.ulaw': 'x' * 4000,
+                 'en/beep.gsm': '',
+                 'README.txt': ''}
+        for name, data in files.items():
+            path = os.path.join(self.path, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'wb').write(data)
+        self.catalog = PromptCatalog.fromDirectory(self.path, durations=True)
+
+    def test_index(self):
+        self.assertEqual(len(self.catalog), 4)
+        self.assertEqual(self.catalog.formats('vm-intro', 'en'),
+                         frozenset(['gsm', 'wav']))
+        self.assertEqual(self.catalog.formats('vm-intro', 'ru'),
+                         frozenset(['gsm', 'wav']))
+
+    def test_sharedFormats(self):
+        self.assertIdentical(self.catalog.prompts['digits/1'][''],
+                             self.catalog.prompts['beep']['en'])
+
+    def test_resolve(self):
+        resolve = self.catalog.resolve
+        self.assertEqual(resolve('digits/1', 'ru'), 'digits/1')
+        self.assertEqual(resolve('digits/1', 'de'), 'digits/1')
+        self.assertEqual(resolve('beep', 'ru'), 'en/beep')
+        self.assertEqual(resolve('beep', 'en_GB'), 'en/beep')
+        self.assertEqual(resolve('beep', 'en'), 'beep')
+        self.assertEqual(resolve('vm-ru-only', 'ru_RU'), 'ru/vm-ru-only')
+        self.assertEqual(resolve('vm-ru-only', 'en'), None)
+        self.assertEqual(resolve('missing', 'en'), None)
+
+    def test_durations(self):
+        self.assertEqual(self.catalog.duration('vm-intro', 'en'), 2.0)
+        self.assertEqual(self.catalog.duration('vm-ru-only', 'ru'), 0.5)
+        self.assertEqual(self.catalog.duration('missing', 'en'), None)
+
+    def test_wavDuration(self):
+        data = wavFile(1.5)
+        self.assertEqual(wavDuration(data[:256], len(data)), 1.5)
+        self.assertEqual(wavDuration('garbage', 7), None)
+
+    def test_absolute(self):
+        resolve = self.catalog.resolve
+        spool = '/var/spool/asterisk/voicemail/default/100/unavail'
+        root = os.path.abspath(self.path)
+        self.assertEqual(resolve(spool, 'ru'), spool)
+        self.assertEqual(resolve(root + '/ru/digits/1', 'en'),
+                         root + '/ru/digits/1')
+        self.assertEqual(resolve(root + '/en/digits/1', 'en'), None)
+
+    def test_manifest(self):
+        catalog = PromptCatalog.fromManifest(['# sounds of the server',
+                                              'ru/digits/2.gsm 0.4',
+                                              'digits/2.gsm', ''])
+        self.assertEqual(catalog.resolve('digits/2', 'ru'), 'digits/2')
+        self.assertEqual(catalog.duration('digits/2', 'ru'), 0.4)
+        self.assertEqual(catalog.duration('digits/2', 'en'), None)
+
+
+class ResolvingProtocolTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.writes = []
+        self.agi.transport.write = self.writes.append
+        self.agi.env = {'agi_language': 'ru'}
+        self.agi.prompts = PromptCatalog.fromManifest(['en/welcome.gsm',
+                                                       'menu.gsm'])
+
+    def test_missing(self):
+        df = self.agi.streamFile('goodbye')
+        self.assertEqual(self.writes, [])
+        return self.assertFailure(df, FailureOnOpen)
+
+    def test_absolutePath(self):
+        self.agi.streamFile('/var/spool/asterisk/voicemail/default/100/greet')
+        self.assertEqual(self.writes, [
+            "STREAM FILE /var/spool/asterisk/voicemail/default/100/greet ''"
+            "\n"])
+
+    def test_recorded(self):
+        self.agi.recordFile('greeting-100', 'wav', '#', beep=False)
+        self.agi.dataReceived('200 result=0 (timeout) endpos=8000\n')
+        self.agi.streamFile('greeting-100')
+        self.assertEqual(self.writes[-1], "STREAM FILE greeting-100 ''\n")
+
+    def test_fallback(self):
+        self.agi.getOption('welcome', '1')
+        self.agi.controlStreamFile('menu')
+        self.assertEqual(self.writes, ["GET OPTION en/welcome '1'\n",
+                                       "CONTROL STREAM FILE menu '' 0 '*' "
+                                       "'#'\n"])
+
+    def test_playlist(self):
+        df = self.agi.playlist(['welcome', 'goodbye'])
+        self.assertEqual(self.writes, [])
+        self.assertFailure(df, FailureOnOpen)
+        self.agi.playlist(['welcome', 'menu'])
+        self.assertEqual(self.writes, ['EXEC Playback "en/welcome&menu"\n'])
+        return df
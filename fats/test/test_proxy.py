@@ -0,0 +1,182 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""FastAGI proxy tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, protocol, reactor
+
+from twisted.fats.agi import parseURL
+from twisted.fats.environment import AGIEnvironment
+from twisted.fats.proxy import ProxyFactory, BackendPool, Backend, \
+     leastOutstanding, accountcodeHash, byPath
+from twisted.fats.service import FastAGIFactory, CallHandler
+
+
+class NamedHandler(CallHandler):
+    """
+    Reads the name of the backend from the channel.
+    """
+    name = None
+
+    def startCall(self):
+        return self.agi.getVariable(self.name)
+
+
+class FakeAsterisk(protocol.Protocol):
+    """
+    Sends the environment block and answers every command.
+    """
+
+    def __init__(self, request, accountcode=''):
+        self.request = request
+        self.accountcode = accountcode
+        self.commands = []
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.write('agi_network: yes\nagi_request: %s\n'
+                             'agi_accountcode: %s\n\n'
+                             % (self.request, self.accountcode))
+
+    def dataReceived(self, data):
+        for line in data.splitlines():
+            self.commands.append(line)
+            self.transport.write('200 result=1 (x)\n')
+
+    def connectionLost(self, reason):
+        self.done.callback(self.commands)
+
+
+def policyArgs(path='/', accountcode=''):
+    env = AGIEnvironment('agi_accountcode: %s' % accountcode)
+    return env, parseURL('agi://localhost%s' % path)
+
+
+class PolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backends = [Backend('a'), Backend('b'), Backend('c')]
+
+    def test_leastOutstanding(self):
+        self.backends[0].active = 2
+        self.backends[1].active = 1
+        self.backends[2].active = 3
+        self.assertIdentical(leastOutstanding(self.backends, *policyArgs()),
+                             self.backends[1])
+
+    def test_accountcodeHash(self):
+        env, url = policyArgs(accountcode='acme')
+        chosen = accountcodeHash(self.backends, env, url)
+        self.assertIdentical(accountcodeHash(list(reversed(self.backends)),
+                                             env, url), chosen)
+        rest = [backend for backend in self.backends
+                if backend is not chosen]
+        self.assertIn(accountcodeHash(rest, env, url), rest)
+
+    def test_byPath(self):
+        policy = byPath({'queue': ['b:4573'], 'queue/vip': ['c:4573']})
+        self.assertEqual(policy(self.backends, *policyArgs('/queue/1')).name,
+                         'b:4573')
+        self.assertEqual(policy(self.backends,
+                                *policyArgs('/queue/vip/1')).name, 'c:4573')
+        self.assertEqual(policy(self.backends, *policyArgs('/menu')).name,
+                         'a:4573')
+        self.assertEqual(policy(self.backends[:1],
+                                *policyArgs('/queue')).name, 'a:4573')
+
+
+class ProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ports = []
+
+    def tearDown(self):
+        self.pool.stop()
+        return defer.gatherResults([defer.maybeDeferred(port.stopListening)
+                                    for port in self.ports])
+
+    def listen(self, factory):
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.ports.append(port)
+        return port.getHost().port
+
+    def backend(self, name):
+        handler = type('Handler', (NamedHandler,), {'name': name})
+        factory = FastAGIFactory()
+        factory.handler = handler
+        return Backend('127.0.0.1', self.listen(factory), name)
+
+    def deadBackend(self):
+        port = reactor.listenTCP(0, protocol.ServerFactory(),
+                                 interface='127.0.0.1')
+        number = port.getHost().port
+        port.stopListening()
+        return Backend('127.0.0.1', number, 'dead')
+
+    def proxy(self, *backends, **kwargs):
+        self.pool = BackendPool(backends, **kwargs)
+        return self.listen(ProxyFactory(self.pool))
+
+    def call(self, port, request='agi://localhost/menu', accountcode=''):
+        asterisk = FakeAsterisk(request, accountcode)
+        creator = protocol.ClientCreator(reactor, lambda: asterisk)
+        creator.connectTCP('127.0.0.1', port)
+        return asterisk.done
+
+    def test_proxied(self):
+        port = self.proxy(self.backend('first'))
+        def check(commands):
+            self.assertEqual(commands, ['GET VARIABLE first'])
+            stats = self.pool.stats()['backends']['first']
+            self.assertEqual((stats['calls'], stats['active']), (1, 0))
+            self.assertNotIdentical(stats['responseTime'], None)
+        return self.call(port).addCallback(check)
+
+    def test_byPath(self):
+        port = self.proxy(self.backend('menu'), self.backend('queue'),
+                          policy=byPath({'queue': ['queue']}))
+        df = defer.gatherResults([
+            self.call(port, 'agi://localhost/queue/1'),
+            self.call(port, 'agi://localhost/menu')])
+        return df.addCallback(self.assertEqual,
+                              [['GET VARIABLE queue'], ['GET VARIABLE menu']])
+
+    def test_failover(self):
+        dead = self.deadBackend()
+        port = self.proxy(dead, self.backend('live'))
+        def check(commands):
+            self.assertEqual(commands, ['GET VARIABLE live'])
+            self.assertFalse(dead.healthy)
+            self.assertEqual(dead.failures, 1)
+            self.assertEqual(self.pool.failovers, 1)
+        return self.call(port).addCallback(check)
+
+    def test_unavailable(self):
+        port = self.proxy(self.deadBackend())
+        def check(commands):
+            self.assertEqual(commands, [])
+            self.assertEqual(self.pool.unavailable, 1)
+        return self.call(port).addCallback(check)
+
+    def test_healthCheck(self):
+        live = self.backend('live')
+        live.healthy = False
+        dead = self.deadBackend()
+        self.proxy(live, dead)
+        self.pool.check()
+        df = defer.Deferred()
+        def wait():
+            if live._checking or dead._checking:
+                reactor.callLater(0.01, wait)
+            else:
+                df.callback(None)
+        wait()
+        def check(result):
+            self.assertTrue(live.healthy)
+            self.assertFalse(dead.healthy)
+        return df.addCallback(check)
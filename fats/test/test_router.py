@@ -0,0 +1,152 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Request router tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.internet.protocol import FileWrapper
+from twisted.test.test_protocols import StringIOWithoutClosing as SIOWC
+
+from twisted.fats.agi import parseURL, getURLCache
+from twisted.fats.errors import AGIHangup
+from twisted.fats.router import Router
+from twisted.fats.service import FastAGIFactory, CallHandler
+from twisted.fats.test.asterisk import ENV
+
+
+class Main(CallHandler):
+    calls = []
+
+    def startCall(self):
+        df = defer.Deferred()
+        self.calls.append((self.__class__.__name__, self.agi.routeArgs, df))
+        return df
+
+
+class Queue(Main):
+    pass
+
+
+class Stats(Main):
+    pass
+
+
+class Files(Main):
+    pass
+
+
+class Default(Main):
+    pass
+
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.router = Router([('ivr/main', Main),
+                              ('queue/{queue}', Queue),
+                              ('queue/{queue}/stats', Stats, 'stats')],
+                             reactor=self.clock)
+        self.router.add('files/*path', Files)
+
+    def match(self, path):
+        route, args = self.router.match(tuple(path.split('/')))
+        return route and route.handler, args
+
+    def test_static(self):
+        self.assertEqual(self.match('ivr/main'), (Main, {}))
+
+    def test_capture(self):
+        self.assertEqual(self.match('queue/support'),
+                         (Queue, {'queue': 'support'}))
+        self.assertEqual(self.match('queue/sales%20team/stats'),
+                         (Stats, {'queue': 'sales team'}))
+
+    def test_rest(self):
+        self.assertEqual(self.match('files/en/digits/1'),
+                         (Files, {'path': 'en/digits/1'}))
+        self.assertEqual(self.router.match(('files',)),
+                         (self.router.routes[-1], {'path': ''}))
+
+    def test_staticPreferred(self):
+        self.router.add('queue/vip', Main)
+        self.assertEqual(self.match('queue/vip'), (Main, {}))
+        self.assertEqual(self.match('queue/stats/stats'),
+                         (Stats, {'queue': 'stats'}))
+
+    def test_unmatched(self):
+        self.assertEqual(self.router.match(('ivr', 'sales')), (None, None))
+        self.assertEqual(self.router.match(('queue', 'a', 'b')),
+                         (None, None))
+        self.assertEqual(self.router.match(()), (None, None))
+
+    def test_root(self):
+        self.router.add('/', Main)
+        self.assertEqual(self.router.match(())[0].handler, Main)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.router.add, 'queue/{name}', Main)
+        self.assertRaises(ValueError, self.router.add, 'a/*rest/b', Main)
+
+
+class FactoryRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.router = Router([('ivr/main', Main), ('queue/{queue}', Queue)],
+                             reactor=self.clock)
+        self.factory = FastAGIFactory()
+        self.factory.router = self.router
+        Main.calls = []
+
+    def call(self, request):
+        agi = self.factory.buildProtocol(None)
+        agi.makeConnection(FileWrapper(SIOWC()))
+        agi.transport.write = lambda data: None
+        agi._startCall(dict(ENV, agi_request=request))
+        return agi
+
+    def test_dispatch(self):
+        agi = self.call('agi://localhost/queue/support?x=1')
+        self.assertEqual(Main.calls[0][:2], ('Queue', {'queue': 'support'}))
+        self.assertIdentical(agi.route, self.router.routes[1])
+        self.clock.advance(2)
+        Main.calls[0][2].callback(None)
+        self.assertEqual(self.router.stats()['routes']['queue/{queue}'],
+                         {'calls': 1, 'active': 0, 'hangups': 0,
+                          'failures': 0, 'averageTime': 2.0})
+
+    def test_failures(self):
+        self.call('agi://localhost/ivr/main')
+        self.call('agi://localhost/ivr/main')
+        Main.calls[0][2].errback(AGIHangup())
+        Main.calls[1][2].errback(ValueError())
+        stats = self.router.stats()['routes']['ivr/main']
+        self.assertEqual((stats['hangups'], stats['failures']), (1, 1))
+
+    def test_default(self):
+        self.factory.handler = Default
+        self.call('agi://localhost/unknown')
+        self.router.default = Files
+        self.call('agi://localhost/unknown')
+        self.assertEqual([call[0] for call in Main.calls],
+                         ['Default', 'Files'])
+        self.assertEqual(self.router.stats()['unmatched'], 2)
+
+
+class URLCacheTest(unittest.TestCase):
+
+    def test_shared(self):
+        request = 'agi://localhost/cached/url?a=b'
+        cache = getURLCache()
+        hits = cache.hits
+        url = parseURL(request)
+        self.assertIdentical(parseURL(request), url)
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual((url.path, url.params), (('cached', 'url'),
+                                                  {'a': 'b'}))
@@ -0,0 +1,164 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""SAY rendering tests, the expected files follow the Asterisk say.c
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import datetime
+
+from twisted.trial import unittest
+
+from twisted.fats.say import EnglishRenderer, RussianRenderer, render, \
+     sayCommand, Sentence
+from twisted.fats.test.asterisk import AGITestCase
+
+# Wednesday, 2008-03-05 14:05
+AFTERNOON = datetime.datetime(2008, 3, 5, 14, 5)
+
+
+class EnglishRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.say = EnglishRenderer()
+
+    def test_smallNumbers(self):
+        self.assertEqual(self.say.number(0), ['digits/0'])
+        self.assertEqual(self.say.number(13), ['digits/13'])
+        self.assertEqual(self.say.number(40), ['digits/40'])
+        self.assertEqual(self.say.number(42), ['digits/40', 'digits/2'])
+
+    def test_largeNumbers(self):
+        self.assertEqual(self.say.number(305),
+                         ['digits/3', 'digits/hundred', 'digits/5'])
+        self.assertEqual(self.say.number(2008),
+                         ['digits/2', 'digits/thousand', 'digits/8'])
+        self.assertEqual(self.say.number(-1200300),
+                         ['digits/minus', 'digits/1', 'digits/million',
+                          'digits/2', 'digits/hundred', 'digits/thousand',
+                          'digits/3', 'digits/hundred'])
+
+    def test_tooBig(self):
+        self.assertRaises(ValueError, self.say.number, 10 ** 9)
+
+    def test_digits(self):
+        self.assertEqual(self.say.digits('1*#-0'),
+                         ['digits/1', 'digits/star', 'digits/pound',
+                          'digits/minus', 'digits/0'])
+
+    def test_date(self):
+        self.assertEqual(self.say.date(AFTERNOON),
+                         ['digits/day-3', 'digits/mon-2', 'digits/5',
+                          'digits/2', 'digits/thousand', 'digits/8'])
+
+    def test_time(self):
+        self.assertEqual(self.say.time(AFTERNOON),
+                         ['digits/2', 'digits/oh', 'digits/5', 'digits/p-m'])
+        self.assertEqual(self.say.time(datetime.datetime(2008, 1, 1, 0, 0)),
+                         ['digits/12', 'digits/oclock', 'digits/a-m'])
+        self.assertEqual(self.say.time(datetime.datetime(2008, 1, 1, 12, 30)),
+                         ['digits/12', 'digits/30', 'digits/p-m'])
+
+    def test_datetime(self):
+        self.assertEqual(self.say.datetime(AFTERNOON),
+                         ['digits/day-3', 'digits/mon-2', 'digits/h-5',
+                          'digits/2', 'digits/thousand', 'digits/8',
+                          'digits/at', 'digits/2', 'digits/oh', 'digits/5',
+                          'digits/p-m'])
+
+    def test_datetimeLastCentury(self):
+        self.assertEqual(
+            self.say.datetime(datetime.datetime(1985, 1, 1), 'Y'),
+            ['digits/19', 'digits/80', 'digits/5'])
+
+    def test_unsupportedFormat(self):
+        self.assertRaises(ValueError, self.say.datetime, AFTERNOON, 'Q')
+
+
+class RussianRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.say = RussianRenderer()
+
+    def test_gender(self):
+        self.assertEqual(self.say.number(2), ['digits/2'])
+        self.assertEqual(self.say.number(2, 'f'), ['digits/2f'])
+        self.assertEqual(self.say.number(21, 'f'), ['digits/20', 'digits/1f'])
+        self.assertEqual(self.say.number(5, 'f'), ['digits/5'])
+
+    def test_hundreds(self):
+        self.assertEqual(self.say.number(345),
+                         ['digits/300', 'digits/40', 'digits/5'])
+
+    def test_thousands(self):
+        self.assertEqual(self.say.number(1000),
+                         ['digits/1f', 'digits/thousand'])
+        self.assertEqual(self.say.number(3000),
+                         ['digits/3', 'digits/thousands-i'])
+        self.assertEqual(self.say.number(11000),
+                         ['digits/11', 'digits/thousands'])
+        self.assertEqual(self.say.number(22005),
+                         ['digits/20', 'digits/2f', 'digits/thousands-i',
+                          'digits/5'])
+
+    def test_millions(self):
+        self.assertEqual(self.say.number(1000000),
+                         ['digits/1', 'digits/million'])
+        self.assertEqual(self.say.number(4000000),
+                         ['digits/4', 'digits/million-a'])
+        self.assertEqual(self.say.number(15000000),
+                         ['digits/15', 'digits/millions'])
+
+    def test_date(self):
+        self.assertEqual(self.say.date(AFTERNOON),
+                         ['digits/day-3', 'digits/mon-2', 'digits/5',
+                          'digits/2f', 'digits/thousands-i', 'digits/8'])
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_memoised(self):
+        first = render('ru', 'number', 1000, None)
+        self.assertIdentical(render('ru', 'number', 1000, None), first)
+        self.assertEqual(first, ('digits/1f', 'digits/thousand'))
+
+    def test_unknownLanguage(self):
+        self.assertEqual(render('de', 'number', 42, None), None)
+        self.assertEqual(sayCommand('number', 42, None),
+                         ('sayNumber', ('42',), {}))
+        self.assertEqual(sayCommand('datetime', 1204725900, 'HM'),
+                         ('sayDatetime', (1204725900.0,), {'format': 'HM'}))
+
+
+class SentenceTest(AGITestCase):
+
+    def test_play(self):
+        writes = []
+        self.agi.transport.write = writes.append
+        Sentence(self.agi).file('vm-youhave').number(3).file('vm-messages'
+            ).time(AFTERNOON).play()
+        self.assertEqual(writes,
+                         ['EXEC Playback "vm-youhave&digits/3&vm-messages&'
+                          'digits/2&digits/oh&digits/5&digits/p-m"\n'])
+
+    def test_language(self):
+        self.agi.env = dict(self.agi.env, agi_language='ru')
+        sentence = Sentence(self.agi).number(2000)
+        self.assertEqual(sentence.files, ['digits/2f', 'digits/thousands-i'])
+
+    def test_unsupportedLanguage(self):
+        self.agi.env = dict(self.agi.env, agi_language='de')
+        writes = []
+        self.agi.transport.write = writes.append
+        results = []
+        Sentence(self.agi).file('vm-youhave').number(21).file('vm-messages'
+            ).play('#').addCallback(results.append)
+        self.assertEqual(writes, ["STREAM FILE vm-youhave '#'\n"])
+        self.agi.lineReceived('200 result=0 endpos=100')
+        self.assertEqual(writes[1:], ["SAY NUMBER 21 '#'\n"])
+        self.agi.lineReceived('200 result=35')
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(results[0].digit, '#')
+        self.assertEqual(results[0].index, 1)
@@ -11,10 +11,17 @@ $Id: test_service.py 24 2008-02-18 12:22:42Z burus $
 #from twisted.fats.errors import AGICommandFailure, UndefinedTimeFormat, \
 #     AGICommandTimeout, FailureOnOpen
 #from twisted.fats.test.asterisk import ENV, AGITestCase, COMMANDS
+import os, sys
+
 from zope.interface import implements
-from twisted.internet import defer
-from twisted.fats.service import FastAGIFactory, ICallHandler
-from twisted.fats.test.asterisk import ENV
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.fats.service import FastAGIFactory, ICallHandler, CallHandler, \
+     CoroutineDriver, FastAGIServer, reloadHandlers
+from twisted.fats.agi import FastAGIProtocol
+from twisted.fats.errors import AGIHangup, LookupTimeout
+from twisted.fats.timer import TimerWheel
+from twisted.fats.test.asterisk import ENV, AGITestCase
 from twisted.trial import unittest
 #import time, datetime
 
@@ -36,6 +43,11 @@ class RottenCallHandler:
 
 
 class MockTransport:
+    disconnecting = False
+
+    def write(self, data):
+        pass
+
     def loseConnection(self):
         pass
 
@@ -59,3 +71,317 @@ class FastAGIFactoryTest(unittest.TestCase):
         self.agi.lineReceived('\n\n')   
         self.assertEqual(self.agi, self.factory.handler.agi)
     test_factoryWithRottenCallHandler.skip = True
+
+
+class HangupCallHandler(CallHandler):
+    hangups = 0
+
+    def startCall(self):
+        return self.agi.noop()
+
+    def hangupReceived(self):
+        HangupCallHandler.hangups += 1
+
+
+class HangupTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = FastAGIFactory()
+        self.factory.handler = HangupCallHandler
+        self.agi = self.factory.buildProtocol(None)
+        self.agi.transport = MockTransport()
+        self.agi.connectionMade()
+        HangupCallHandler.hangups = 0
+
+    def test_handlerNotified(self):
+        self.agi.dataReceived('agi_network: yes\n\n')
+        self.assertTrue(isinstance(self.agi.handler, HangupCallHandler))
+        self.agi.dataReceived('HANGUP\n')
+        self.assertEqual(HangupCallHandler.hangups, 1)
+        self.assertTrue(self.agi.hungup)
+
+
+class CoroutineDriverTest(unittest.TestCase):
+
+    def test_readyResults(self):
+        def script():
+            first = yield defer.succeed(1)
+            second = yield defer.succeed(2)
+            defer.returnValue(first + second)
+        return CoroutineDriver(script()).start().addCallback(
+            self.assertEqual, 3)
+
+    def test_pendingResults(self):
+        pending = [defer.Deferred() for i in range(3)]
+        def script():
+            total = 0
+            for df in pending:
+                total += yield df
+            defer.returnValue(total)
+        result = CoroutineDriver(script()).start()
+        for i, df in enumerate(pending):
+            self.assertFalse(result.called)
+            df.callback(i + 1)
+        return result.addCallback(self.assertEqual, 6)
+
+    def test_plainValues(self):
+        def script():
+            value = yield 'value'
+            defer.returnValue(value)
+        return CoroutineDriver(script()).start().addCallback(
+            self.assertEqual, 'value')
+
+    def test_stopIteration(self):
+        def script():
+            yield defer.succeed(None)
+        return CoroutineDriver(script()).start().addCallback(
+            self.assertEqual, None)
+
+    def test_errorCaught(self):
+        df = defer.Deferred()
+        def script():
+            try:
+                yield df
+            except ValueError:
+                defer.returnValue('caught')
+        result = CoroutineDriver(script()).start()
+        df.errback(ValueError())
+        return result.addCallback(self.assertEqual, 'caught')
+
+    def test_errorRaised(self):
+        def script():
+            yield defer.fail(ValueError())
+        return self.assertFailure(CoroutineDriver(script()).start(),
+                                  ValueError)
+
+    def test_longReadyChain(self):
+        def script():
+            for i in xrange(5000):
+                yield defer.succeed(i)
+        return CoroutineDriver(script()).start()
+
+
+class CoroutineCallHandler(CallHandler):
+    results = []
+
+    def startCall(self):
+        result = yield self.agi.noop()
+        CoroutineCallHandler.results.append(result.result)
+
+
+class CoroutineHandlerTest(unittest.TestCase):
+
+    def test_handleCall(self):
+        factory = FastAGIFactory()
+        factory.handler = CoroutineCallHandler
+        agi = factory.buildProtocol(None)
+        agi.transport = MockTransport()
+        agi.connectionMade()
+        agi.dataReceived('agi_network: yes\n\n')
+        agi.dataReceived('200 result=0\n')
+        self.assertEqual(CoroutineCallHandler.results, ['0'])
+
+
+class OverlapTest(AGITestCase):
+
+    def setUp(self):
+        AGITestCase.setUp(self)
+        self.clock = task.Clock()
+        self.agi.wheel = TimerWheel(self.clock)
+        self.writes = []
+        self.agi.transport.write = self.writes.append
+        self.handler = CallHandler()
+        self.handler.agi = self.agi
+        self.lookup = defer.Deferred()
+
+    def test_lookupDuringPlayback(self):
+        df = self.handler.overlap(self.lookup, ['hello', 'wait'])
+        self.assertEqual(self.writes, ['EXEC Playback "hello&wait"\n'])
+        self.clock.advance(1)
+        self.lookup.callback('SIP/100')
+        self.clock.advance(3)
+        self.agi.lineReceived('200 result=0')
+        def check(result):
+            self.assertEqual((result.value, result.hidden, result.waited),
+                             ('SIP/100', 1, 0))
+            self.assertEqual(self.handler.hiddenLatency, 1)
+        return df.addCallback(check)
+
+    def test_lookupAfterPlayback(self):
+        df = self.handler.overlap(lambda: self.lookup, 'hello')
+        self.clock.advance(4)
+        self.agi.lineReceived('200 result=0')
+        self.clock.advance(1)
+        self.lookup.callback('SIP/100')
+        def check(result):
+            self.assertEqual((result.hidden, result.waited), (4, 1))
+            self.assertEqual(self.agi.pendingWaits, {})
+        return df.addCallback(check)
+
+    def test_interrupted(self):
+        df = self.handler.overlap(self.lookup, 'hello', escapeDigits='1')
+        self.assertEqual(self.writes, ["STREAM FILE hello '1'\n"])
+        self.agi.lineReceived('200 result=49 endpos=800')
+        self.lookup.callback('SIP/100')
+        return df.addCallback(lambda result:
+                              self.assertEqual(result.playback.digit, '1'))
+
+    def test_deadline(self):
+        df = self.handler.overlap(self.lookup, 'hello', timeout=2)
+        self.agi.lineReceived('200 result=0')
+        self.clock.pump([0.5] * 6)
+        self.assertFailure(self.lookup, defer.CancelledError)
+        return self.assertFailure(df, LookupTimeout)
+
+    def test_hangupDuringPlayback(self):
+        df = self.handler.overlap(self.lookup, 'hello')
+        self.agi.hangupReceived()
+        self.assertFailure(self.lookup, defer.CancelledError)
+        return self.assertFailure(df, AGIHangup)
+
+    def test_hangupWhileWaiting(self):
+        df = self.handler.overlap(self.lookup, 'hello')
+        self.agi.lineReceived('200 result=0')
+        self.agi.hangupReceived()
+        self.assertFailure(self.lookup, defer.CancelledError)
+        return self.assertFailure(df, AGIHangup)
+
+    def test_lookupFailure(self):
+        df = self.handler.overlap(self.lookup, 'hello')
+        self.lookup.errback(ValueError())
+        self.agi.lineReceived('200 result=0')
+        return self.assertFailure(df, ValueError)
+
+
+class PendingCallHandler(CallHandler):
+    calls = []
+
+    def startCall(self):
+        df = defer.Deferred()
+        PendingCallHandler.calls.append(df)
+        return df
+
+
+class DrainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = FastAGIFactory()
+        self.factory.handler = PendingCallHandler
+        PendingCallHandler.calls = []
+
+    def call(self):
+        agi = self.factory.buildProtocol(None)
+        agi.transport = MockTransport()
+        agi.connectionMade()
+        agi.finished = False
+        def finish():
+            agi.finished = True
+        agi.finish = finish
+        agi.dataReceived('agi_network: yes\n\n')
+        return agi
+
+    def test_idle(self):
+        drained = []
+        self.factory.drain(reactor=self.clock).addCallback(drained.append)
+        self.assertEqual(drained, [0])
+        self.assertTrue(self.factory.draining)
+
+    def hangup(self, agi):
+        agi.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    def test_callsFinish(self):
+        first, second = self.call(), self.call()
+        self.assertEqual(self.factory.activeCalls, 2)
+        drained = []
+        self.factory.drain(timeout=10, reactor=self.clock
+                           ).addCallback(drained.append)
+        PendingCallHandler.calls[0].callback(None)
+        self.hangup(first)
+        self.clock.advance(5)
+        self.assertEqual(drained, [])
+        self.hangup(second)
+        self.assertEqual(drained, [0])
+        self.assertEqual(self.factory.activeCalls, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_deadline(self):
+        first, second = self.call(), self.call()
+        self.hangup(first)
+        drained = []
+        self.factory.drain(timeout=10, reactor=self.clock
+                           ).addCallback(drained.append)
+        self.factory.drain(reactor=self.clock).addCallback(drained.append)
+        self.clock.advance(10)
+        self.assertEqual(drained, [1, 1])
+        self.assertTrue(second.finished)
+        self.hangup(second)
+        self.assertEqual(self.factory.activeCalls, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class FastAGIServerTest(unittest.TestCase):
+
+    def test_drainOnStop(self):
+        factory = FastAGIFactory()
+        server = FastAGIServer(0, factory, interface='127.0.0.1')
+        self.assertIdentical(server.factory, factory)
+        server.drainTimeout = 1
+        server.startService()
+        df = server.stopService()
+        def check(dropped):
+            self.assertEqual(dropped, 0)
+            self.assertTrue(factory.draining)
+        return df.addCallback(check)
+
+
+HANDLER_MODULE = """
+from twisted.fats.service import CallHandler
+
+class Handler(CallHandler):
+    version = %d
+"""
+
+
+class ReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        os.mkdir(self.path)
+        sys.path.insert(0, self.path)
+        self.addCleanup(sys.path.remove, self.path)
+        self.addCleanup(sys.modules.pop, 'reloadable_ivr', None)
+        self.write(1)
+        import reloadable_ivr
+        self.factory = FastAGIFactory()
+        self.factory.handler = reloadable_ivr.Handler
+
+    def write(self, version, extra=''):
+        name = os.path.join(self.path, 'reloadable_ivr.py')
+        module = open(name, 'w')
+        module.write(HANDLER_MODULE % version + extra)
+        module.close()
+        for compiled in (name + 'c', name + 'o'):
+            if os.path.exists(compiled):
+                os.remove(compiled)
+
+    def test_reload(self):
+        old = self.factory.handler()
+        self.write(2)
+        self.assertEqual(reloadHandlers(self.factory), ['reloadable_ivr'])
+        self.assertEqual(self.factory.handler.version, 2)
+        self.assertEqual(old.version, 1)
+
+    def test_router(self):
+        from twisted.fats.router import Router
+        self.factory.router = Router([('menu', self.factory.handler)])
+        self.factory.handler = CallHandler
+        self.write(3)
+        self.assertEqual(reloadHandlers(self.factory), ['reloadable_ivr'])
+        self.assertEqual(self.factory.router.routes[0].handler.version, 3)
+        self.assertIdentical(self.factory.handler, CallHandler)
+
+    def test_brokenModule(self):
+        handler = self.factory.handler
+        self.write(4, 'class Broken(\n')
+        self.assertRaises(SyntaxError, reloadHandlers, self.factory)
+        self.assertIdentical(self.factory.handler, handler)
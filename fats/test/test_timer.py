@@ -0,0 +1,93 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Timer wheel tests
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task, error
+
+from twisted.fats.timer import TimerWheel, getWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(self.clock, tick=0.1, size=8)
+        self.fired = []
+
+    def test_fire(self):
+        self.wheel.callLater(0.25, self.fired.append, 'a')
+        self.wheel.callLater(0.05, self.fired.append, 'b')
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['b'])
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['b'])
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['b', 'a'])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_oneDelayedCall(self):
+        for i in range(100):
+            self.wheel.callLater(i * 0.01, self.fired.append, i)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.pump([0.1] * 11)
+        self.assertEqual(sorted(self.fired), range(100))
+
+    def test_rounds(self):
+        timer = self.wheel.callLater(2, self.fired.append, 'late')
+        self.clock.pump([0.1] * 19)
+        self.assertEqual(self.fired, [])
+        self.assertTrue(timer.active())
+        self.clock.pump([0.1] * 2)
+        self.assertEqual(self.fired, ['late'])
+        self.assertFalse(timer.active())
+        self.assertRaises(error.AlreadyCalled, timer.cancel)
+
+    def test_cancel(self):
+        timer = self.wheel.callLater(0.1, self.fired.append, 'a')
+        timer.cancel()
+        self.assertFalse(timer.active())
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertRaises(error.AlreadyCancelled, timer.cancel)
+        self.clock.advance(1)
+        self.assertEqual(self.fired, [])
+
+    def test_cancelFromTimer(self):
+        second = self.wheel.callLater(0.01, self.fired.append, 'b')
+        self.wheel.callLater(0.01, lambda: second.active() and second.cancel())
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_scheduleFromTimer(self):
+        def again():
+            self.fired.append(self.clock.seconds())
+            if len(self.fired) < 3:
+                self.wheel.callLater(0, again)
+        self.wheel.callLater(0, again)
+        self.clock.pump([0.1] * 5)
+        self.assertEqual(len(self.fired), 3)
+
+    def test_clockJump(self):
+        self.wheel.callLater(0.3, self.fired.append, 'a')
+        self.wheel.callLater(5, self.fired.append, 'b')
+        self.clock.advance(10)
+        self.assertEqual(sorted(self.fired), ['a', 'b'])
+
+    def test_error(self):
+        def fail():
+            raise ValueError()
+        self.wheel.callLater(0, fail)
+        self.wheel.callLater(0, self.fired.append, 'a')
+        self.clock.advance(0.1)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_sharedWheel(self):
+        self.assertIdentical(getWheel(self.clock), getWheel(self.clock))
+        self.assertNotIdentical(getWheel(self.clock), getWheel(task.Clock()))
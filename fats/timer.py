@@ -0,0 +1,180 @@
+# -*- test-case-name: twisted.fats.test.test_timer -*-
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+"""Hashed timer wheel
+
+API Stability: unstable
+
+Every live call has a few timers: the deadline of the pending command, the
+session deadline, the L{FastAGIProtocol.wait} pause. Most of them are
+cancelled long before they expire. Keeping them all in the reactor's delayed
+call heap makes every schedule and cancel pay for the heap of all the calls.
+
+The L{TimerWheel} hashes the timers into the slots by their expiration tick,
+so adding and cancelling a timer is a set operation, and the reactor sees a
+single delayed call per wheel which advances it while there are timers.
+The timers fire on the first tick after their time, so the precision is
+the L{TimerWheel.tick}.
+
+@author: U{Alexander Burtsev<mailto:eburus@gmail.com>}
+
+$Id$
+"""
+
+import weakref
+
+from twisted.internet import error
+from twisted.python import log
+
+TICK = 0.05
+SIZE = 512
+
+_wheels = weakref.WeakKeyDictionary()
+
+
+class WheelTimer(object):
+    """
+    Timer scheduled on the L{TimerWheel}, provides the C{cancel}, C{active}
+    and C{getTime} methods of the reactor's delayed call.
+
+    @ivar time: expiration time in seconds since the epoch.
+    """
+    __slots__ = ('wheel', 'time', 'slot', 'func', 'args', 'kw',
+                 'cancelled', 'called')
+
+    def __init__(self, wheel, time, func, args, kw):
+        self.wheel = wheel
+        self.time = time
+        self.slot = None
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.cancelled = self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        """
+        Unschedule the timer.
+
+        @raise error.AlreadyCancelled: if the timer is already cancelled.
+        @raise error.AlreadyCalled: if the timer has already fired.
+        """
+        if self.cancelled:
+            raise error.AlreadyCancelled
+        if self.called:
+            raise error.AlreadyCalled
+        self.cancelled = True
+        self.wheel._remove(self)
+        self.func = self.args = self.kw = None
+
+    def __repr__(self):
+        return '<WheelTimer %s at %s>' % (self.func, self.time)
+
+
+class TimerWheel(object):
+    """
+    Timers of the many calls driven by the one reactor delayed call.
+
+    @ivar clock: reactor or L{task.Clock} providing C{callLater} and
+        C{seconds}.
+    @ivar tick: duration of the slot in seconds.
+    @ivar slots: list of the timer sets.
+    @ivar cursor: number of the tick which is not processed completely.
+    """
+
+    def __init__(self, clock=None, tick=TICK, size=SIZE):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.tick = tick
+        self.slots = [set() for i in xrange(size)]
+        self.cursor = int(clock.seconds() / tick)
+        self.count = 0
+        self._call = None
+
+    def __len__(self):
+        """
+        @return: number of the scheduled timers.
+        """
+        return self.count
+
+    def callLater(self, delay, func, *args, **kw):
+        """
+        Schedule the function call like C{reactor.callLater}.
+
+        @return: L{WheelTimer}
+        """
+        timer = WheelTimer(self, self.clock.seconds() + delay, func, args, kw)
+        index = max(int(timer.time / self.tick), self.cursor)
+        timer.slot = self.slots[index % len(self.slots)]
+        timer.slot.add(timer)
+        self.count += 1
+        if self._call is None:
+            self._schedule()
+        return timer
+
+    def _remove(self, timer):
+        timer.slot.discard(timer)
+        timer.slot = None
+        self.count -= 1
+        if not self.count and self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _schedule(self):
+        now = self.clock.seconds()
+        delay = (int(now / self.tick) + 1) * self.tick - now
+        if delay < self.tick / 100:
+            delay += self.tick
+        self._call = self.clock.callLater(delay, self._advance)
+
+    def _advance(self):
+        """
+        Fire the expired timers of the passed ticks.
+        """
+        self._call = None
+        now = self.clock.seconds()
+        current = int(now / self.tick)
+        size = len(self.slots)
+        start = max(self.cursor, current - size + 1)
+        # The current tick may get more timers, it is scanned once again.
+        self.cursor = current
+        for index in xrange(start, current + 1):
+            slot = self.slots[index % size]
+            expired = [timer for timer in slot if timer.time <= now]
+            for timer in expired:
+                if timer.slot is None:
+                    # Cancelled by the previous timer.
+                    continue
+                self._remove(timer)
+                timer.called = True
+                func, args, kw = timer.func, timer.args, timer.kw
+                timer.func = timer.args = timer.kw = None
+                try:
+                    func(*args, **kw)
+                except:
+                    log.err()
+        if self.count and self._call is None:
+            self._schedule()
+
+
+def getWheel(clock=None):
+    """
+    @param clock: reactor, the global one by default.
+    @return: L{TimerWheel} shared by all the sessions of the reactor.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    wheel = _wheels.get(clock)
+    if wheel is None:
+        wheel = _wheels[clock] = TimerWheel(clock)
+    return wheel
+
+
+__all__ = ['TimerWheel', 'WheelTimer', 'getWheel', 'TICK']
@@ -7,10 +7,9 @@ except ImportError:
                      "have installed the Twisted core package before "
                      "attempting to install any other Twisted projects.")
 
-if sys.version_info[:2] != (2, 5):
-    raise SystemExit("Python 2.5 is required =(. "
-                     "You can install it anyway, but code isn't tested yet."
-                     "with the Python 2.4.")
+if sys.version_info[:2] < (2, 7):
+    raise SystemExit("Python 2.7 is required, the framing is built on "
+                     "the memoryview.")
 
 if __name__ == '__main__':
     if sys.version_info[:2] >= (2, 4):
@@ -0,0 +1,10 @@
+# Copyright (c) 2006-2008 Alexander Burtsev
+# See LICENSE for details
+
+from twisted.application.service import ServiceMaker
+
+TwistedFATS = ServiceMaker(
+    "Twisted FATS",
+    "twisted.fats.tap",
+    "A prefork FastAGI server.",
+    "fats")